@@ -0,0 +1,56 @@
+"""
+Latency of a one-backend change through the API handlers (PATCH add, then PATCH remove) vs number of backends
+already declared. The handlers are called directly, without HTTP, so only the control plane work is measured:
+registry update, slot layout, map writes of the changed slots, generation flip.
+
+Loads xdp_prog.c (nothing is attached to a NIC). Run as root from the repository root:
+    INTERFACE_IN=lo INTERFACE_OUT=lo MAX_BACKENDS=1024 python bench/backend_api.py
+"""
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xdp_lb
+from object import BackendPatchRequest, BackendRequest
+from registry import BackendRegistry
+
+logging.getLogger().setLevel(logging.WARNING)
+
+REPEAT = int(os.environ.get("REPEAT", "50"))
+MAC = "02:00:00:00:00:01"
+
+
+def request(i):
+    return BackendRequest(ip=f"10.{(i >> 16) & 0xff}.{(i >> 8) & 0xff}.{i & 0xff}", port=5555, mac=MAC)
+
+
+def bench(n):
+    xdp_lb.change_service_backends(0, BackendRegistry(xdp_lb.make_backends([request(i) for i in range(n)])))
+    extra = request(n)
+
+    add, remove = [], []
+    for _ in range(REPEAT):
+        time_start = time.perf_counter_ns()
+        xdp_lb.patch_service_backends(0, BackendPatchRequest(add=[extra]))
+        add.append(time.perf_counter_ns() - time_start)
+
+        time_start = time.perf_counter_ns()
+        xdp_lb.patch_service_backends(0, BackendPatchRequest(remove=[extra]))
+        remove.append(time.perf_counter_ns() - time_start)
+
+    return statistics.median(add), statistics.median(remove)
+
+
+if __name__ == "__main__":
+    xdp_lb.set_services(xdp_lb.config.services[:1])
+
+    for n in [1, 10, 100, 1000]:
+        if n >= xdp_lb.config.max_backends:
+            break
+        add, remove = bench(n)
+        print(json.dumps({"backends": n, "add_ms": round(add / 1e6, 3), "remove_ms": round(remove / 1e6, 3)}), flush=True)
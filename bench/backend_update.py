@@ -0,0 +1,69 @@
+"""
+Backend table update latency vs number of backends.
+
+Loads xdp_prog.c (nothing is attached to a NIC) and times set_backends() for growing backend counts:
+- write: replacing every backend (two disjoint sets in turn) so every slot of the inactive copy is rewritten with
+  batched map updates, grows with the number of backends
+- flip: the single backend_generation update that makes the new copy visible to packets, stays flat
+
+Run as root from the repository root:
+    INTERFACE_IN=lo INTERFACE_OUT=lo MAX_BACKENDS=8192 MAGLEV_TABLE_SIZE=65537 python bench/backend_update.py
+"""
+import ctypes
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xdp_lb
+from object import Backend
+
+logging.getLogger().setLevel(logging.WARNING)
+
+REPEAT = int(os.environ.get("REPEAT", "20"))
+
+
+def fake_backends(n, offset=0):
+    # 10.0.0.0/8, network byte order as written by make_backend
+    return [
+        Backend(ip=int.from_bytes(bytes([10, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff]), "little"),
+                port=0x5c15, tunnel_port=0, mac=(ctypes.c_ubyte * 6)(0x02, 0, 0, 0, 0, 1))
+        for i in range(offset, offset + n)
+    ]
+
+
+def bench_flip():
+    samples = []
+    for _ in range(REPEAT):
+        generation = xdp_lb.get_backend_generation()
+        time_start = time.perf_counter_ns()
+        xdp_lb.b["backend_generation"][0] = ctypes.c_uint32(generation)
+        samples.append(time.perf_counter_ns() - time_start)
+    return statistics.median(samples)
+
+
+def bench_update(n):
+    backends = [fake_backends(n), fake_backends(n, offset=n)]
+    samples = []
+    for i in range(REPEAT):
+        time_start = time.perf_counter_ns()
+        xdp_lb.set_backends(backends[i % 2])
+        samples.append(time.perf_counter_ns() - time_start)
+    return statistics.median(samples)
+
+
+if __name__ == "__main__":
+    results = []
+    n = 16
+    while n <= xdp_lb.config.max_backends:
+        results.append({
+            "backends": n,
+            "update_ms": bench_update(n) / 1e6,
+            "flip_us": bench_flip() / 1e3,
+        })
+        print(json.dumps(results[-1]), flush=True)
+        n *= 4
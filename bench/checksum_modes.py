@@ -0,0 +1,58 @@
+"""
+ns/packet of xdp_prog for each CHECKSUM_MODE, measured with BPF_PROG_TEST_RUN on one UDP packet per payload size.
+
+Checks that the forwarded packet has valid IP and UDP checksums (UDP checksum 0 in zero mode) before timing.
+
+    sudo python bench/checksum_modes.py
+"""
+import ctypes
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scapy.layers.inet import IP, UDP
+from scapy.layers.l2 import Ether
+from scapy.packet import Raw
+
+import config
+from testrun import XDP_ACTIONS, load, prog_test_run, set_service
+
+REPEAT = int(os.environ.get("REPEAT", "1000000"))
+PAYLOAD_SIZES = [int(x) for x in os.environ.get("PAYLOAD_SIZES", "18,128,512,1400").split(",")]
+
+VIP, PORT = "10.0.0.1", 5000
+
+
+def checksums_ok(packet: bytes, mode: str) -> bool:
+    forwarded = Ether(packet)
+    ip_check, udp_check = forwarded[IP].chksum, forwarded[UDP].chksum
+
+    # Let scapy recompute them
+    del forwarded[IP].chksum
+    del forwarded[UDP].chksum
+    expected = Ether(bytes(forwarded))
+
+    if mode == "zero":
+        return ip_check == expected[IP].chksum and udp_check == 0
+    return ip_check == expected[IP].chksum and udp_check == expected[UDP].chksum
+
+
+b, prog_fd = load()
+set_service(b, VIP, PORT, [("10.0.1.1", 6000)])
+
+for payload_size in PAYLOAD_SIZES:
+    packet = bytes(Ether(src="02:00:00:00:01:00", dst="02:00:00:00:00:ff") / IP(src="192.168.1.10", dst=VIP) / UDP(sport=40000, dport=PORT) / Raw(os.urandom(payload_size)))
+
+    for mode, value in config.checksum_modes.items():
+        b["csum_mode"][0] = ctypes.c_uint32(value)
+
+        action, forwarded, _ = prog_test_run(prog_fd, packet)
+        if XDP_ACTIONS[action] != "XDP_TX":
+            raise RuntimeError(f"Packet not forwarded: {XDP_ACTIONS[action]}")
+        if not checksums_ok(forwarded, mode):
+            raise RuntimeError(f"Invalid checksum in {mode} mode")
+
+        _, _, ns = prog_test_run(prog_fd, packet, REPEAT)
+        print(json.dumps({"mode": mode, "packet_size": len(packet), "repeat": REPEAT, "ns_per_packet": ns}))
@@ -0,0 +1,62 @@
+"""
+Compare two JSON lines results files of bench/prog_matrix.py and bench/pktgen_e2e.py (OUTPUT=...), typically from two
+commits. Results are matched on their parameters, prints one JSON line per metric with the relative change and exits 1
+when a metric got worse by more than THRESHOLD percent.
+
+    python bench/compare.py base.json new.json
+"""
+import json
+import os
+import sys
+
+THRESHOLD = float(os.environ.get("THRESHOLD", "5"))
+
+# Compared metrics -> True when higher is better, other metrics are informative
+METRICS = {
+    "ns_per_packet": False,
+    "pps": True,
+    "drop_rate": False,
+    "cpu_percent": False,
+}
+
+
+def load(path):
+    """
+    Results of the last run of each bench in path, keyed by (bench, parameters)
+    """
+    results = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get("kind") == "run":
+                results = {key: value for key, value in results.items() if key[0] != record["bench"]}
+                continue
+            params = tuple(sorted((k, v) for k, v in record.items() if k not in ("bench", "kind", "metrics")))
+            results[(record["bench"], params)] = record["metrics"]
+    return results
+
+
+if __name__ == "__main__":
+    base, new = load(sys.argv[1]), load(sys.argv[2])
+
+    regressions = 0
+    for key, metrics in new.items():
+        if key not in base:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            before, after = base[key].get(metric), metrics.get(metric)
+            if before is None or after is None:
+                continue
+
+            if before:
+                change = (after - before) / before * 100
+            else:
+                change = 0.0 if after == before else (100.0 if after > before else -100.0)
+            regression = (change < -THRESHOLD) if higher_is_better else (change > THRESHOLD)
+            regressions += regression
+            print(json.dumps({**dict(key[1]), "bench": key[0], "metric": metric, "base": before, "new": after,
+                              "change_percent": round(change, 2), "regression": regression}))
+
+    sys.exit(1 if regressions else 0)
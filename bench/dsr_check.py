@@ -0,0 +1,117 @@
+"""
+Checks of the direct server return setup of bench/dsr_netns.sh, each prints one JSON line and exits 1 on failure:
+- capture IFACE MODE VIP PORT [GUE_PORT]: the first packet for VIP:PORT received on IFACE (backend side) is
+  encapsulated as MODE (ipip, or gue to GUE_PORT) and carries the client packet unchanged
+- client IFACE VIP PORT BACKEND_MAC: a datagram sent to VIP:PORT is answered from VIP:PORT, by a frame coming from
+  BACKEND_MAC (the reply did not go back through the load balancer)
+
+Needs root (AF_PACKET sockets), run inside the namespaces:
+    ip netns exec dsr-backend python bench/dsr_check.py capture eth0 gue 10.200.0.100 5000 6080
+"""
+import json
+import socket
+import struct
+import sys
+import time
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+TIMEOUT = 5
+
+
+def sniff(iface):
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+    sock.bind((iface, 0))
+    sock.settimeout(TIMEOUT)
+    return sock
+
+
+def frames(sock):
+    deadline = time.monotonic() + TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            frame = sock.recv(65535)
+        except socket.timeout:
+            return
+        if len(frame) >= 34 and struct.unpack("!H", frame[12:14])[0] == ETH_P_IP:
+            yield frame
+
+
+def parse_ip(packet):
+    """
+    (protocol, source, destination, payload) of an IPv4 packet
+    """
+    ihl = (packet[0] & 0x0f) * 4
+    return packet[9], socket.inet_ntoa(packet[12:16]), socket.inet_ntoa(packet[16:20]), packet[ihl:]
+
+
+def udp_ports(payload):
+    return struct.unpack("!HH", payload[:4])
+
+
+def mac_str(mac):
+    return ":".join(f"{b:02x}" for b in mac)
+
+
+def capture(iface, mode, vip, port, gue_port=6080):
+    result = {"check": "encapsulation", "mode": mode, "ok": False}
+
+    for frame in frames(sniff(iface)):
+        protocol, outer_src, outer_dst, payload = parse_ip(frame[14:])
+        if protocol == socket.IPPROTO_IPIP:
+            encap, inner = "ipip", payload
+        elif protocol == socket.IPPROTO_UDP and len(payload) > 12 and udp_ports(payload)[1] == gue_port:
+            encap, inner = "gue", payload[12:]  # UDP header and GUE variant 1 (no header)
+        else:
+            continue
+
+        protocol, inner_src, inner_dst, inner_payload = parse_ip(inner)
+        if protocol != socket.IPPROTO_UDP or inner_dst != vip or udp_ports(inner_payload)[1] != port:
+            continue
+
+        result.update(encap=encap, outer_src=outer_src, outer_dst=outer_dst, inner_src=inner_src, inner_dst=inner_dst,
+                      ok=encap == mode)
+        if encap == "gue":
+            result["outer_sport"] = udp_ports(payload)[0]
+        break
+
+    print(json.dumps(result), flush=True)
+    return result["ok"]
+
+
+def client(iface, vip, port, backend_mac):
+    result = {"check": "direct_reply", "ok": False}
+    sniffer = sniff(iface)
+    payload = f"dsr {time.time_ns()}".encode()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(TIMEOUT)
+    sock.connect((vip, port))
+    sock.send(payload)
+    try:
+        data, address = sock.recvfrom(65535)
+        result.update(echo=data == payload, reply_from=f"{address[0]}:{address[1]}")
+    except socket.timeout:
+        print(json.dumps(result), flush=True)
+        return False
+
+    for frame in frames(sniffer):
+        protocol, src, _, udp = parse_ip(frame[14:])
+        if protocol == socket.IPPROTO_UDP and src == vip and udp_ports(udp)[0] == port and payload in udp:
+            result["reply_mac"] = mac_str(frame[6:12])
+            break
+
+    result["ok"] = result["echo"] and result["reply_from"] == f"{vip}:{port}" and result.get("reply_mac") == backend_mac.lower()
+    print(json.dumps(result), flush=True)
+    return result["ok"]
+
+
+if __name__ == "__main__":
+    check, args = sys.argv[1], sys.argv[2:]
+    if check == "capture":
+        ok = capture(args[0], args[1], args[2], int(args[3]), *[int(a) for a in args[4:]])
+    elif check == "client":
+        ok = client(args[0], args[1], int(args[2]), args[3])
+    else:
+        sys.exit(f"Unknown check {check}")
+    sys.exit(0 if ok else 1)
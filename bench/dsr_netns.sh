@@ -0,0 +1,88 @@
+#!/bin/sh
+# Direct server return between network namespaces joined by a bridge in the root namespace:
+#   dsr-client   10.200.0.1   sends to VIP:5000, the VIP resolves to the load balancer MAC
+#   dsr-lb       10.200.0.2   xdp_lb.py in SKB mode, encapsulates to the backend
+#   dsr-backend  10.200.0.3   VIP on lo, ipip/gue decapsulation, UDP echo server on VIP:5000
+# Prints the JSON lines of bench/dsr_check.py, exits 1 if a check failed. Run as root from the repository root:
+#     MODE=ipip sh bench/dsr_netns.sh
+#     MODE=gue sh bench/dsr_netns.sh
+set -eu
+
+MODE=${MODE:-ipip}
+GUE_PORT=${GUE_PORT:-6080}
+API_PORT=${API_PORT:-18000}
+VIP=10.200.0.100
+PORT=5000
+
+cleanup() {
+    [ -n "${LB_PID:-}" ] && kill "$LB_PID" 2>/dev/null || true
+    [ -n "${ECHO_PID:-}" ] && kill "$ECHO_PID" 2>/dev/null || true
+    for ns in client lb backend; do
+        ip netns del "dsr-$ns" 2>/dev/null || true
+    done
+    ip link del dsr-br 2>/dev/null || true
+}
+trap cleanup EXIT
+cleanup
+
+ip link add dsr-br type bridge
+ip link set dsr-br up
+i=1
+for ns in client lb backend; do
+    ip netns add "dsr-$ns"
+    ip link add "dsr-$ns" type veth peer name eth0 netns "dsr-$ns"
+    ip link set "dsr-$ns" master dsr-br up
+    ip -n "dsr-$ns" addr add "10.200.0.$i/24" dev eth0
+    ip -n "dsr-$ns" link set eth0 up
+    ip -n "dsr-$ns" link set lo up
+    i=$((i + 1))
+done
+
+# Backend: VIP on lo without answering ARP for it, tunnel device receiving from any remote
+ip -n dsr-backend addr add "$VIP/32" dev lo
+ip -n dsr-backend link add name dsr0 type ipip external
+ip -n dsr-backend link set dsr0 up
+ip netns exec dsr-backend sysctl -qw net.ipv4.conf.all.arp_ignore=1 net.ipv4.conf.all.arp_announce=2 \
+    net.ipv4.conf.all.rp_filter=0 net.ipv4.conf.default.rp_filter=0 net.ipv4.conf.dsr0.rp_filter=0
+if [ "$MODE" = gue ]; then
+    ip netns exec dsr-backend ip fou add port "$GUE_PORT" gue
+fi
+ip netns exec dsr-backend python3 -c "
+import socket
+sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+sock.bind(('$VIP', $PORT))
+while True:
+    data, address = sock.recvfrom(65535)
+    sock.sendto(data, address)
+" &
+ECHO_PID=$!
+
+# Load balancer: the default route only gives a fallback MAC, the backend is resolved before starting
+ip -n dsr-lb route add default via 10.200.0.1
+ip netns exec dsr-lb ping -c 1 -W 1 10.200.0.3 > /dev/null
+ip netns exec dsr-lb env INTERFACE_IN=eth0 INTERFACE_OUT=eth0 INTERFACE_IN_VIP="$VIP" DESTINATION_PORTS="$PORT" \
+    BACKENDS="10.200.0.3:$PORT" SERVICES_FILE= FORWARDING_MODE="$MODE" GUE_PORT="$GUE_PORT" \
+    XDP_MODE=XDP_FLAGS_SKB_MODE LISTEN_PORT="$API_PORT" RSS_CPUS= CONNTRACK_TIMEOUT=0 HEALTH_CHECK_INTERVAL=0 \
+    python3 xdp_lb.py > /tmp/dsr-lb.log 2>&1 &
+LB_PID=$!
+
+for _ in $(seq 60); do
+    if ip netns exec dsr-lb python3 -c "import urllib.request; urllib.request.urlopen('http://127.0.0.1:$API_PORT/api/v1/configs')" 2>/dev/null; then
+        break
+    fi
+    kill -0 "$LB_PID" || { cat /tmp/dsr-lb.log; exit 1; }
+    sleep 1
+done
+
+# Client: the VIP is reached through the load balancer
+LB_MAC=$(ip netns exec dsr-lb cat /sys/class/net/eth0/address)
+BACKEND_MAC=$(ip netns exec dsr-backend cat /sys/class/net/eth0/address)
+ip -n dsr-client neigh replace "$VIP" lladdr "$LB_MAC" dev eth0 nud permanent
+
+status=0
+ip netns exec dsr-backend python3 bench/dsr_check.py capture eth0 "$MODE" "$VIP" "$PORT" "$GUE_PORT" &
+CAPTURE_PID=$!
+sleep 1
+ip netns exec dsr-client python3 bench/dsr_check.py client eth0 "$VIP" "$PORT" "$BACKEND_MAC" || status=1
+wait "$CAPTURE_PID" || status=1
+exit $status
@@ -0,0 +1,191 @@
+"""
+Fleet rollout with fleet.py against NODES stand-in nodes: asyncio HTTP servers that answer the subset of the xdp_lb.py
+API fleet.py uses (/api/v1/configs, PUT of the backends and rate limit of a service, /api/v1/rates, xdp_verdict_total
+in /metrics), each request taking DELAY seconds like a real handler writing its maps.
+
+Cases:
+- converge: every node changed in a single wave without gates, then diffed, reports seconds to full convergence
+- noop: the same state again, nothing to change
+- staged: waves 1,25%,100% with health gates after SETTLE seconds
+- gate_failure: a backend that makes the stand-ins count failed forwards, the canary wave must fail, be rolled back,
+  and leave the other nodes untouched
+
+Exits 1 when a case does not end as expected. Does not need root or bcc:
+    python bench/fleet_converge.py
+    NODES=100 DELAY=0.005 python bench/fleet_converge.py
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fleet
+from results import Results
+
+NODES = int(os.environ.get("NODES", "30"))
+DELAY = float(os.environ.get("DELAY", "0.002"))
+SETTLE = float(os.environ.get("SETTLE", "0.2"))
+BACKENDS = int(os.environ.get("BACKENDS", "16"))
+PACKET_RATE = 100000
+
+# Backend whose packets the stand-ins count as failed forwards (no_lb_mac)
+BROKEN_BACKEND = "10.99.0.1"
+
+SERVICE_BACKENDS = re.compile(r"^/api/v1/services/(\d+)/backends$")
+SERVICE_RATE_LIMIT = re.compile(r"^/api/v1/services/(\d+)/rate_limit$")
+
+
+class StandInNode:
+    """
+    Two services with backends and a rate limit, and packet counters that advance with time: forwarded packets, or
+    failed ones while BROKEN_BACKEND is a backend
+    """
+
+    def __init__(self):
+        self.server = None
+        self.reset()
+
+    def reset(self):
+        self.services = {service_id: {
+            "id": service_id,
+            "name": f"service{service_id}",
+            "rate_limit": {"rate": 0, "burst": 0, "prefix": 32, "allow": [], "deny": []},
+            "declared": [backend(i) for i in range(BACKENDS)],
+        } for service_id in range(2)}
+        self.forwarded = self.failed = 0.0
+        self.last = time.monotonic()
+        self.requests = 0
+
+    def count(self):
+        now = time.monotonic()
+        packets = (now - self.last) * PACKET_RATE
+        broken = any(be["ip"] == BROKEN_BACKEND for service in self.services.values() for be in service["declared"])
+        if broken:
+            self.failed += packets
+        else:
+            self.forwarded += packets
+        self.last = now
+
+    def configs(self, service):
+        return {**service, "backends": service["declared"], "declared_backends": len(service["declared"])}
+
+    def handle(self, method, path, body):
+        self.count()
+        if method == "GET" and path == "/api/v1/configs":
+            return 200, {"services": [self.configs(service) for service in self.services.values()]}
+        if method == "GET" and path == "/api/v1/rates":
+            return 200, {"packet_rate": [PACKET_RATE // 2, PACKET_RATE // 2]}
+        if method == "GET" and path == "/metrics":
+            return 200, (f'xdp_verdict_total{{reason="forward",action="tx",interface="eth0",host="node"}} {self.forwarded:.0f}\n'
+                         f'xdp_verdict_total{{reason="no_lb_mac",action="drop",interface="eth0",host="node"}} {self.failed:.0f}\n')
+        if method == "PUT" and (match := SERVICE_BACKENDS.match(path)):
+            service = self.services[int(match.group(1))]
+            service["declared"] = [{"mac": "02:00:00:00:00:01", "tunnel_port": 0, **be} for be in body]
+            return 200, self.configs(service)
+        if method == "PUT" and (match := SERVICE_RATE_LIMIT.match(path)):
+            service = self.services[int(match.group(1))]
+            service["rate_limit"] = body
+            return 200, service["rate_limit"]
+        return 404, {"detail": "Not Found"}
+
+    async def serve(self, reader, writer):
+        try:
+            while request_line := await reader.readline():
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b""):
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                data = await reader.readexactly(int(headers.get("content-length", "0")))
+
+                await asyncio.sleep(DELAY)
+                self.requests += 1
+                status, response = self.handle(method, path, json.loads(data) if data else None)
+                payload = (response if isinstance(response, str) else json.dumps(response)).encode()
+                writer.write(f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n".encode() + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Client gone, or the event loop closing at the end of the run
+            pass
+        finally:
+            writer.close()
+
+    async def start(self) -> str:
+        self.server = await asyncio.start_server(self.serve, "127.0.0.1", 0)
+        return f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+
+
+def backend(i, weight=1):
+    return {"ip": f"10.1.{i >> 8}.{i & 0xff}", "port": 6000, "weight": weight}
+
+
+def desired_state(urls, extra=()):
+    return {
+        "nodes": urls,
+        "services": {
+            0: {"backends": [backend(i, 1 + i % 3) for i in range(1, BACKENDS + 1)] + list(extra)},
+            1: {"backends": [backend(i) for i in range(BACKENDS)], "rate_limit": {"rate": 1000, "deny": ["192.0.2.0/24"]}},
+        },
+        "waves": ["100%"],
+        "gates": dict(fleet.DEFAULT_GATES),
+    }
+
+
+async def run_case(results, case, state, nodes, waves, gates, expect_ok):
+    instance = fleet.Fleet(state)
+    requests = sum(node.requests for node in nodes)
+    snapshot = [json.dumps(node.services, sort_keys=True) for node in nodes]
+
+    start = time.perf_counter()
+    ok = await instance.apply(waves, gates)
+    seconds = time.perf_counter() - start
+    diff = await instance.diff()
+    instance.close()
+
+    diverged = [url for url, changes in diff.items() if changes]
+    if expect_ok:
+        passed = ok and not diverged
+    else:
+        # Rolled back: every node as before the rollout
+        passed = not ok and [json.dumps(node.services, sort_keys=True) for node in nodes] == snapshot
+
+    results.record({
+        "seconds": round(seconds, 4),
+        "requests": sum(node.requests for node in nodes) - requests,
+        "diverged_nodes": len(diverged),
+        "ok": passed,
+    }, case=case, waves=waves, settle=gates["settle"])
+    return passed
+
+
+async def main():
+    logging.basicConfig(level=logging.WARNING)
+    results = Results("fleet_converge", nodes=NODES, delay=DELAY, backends=BACKENDS)
+
+    nodes = [StandInNode() for _ in range(NODES)]
+    urls = [await node.start() for node in nodes]
+    state = fleet.parse_state(desired_state(urls))
+    broken = fleet.parse_state(desired_state(urls, [{"ip": BROKEN_BACKEND, "port": 6000}]))
+
+    passed = True
+    passed &= await run_case(results, "converge", state, nodes, "100%", {"settle": 0}, True)
+    passed &= await run_case(results, "noop", state, nodes, "100%", {"settle": 0}, True)
+    passed &= await run_case(results, "gate_failure", broken, nodes, "1,25%,100%", {"settle": SETTLE}, False)
+    # Back to the initial backends, so that the staged rollout has changes to make
+    for node in nodes:
+        node.reset()
+    passed &= await run_case(results, "staged", state, nodes, "1,25%,100%", {"settle": SETTLE}, True)
+
+    for node in nodes:
+        node.server.close()
+
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
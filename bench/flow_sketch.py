@@ -0,0 +1,84 @@
+"""
+Flow telemetry aggregation: samples per second added to FlowTelemetry (all dimensions) on one core, its memory, and the
+accuracy of the top flows and sources against exact counts.
+
+SAMPLES flow samples of FLOWS distinct flows (from FLOWS / 4 sources), Zipf distributed with exponent ZIPF, are added
+in batches of BATCH as run_flow_consumer does. recall is the share of the exact top TOP found by /api/v1/flows/top,
+max_error the largest relative error of their packet estimates. memory_bytes must not grow with FLOWS.
+
+Does not need root or bcc:
+    python bench/flow_sketch.py
+    FLOWS=1000000 SAMPLES=2000000 python bench/flow_sketch.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flows import DIMENSIONS, PACKETS, FlowTelemetry
+from object import FLOW_SAMPLE_DTYPE
+from results import Results
+
+FLOWS = int(os.environ.get("FLOWS", "100000"))
+SAMPLES = int(os.environ.get("SAMPLES", "1000000"))
+ZIPF = float(os.environ.get("ZIPF", "1.2"))
+TOP = int(os.environ.get("TOP", "20"))
+BATCH = int(os.environ.get("BATCH", "4096"))
+SAMPLE_RATE = 100
+
+
+def make_samples(rng):
+    flows = np.zeros(FLOWS, dtype=FLOW_SAMPLE_DTYPE)
+    flows["saddr"] = rng.integers(0, FLOWS // 4 + 1, FLOWS, dtype=np.uint32) + 0x0a000000
+    flows["daddr"] = 0x0100000a
+    flows["sport"] = rng.integers(1024, 65536, FLOWS)
+    flows["dport"] = 0x8813
+    flows["proto"] = 17
+    flows["backend_ip"] = 0x0101000a
+    flows["backend_port"] = 0x7017
+
+    samples = flows[(rng.zipf(ZIPF, SAMPLES) - 1) % FLOWS]
+    samples["pkt_size"] = rng.integers(64, 1500, SAMPLES)
+    return samples
+
+
+def memory_bytes(telemetry):
+    return sum(sketch.table.nbytes for heavy_hitters in telemetry.dimensions.values() for sketch in heavy_hitters.sketches) + \
+        sum(keys.nbytes + info.nbytes for heavy_hitters in telemetry.dimensions.values() for keys, info in zip(heavy_hitters.keys, heavy_hitters.info))
+
+
+def accuracy(telemetry, dimension, samples, now):
+    keys = DIMENSIONS[dimension][0](samples)
+    unique, counts = np.unique(keys, return_counts=True)
+    order = np.argsort(-counts, kind="stable")[:TOP]
+    exact = {tuple(DIMENSIONS[dimension][1](int(k["hi"]), int(k["lo"])).items()): int(c) * SAMPLE_RATE for k, c in zip(unique[order], counts[order])}
+
+    heavy_hitters = telemetry.dimensions[dimension]
+    top_keys, _, estimates = heavy_hitters.top(TOP, heavy_hitters.window(now))
+    found = {tuple(DIMENSIONS[dimension][1](int(k["hi"]), int(k["lo"])).items()): int(e[PACKETS]) for k, e in zip(top_keys, estimates)}
+
+    recall = len(exact.keys() & found.keys()) / max(len(exact), 1)
+    max_error = max((abs(found[k] - c) / c for k, c in exact.items() if k in found), default=0.0)
+    return round(recall, 3), round(max_error, 4)
+
+
+if __name__ == "__main__":
+    results = Results("flow_sketch", flows=FLOWS, samples=SAMPLES, zipf=ZIPF, top=TOP, batch=BATCH)
+    samples = make_samples(np.random.default_rng(1))
+
+    for capacity, width, depth in [(256, 1024, 4), (1024, 4096, 4), (4096, 16384, 4)]:
+        telemetry = FlowTelemetry(capacity, width, depth, slots=6, slot_seconds=10.0)
+        now = 1000.0
+
+        start = time.perf_counter()
+        for i in range(0, SAMPLES, BATCH):
+            telemetry.add(samples[i:i + BATCH], SAMPLE_RATE, now)
+        elapsed = time.perf_counter() - start
+
+        metrics = {"samples_per_second": round(SAMPLES / elapsed), "memory_bytes": memory_bytes(telemetry)}
+        for dimension in ["flow", "source"]:
+            metrics[f"{dimension}_recall"], metrics[f"{dimension}_max_error"] = accuracy(telemetry, dimension, samples, now)
+        results.record(metrics, capacity=capacity, width=width, depth=depth)
@@ -0,0 +1,88 @@
+"""
+Health checker against local UDP echo servers: BACKENDS servers on 127.0.0.1, a quarter of them stopped after the
+first checks then restarted. Reports how long the checker takes to mark them down and up again, and the CPU usage
+of the process (checker and echo servers).
+
+Does not need root or bcc:
+    BACKENDS=500 INTERVAL=0.5 python bench/health_check.py
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from health import HealthCheck, HealthChecker
+
+BACKENDS = int(os.environ.get("BACKENDS", "500"))
+INTERVAL = float(os.environ.get("INTERVAL", "0.5"))
+BASE_PORT = int(os.environ.get("BASE_PORT", "20000"))
+
+logging.disable(logging.WARNING)
+
+CHECK = HealthCheck(interval=INTERVAL, timeout=INTERVAL / 2, rise=2, fall=3, jitter=0.1, payload=b"ping", response=b"pong")
+
+
+class EchoServer(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if data == b"ping":
+            self.transport.sendto(b"pong", addr)
+
+
+async def start_server(port):
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(EchoServer, local_addr=("127.0.0.1", port))
+    return transport
+
+
+async def wait_for(checker, backends, up, timeout):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if all(checker.is_up(0, "127.0.0.1", port) == up for port in backends):
+            return time.perf_counter() - start
+        await asyncio.sleep(0.01)
+    raise TimeoutError(f"Backends not {'up' if up else 'down'} after {timeout} s")
+
+
+async def main():
+    ports = [BASE_PORT + i for i in range(BACKENDS)]
+    servers = {port: await start_server(port) for port in ports}
+    changes = []
+
+    checker = HealthChecker(on_change=changes.append)
+    await checker.start()
+    checker.set_targets(0, CHECK, [("127.0.0.1", port) for port in ports])
+    await asyncio.sleep(INTERVAL * 2)
+
+    cpu_start = time.process_time()
+    stopped = ports[::4]
+    for port in stopped:
+        servers.pop(port).close()
+
+    down = await wait_for(checker, stopped, False, INTERVAL * (CHECK.fall + 3))
+
+    for port in stopped:
+        servers[port] = await start_server(port)
+
+    up = await wait_for(checker, stopped, True, INTERVAL * (CHECK.rise + 3))
+    elapsed = down + up
+
+    print(json.dumps({
+        "backends": BACKENDS,
+        "stopped": len(stopped),
+        "interval_s": INTERVAL,
+        "fall": CHECK.fall,
+        "rise": CHECK.rise,
+        "down_detected_s": round(down, 3),
+        "up_detected_s": round(up, 3),
+        "still_up": sum(checker.is_up(0, "127.0.0.1", port) for port in ports if port not in stopped),
+        "cpu_percent": round((time.process_time() - cpu_start) / elapsed * 100, 1),
+    }))
+
+
+asyncio.run(main())
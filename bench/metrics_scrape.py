@@ -0,0 +1,86 @@
+"""
+/metrics load test: SCRAPERS concurrent clients scraping in a loop for DURATION seconds.
+
+Reports scrape latency percentiles, throughput and, when PID is the load balancer process, its CPU usage
+(utime + stime from /proc) over the run. Each client sends Accept-Encoding: gzip like Prometheus does,
+and ETAG=1 makes them revalidate with If-None-Match.
+
+    PID=$(pgrep -f xdp_lb.py) URL=http://127.0.0.1:8000/metrics SCRAPERS=100 python bench/metrics_scrape.py
+"""
+import asyncio
+import json
+import os
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+
+URL = urlsplit(os.environ.get("URL", "http://127.0.0.1:8000/metrics"))
+SCRAPERS = int(os.environ.get("SCRAPERS", "100"))
+DURATION = float(os.environ.get("DURATION", "10"))
+PID = os.environ.get("PID")
+ETAG = os.environ.get("ETAG", "0") == "1"
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def scrape(reader, writer, etag):
+    request = f"GET {URL.path or '/'} HTTP/1.1\r\nHost: {URL.netloc}\r\nAccept-Encoding: gzip\r\n"
+    if etag:
+        request += f"If-None-Match: {etag}\r\n"
+    writer.write((request + "\r\n").encode())
+    await writer.drain()
+
+    status_line = await reader.readline()
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode().partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    await reader.readexactly(int(headers.get("content-length", "0")))
+    return int(status_line.split()[1]), headers.get("etag")
+
+
+async def scraper(deadline, latencies, statuses):
+    reader, writer = await asyncio.open_connection(URL.hostname, URL.port or 80)
+    etag = None
+
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        status, new_etag = await scrape(reader, writer, etag if ETAG else None)
+        latencies.append(time.perf_counter() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+        etag = new_etag or etag
+
+    writer.close()
+
+
+async def main():
+    latencies, statuses = [], {}
+    cpu_start = cpu_seconds(PID) if PID else None
+
+    start = time.perf_counter()
+    await asyncio.gather(*(scraper(start + DURATION, latencies, statuses) for _ in range(SCRAPERS)))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    result = {
+        "scrapers": SCRAPERS,
+        "etag": ETAG,
+        "scrapes": len(latencies),
+        "scrapes_per_s": round(len(latencies) / elapsed, 1),
+        "statuses": statuses,
+        **{f"p{p}_ms": round(float(np.percentile(latencies, p)), 2) for p in (50, 90, 99)},
+        "max_ms": round(float(latencies.max()), 2),
+    }
+    if PID:
+        result["server_cpu_percent"] = round((cpu_seconds(PID) - cpu_start) / elapsed * 100, 1)
+
+    print(json.dumps(result))
+
+
+asyncio.run(main())
@@ -0,0 +1,51 @@
+"""
+MAC resolution of BACKENDS backends when adding them in bulk:
+- proc: the ARP entry of the backend, or of the default gateway, each reading and scanning /proc/net/arp (previous
+  path)
+- cache: NeighborCache.lookup, dict lookups after one netlink dump
+
+Backends are the addresses of the ARP table (so both paths find them) repeated up to BACKENDS.
+
+    BACKENDS=1000 python bench/neighbor_lookup.py
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+from neighbors import NeighborCache
+
+BACKENDS = int(os.environ.get("BACKENDS", "1000"))
+
+
+def run(name, resolve, ips):
+    start = time.perf_counter()
+    for ip in ips:
+        resolve(ip)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"resolver": name, "backends": len(ips), "us_per_backend": round(elapsed / len(ips) * 1e6, 2)}))
+
+
+def proc_arp(ip):
+    with open("/proc/net/arp") as f:
+        next(f)  # skip header
+        for line in f:
+            fields = line.split()
+            if fields[0] == ip:
+                return fields[3]
+    return None
+
+
+def proc(ip):
+    return proc_arp(ip) or proc_arp(utils.get_default_gateway_ip())
+
+
+cache = NeighborCache()
+known = list(cache.neighbors) or [utils.get_default_gateway_ip()]
+ips = [known[i % len(known)] for i in range(BACKENDS)]
+
+run("proc", proc, ips)
+run("cache", cache.lookup, ips)
@@ -0,0 +1,171 @@
+"""
+End to end throughput on one box: the kernel pktgen module sends UDP packets to the VIP from a veth in the root
+namespace, xdp_lb.py runs on the peer veth in the bench-lb namespace and sends them back (XDP_TX) to backends routed
+through the generator side. For each frame size, reports over DURATION seconds:
+- pps: packets sent by pktgen per second
+- drop_rate: share of the sent packets that did not come back from the load balancer
+- cpu_percent: CPU usage of the xdp_lb.py process (control plane)
+
+Results are JSON lines (see bench/results.py, OUTPUT=file to keep them). Needs root, bcc and the pktgen module.
+Runs from the repository root, the xdp_lb.py settings (LB_ALGORITHM, CHECKSUM_MODE...) come from the environment:
+    sudo OUTPUT=results.json python bench/pktgen_e2e.py
+"""
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bcc import BPF
+
+from results import ROOT, Results
+
+DURATION = float(os.environ.get("DURATION", "10"))
+FRAME_SIZES = [int(x) for x in os.environ.get("FRAME_SIZES", "64,512,1500").split(",")]
+BACKENDS = int(os.environ.get("BACKENDS", "16"))
+FLOWS = int(os.environ.get("FLOWS", "1024"))
+XDP_MODE = os.environ.get("XDP_MODE", "XDP_FLAGS_DRV_MODE")
+API_PORT = int(os.environ.get("API_PORT", "18001"))
+
+NS = "bench-lb"
+GEN_DEV, LB_DEV = "bench-gen", "eth0"
+GEN_IP, LB_IP, VIP, PORT = "10.201.0.1", "10.201.0.2", "10.201.0.100", 5000
+
+PKTGEN = "/proc/net/pktgen"
+
+
+def sh(*args, **kwargs):
+    return subprocess.run(args, check=True, capture_output=True, text=True, **kwargs).stdout
+
+
+def pktgen(path, command):
+    with open(os.path.join(PKTGEN, path), "w") as f:
+        f.write(command + "\n")
+
+
+def setup():
+    teardown()
+    sh("ip", "netns", "add", NS)
+    sh("ip", "link", "add", GEN_DEV, "type", "veth", "peer", "name", LB_DEV, "netns", NS)
+    sh("ip", "addr", "add", f"{GEN_IP}/24", "dev", GEN_DEV)
+    sh("ip", "link", "set", GEN_DEV, "up")
+    sh("ip", "-n", NS, "addr", "add", f"{LB_IP}/24", "dev", LB_DEV)
+    sh("ip", "-n", NS, "link", "set", LB_DEV, "up")
+    sh("ip", "-n", NS, "link", "set", "lo", "up")
+    # Backends are behind the generator, their MAC is the one of the generator veth
+    sh("ip", "-n", NS, "route", "add", "default", "via", GEN_IP)
+    sh("ip", "netns", "exec", NS, "ping", "-c", "1", "-W", "1", GEN_IP)
+
+
+def teardown():
+    subprocess.run(["ip", "netns", "del", NS], capture_output=True)
+    subprocess.run(["ip", "link", "del", GEN_DEV], capture_output=True)
+
+
+def start_lb():
+    env = {
+        **os.environ,
+        "INTERFACE_IN": LB_DEV,
+        "INTERFACE_OUT": LB_DEV,
+        "INTERFACE_IN_VIP": VIP,
+        "DESTINATION_PORTS": str(PORT),
+        "BACKENDS": ",".join(f"10.202.{i >> 8}.{i & 0xff}:{PORT}" for i in range(1, BACKENDS + 1)),
+        "SERVICES_FILE": "",
+        "XDP_MODE": XDP_MODE,
+        "LISTEN_PORT": str(API_PORT),
+    }
+    log = open("/tmp/bench-lb.log", "w")
+    lb = subprocess.Popen(["ip", "netns", "exec", NS, sys.executable, "xdp_lb.py"], cwd=ROOT, env=env, stdout=log, stderr=log)
+
+    probe = f"import urllib.request; urllib.request.urlopen('http://127.0.0.1:{API_PORT}/api/v1/configs')"
+    for _ in range(60):
+        if lb.poll() is not None:
+            raise RuntimeError("xdp_lb.py exited, see /tmp/bench-lb.log")
+        if subprocess.run(["ip", "netns", "exec", NS, sys.executable, "-c", probe], capture_output=True).returncode == 0:
+            return lb
+        time.sleep(1)
+    raise RuntimeError("xdp_lb.py did not start, see /tmp/bench-lb.log")
+
+
+def cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime, fields 14 and 15
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def rx_packets(dev):
+    with open(f"/sys/class/net/{dev}/statistics/rx_packets") as f:
+        return int(f.read())
+
+
+def run(frame_size, lb_mac, pid):
+    pktgen("kpktgend_0", "rem_device_all")
+    pktgen("kpktgend_0", f"add_device {GEN_DEV}")
+    for command in [
+        "count 0",
+        "clone_skb 0",  # veth does not support shared skbs
+        f"pkt_size {frame_size - 4}",  # without FCS
+        "delay 0",
+        f"dst {VIP}",
+        f"dst_mac {lb_mac}",
+        f"src_min {GEN_IP}",
+        f"src_max {GEN_IP}",
+        f"udp_dst_min {PORT}",
+        f"udp_dst_max {PORT}",
+        "udp_src_min 1024",
+        f"udp_src_max {1024 + FLOWS - 1}",
+    ]:
+        pktgen(GEN_DEV, command)
+
+    returned, cpu = rx_packets(GEN_DEV), cpu_seconds(pid)
+    # start blocks until stop
+    generator = threading.Thread(target=pktgen, args=("pgctrl", "start"))
+    generator.start()
+    time.sleep(DURATION)
+    pktgen("pgctrl", "stop")
+    generator.join()
+    # Packets still in flight
+    time.sleep(0.5)
+    returned, cpu = rx_packets(GEN_DEV) - returned, cpu_seconds(pid) - cpu
+
+    with open(os.path.join(PKTGEN, GEN_DEV)) as f:
+        status = f.read()
+    sent = int(re.search(r"pkts-sofar: (\d+)", status).group(1))
+    pps = re.search(r"(\d+)pps", status)
+
+    return {
+        "pps": int(pps.group(1)) if pps else round(sent / DURATION),
+        # Gratuitous ARPs of the load balancer come back too
+        "drop_rate": round(max(1 - returned / sent, 0), 6) if sent else 0.0,
+        "cpu_percent": round(cpu / DURATION * 100, 2),
+        "sent": sent,
+        "returned": returned,
+    }
+
+
+if __name__ == "__main__":
+    results = Results("pktgen_e2e", duration=DURATION, xdp_mode=XDP_MODE)
+    sh("modprobe", "pktgen")
+    setup()
+
+    lb = None
+    try:
+        lb = start_lb()
+        lb_mac = sh("ip", "netns", "exec", NS, "cat", f"/sys/class/net/{LB_DEV}/address").strip()
+
+        # XDP_TX frames of a native XDP veth are only received by a peer with XDP (or NAPI) enabled
+        peer = BPF(text="int xdp_pass(struct xdp_md *ctx) { return XDP_PASS; }")
+        peer.attach_xdp(GEN_DEV, peer.load_func("xdp_pass", BPF.XDP), 0)
+
+        for frame_size in FRAME_SIZES:
+            # ip netns exec execs xdp_lb.py, same PID
+            results.record(run(frame_size, lb_mac, lb.pid), frame_size=frame_size, backends=BACKENDS, flows=FLOWS)
+    finally:
+        if lb:
+            lb.terminate()
+            lb.wait()
+        teardown()
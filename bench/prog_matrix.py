@@ -0,0 +1,81 @@
+"""
+ns/packet of xdp_prog with BPF_PROG_TEST_RUN over a matrix of packet shapes, frame sizes, backend counts and backend
+selection algorithms. No NIC or traffic needed, results are JSON lines (see bench/results.py, OUTPUT=file to keep them).
+
+Shapes: udp (matched service), udp_unmatched_port, icmp_echo (to the VIP), non_ip (ARP).
+
+BPF_PROG_TEST_RUN does not reset the packet between repeated runs, so a packet the program rewrites (forwarded UDP, ICMP echo
+replied) would be measured in its rewritten form from the second run on. Those are timed with RUNS single runs and
+the mean of the kernel durations ("method": "single"), the others with one run of REPEAT ("method": "repeat").
+
+    sudo OUTPUT=results.json python bench/prog_matrix.py
+"""
+import ctypes
+import os
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scapy.layers.inet import ICMP, IP, UDP
+from scapy.layers.l2 import ARP, Ether
+from scapy.packet import Raw
+
+import config
+from results import Results
+from testrun import XDP_ACTIONS, load, prog_test_run, set_maglev_table, set_service
+
+REPEAT = int(os.environ.get("REPEAT", "1000000"))
+RUNS = int(os.environ.get("RUNS", "20000"))
+FRAME_SIZES = [int(x) for x in os.environ.get("FRAME_SIZES", "64,512,1500").split(",")]
+BACKEND_COUNTS = [int(x) for x in os.environ.get("BACKEND_COUNTS", "1,16,256,1000").split(",")]
+ALGORITHMS = os.environ.get("LB_ALGORITHMS", ",".join(config.lb_algorithms)).split(",")
+MAX_BACKENDS = max(BACKEND_COUNTS)
+
+VIP, PORT = "10.0.0.1", 5000
+CLIENT_MAC, LB_MAC = "02:00:00:00:01:00", "02:00:00:00:00:ff"
+
+
+def pad(packet, frame_size):
+    return bytes(packet / Raw(b"\x00" * max(frame_size - len(packet), 0)))
+
+
+SHAPES = {
+    "udp": lambda size: pad(Ether(src=CLIENT_MAC, dst=LB_MAC) / IP(src="192.168.1.10", dst=VIP) / UDP(sport=40000, dport=PORT), size),
+    "udp_unmatched_port": lambda size: pad(Ether(src=CLIENT_MAC, dst=LB_MAC) / IP(src="192.168.1.10", dst=VIP) / UDP(sport=40000, dport=PORT + 1), size),
+    "icmp_echo": lambda size: pad(Ether(src=CLIENT_MAC, dst=LB_MAC) / IP(src="192.168.1.10", dst=VIP) / ICMP(type=8, id=1, seq=1), size),
+    "non_ip": lambda size: pad(Ether(src=CLIENT_MAC, dst="ff:ff:ff:ff:ff:ff") / ARP(psrc="192.168.1.10", pdst=VIP), size),
+}
+
+
+def measure(prog_fd, packet):
+    """
+    (XDP action, method, ns per packet)
+    """
+    action, out, _ = prog_test_run(prog_fd, packet)
+    if out == packet:
+        _, _, ns = prog_test_run(prog_fd, packet, REPEAT)
+        return XDP_ACTIONS[action], "repeat", ns
+
+    durations = [prog_test_run(prog_fd, packet)[2] for _ in range(RUNS)]
+    return XDP_ACTIONS[action], "single", round(statistics.mean(durations), 1)
+
+
+if __name__ == "__main__":
+    results = Results("prog_matrix", repeat=REPEAT, runs=RUNS)
+    b, prog_fd = load(max_backends=MAX_BACKENDS, maglev_table_size=config.maglev_table_size)
+
+    for n in BACKEND_COUNTS:
+        backends = [(f"10.1.{i >> 8}.{i & 0xff}", 6000) for i in range(n)]
+        set_service(b, VIP, PORT, backends)
+
+        for algorithm in ALGORITHMS:
+            b["lb_algorithm"][0] = ctypes.c_uint32(config.lb_algorithms[algorithm])
+            if algorithm == "maglev":
+                set_maglev_table(b, backends, maglev_table_size=config.maglev_table_size)
+
+            for shape, make in SHAPES.items():
+                for frame_size in FRAME_SIZES:
+                    action, method, ns = measure(prog_fd, make(frame_size))
+                    results.record({"ns_per_packet": ns}, shape=shape, frame_size=frame_size, backends=n,
+                                   lb_algorithm=algorithm, action=action, method=method)
@@ -0,0 +1,136 @@
+"""
+ns/packet of xdp_prog with BPF_PROG_TEST_RUN with the rate limiter of the service off and on, over frame sizes.
+No NIC or traffic needed, results are JSON lines (see bench/results.py, OUTPUT=file to keep them).
+
+Cases:
+- off: no rate limit, the reference
+- under_limit: forwarded, the token bucket of the source has credit
+- new_source: forwarded, every packet comes from another source (LRU insert of a new bucket), SOURCES addresses
+- over_limit: dropped, the token bucket of the source is empty
+- allowed, denied: the source is in the allow or deny list among PREFIXES other prefixes
+- spread: one source sends 2 * BURST packets from each of the CPUS CPUs in turn (the RX CPUs of a source spread by
+  RSS), with its burst split over them like xdp_lb.py does. forwarded must be BURST, not BURST per CPU
+overhead_ns is the difference with off for the forwarded cases, timed the same way (see bench/prog_matrix.py).
+
+    sudo OUTPUT=results.json python bench/rate_limit.py
+"""
+import os
+import random
+import socket
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scapy.layers.inet import IP, UDP
+from scapy.layers.l2 import Ether
+
+import config
+from object import RateLimit
+from prog_matrix import CLIENT_MAC, FRAME_SIZES, LB_MAC, PORT, RUNS, VIP, measure, pad
+from results import Results
+from testrun import XDP_ACTIONS, ip_to_int, load, prog_test_run, set_service
+from utils import token_bucket
+
+SOURCES = int(os.environ.get("SOURCES", "10000"))
+PREFIXES = int(os.environ.get("PREFIXES", "1000"))
+BACKENDS = int(os.environ.get("BACKENDS", "16"))
+BURST = int(os.environ.get("BURST", "1000"))
+CPUS = [int(x) for x in os.environ.get("CPUS", ",".join(str(cpu) for cpu in sorted(os.sched_getaffinity(0))[:4])).split(",")]
+
+SOURCE = "192.168.1.10"
+
+
+def udp(source, frame_size):
+    return pad(Ether(src=CLIENT_MAC, dst=LB_MAC) / IP(src=source, dst=VIP) / UDP(sport=40000, dport=PORT), frame_size)
+
+
+def set_rate_limit(b, rate=0, burst=0, prefixes=(), cpus=1):
+    """
+    Rate limit of service 0 per source address split over cpus RX CPUs, prefixes are (a.b.c.d, length, action) of its
+    allow and deny lists
+    """
+    table = b["source_prefixes"]
+    for key in list(table.keys()):
+        del table[key]
+    for address, length, action in prefixes:
+        table[table.Key(prefixlen=32 + length, service_id=socket.htonl(0), saddr=ip_to_int(address))] = table.Leaf(config.source_actions[action])
+
+    cost, bucket_size = token_bucket(rate, burst, cpus)
+    b["rate_limits"][0] = RateLimit(cost=cost, burst=bucket_size, mask=0xffffffff, lists=1 if prefixes else 0)
+    b["rate_limit_buckets"].clear()
+
+
+def other_prefixes(n, seed=1):
+    rng = random.Random(seed)
+    return [(f"10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.0", 24, rng.choice(list(config.source_actions))) for _ in range(n)]
+
+
+def measure_sources(prog_fd, frame_size):
+    """
+    (XDP action, method, ns per packet) of forwarded packets from SOURCES sources in turn
+    """
+    packets = [udp(f"172.16.{i >> 8 & 0xff}.{i & 0xff}", frame_size) for i in range(SOURCES)]
+    runs = [prog_test_run(prog_fd, packets[i % SOURCES]) for i in range(RUNS)]
+    return XDP_ACTIONS[runs[-1][0]], "single", round(statistics.mean(ns for _, _, ns in runs), 1)
+
+
+def measure_spread(b, prog_fd, frame_size):
+    """
+    Forwarded packets of one source sending from every CPU of CPUS, at 1 packet per second so that no credit is earned
+    during the run
+    """
+    set_rate_limit(b, rate=1, burst=BURST, cpus=len(CPUS))
+    packet = udp(SOURCE, frame_size)
+    affinity = os.sched_getaffinity(0)
+    forwarded = 0
+    try:
+        for cpu in CPUS:
+            # BPF_PROG_TEST_RUN runs the program on the calling CPU
+            os.sched_setaffinity(0, {cpu})
+            for _ in range(2 * BURST):
+                action, _, _ = prog_test_run(prog_fd, packet)
+                forwarded += XDP_ACTIONS[action] != "XDP_DROP"
+    finally:
+        os.sched_setaffinity(0, affinity)
+    return forwarded
+
+
+if __name__ == "__main__":
+    results = Results("rate_limit", runs=RUNS, sources=SOURCES, prefixes=PREFIXES, backends=BACKENDS, burst=BURST, cpus=CPUS)
+    b, prog_fd = load(extra_cflags=["-D__MAX_RATE_LIMITED__=%u" % max(SOURCES, 1024)])
+    set_service(b, VIP, PORT, [(f"10.1.0.{i}", 6000) for i in range(1, BACKENDS + 1)])
+
+    cases = {
+        "off": dict(),
+        # 1 ns per packet, never out of credit
+        "under_limit": dict(rate=10**9),
+        "new_source": dict(rate=10**9),
+        # The first packet empties the bucket
+        "over_limit": dict(rate=1, burst=1),
+        "allowed": dict(rate=1, burst=1, prefixes=other_prefixes(PREFIXES) + [(SOURCE, 32, "allow")]),
+        "denied": dict(prefixes=other_prefixes(PREFIXES) + [("192.168.1.0", 24, "deny")]),
+    }
+
+    for frame_size in FRAME_SIZES:
+        reference = {}
+        for case, limit in cases.items():
+            set_rate_limit(b, **limit)
+            if case == "new_source":
+                action, method, ns = measure_sources(prog_fd, frame_size)
+            else:
+                packet = udp(SOURCE, frame_size)
+                # Creates the bucket of the source, measure() tells rewritten packets from the first run
+                prog_test_run(prog_fd, packet)
+                action, method, ns = measure(prog_fd, packet)
+
+            metrics = {"ns_per_packet": ns}
+            if case == "off":
+                reference[method] = ns
+            elif action != "XDP_DROP" and method in reference:
+                metrics["overhead_ns"] = round(ns - reference[method], 1)
+            results.record(metrics, case=case, frame_size=frame_size, action=action, method=method)
+
+        forwarded = measure_spread(b, prog_fd, frame_size)
+        # Up to one packet per CPU more, from rounding the burst share up
+        results.record({"forwarded": forwarded, "ok": BURST <= forwarded <= BURST + len(CPUS)}, case="spread", frame_size=frame_size)
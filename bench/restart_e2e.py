@@ -0,0 +1,131 @@
+"""
+Hitless restart on one box: pktgen sends UDP packets at RATE pps to the VIP through the veth pair of pktgen_e2e.py,
+xdp_lb.py runs in the bench-lb namespace with BPF_PIN_DIR and is restarted RESTARTS times while traffic flows.
+Reports:
+- drop_rate, lost: packets sent by pktgen that did not come back from the load balancer
+- counters_continuous: xdp_packet_processed of /metrics never went down across a restart
+- restart_ms: mean time from stopping xdp_lb.py to its API answering again
+
+Results are JSON lines (see bench/results.py, OUTPUT=file to keep them), exits 1 when a packet was lost or a counter
+reset. Needs root, bcc and the pktgen module. Runs from the repository root:
+    sudo OUTPUT=results.json python bench/restart_e2e.py
+"""
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bcc import BPF
+
+from pktgen_e2e import API_PORT, GEN_DEV, GEN_IP, LB_DEV, NS, PKTGEN, PORT, VIP, XDP_MODE, pktgen, rx_packets, setup, sh, start_lb, teardown
+from results import Results
+
+RATE = int(os.environ.get("RATE", "100000"))
+DURATION = float(os.environ.get("DURATION", "20"))
+RESTARTS = int(os.environ.get("RESTARTS", "3"))
+FRAME_SIZE = int(os.environ.get("FRAME_SIZE", "64"))
+FLOWS = int(os.environ.get("FLOWS", "1024"))
+
+# bpffs outside /sys, ip netns exec mounts its own sysfs
+BPFFS = "/tmp/bench-bpffs"
+
+
+def packets_processed() -> int:
+    probe = f"import urllib.request; print(urllib.request.urlopen('http://127.0.0.1:{API_PORT}/metrics').read().decode())"
+    body = sh("ip", "netns", "exec", NS, sys.executable, "-c", probe)
+    match = re.search(r'^xdp_packet_processed\{cpu="total",[^}]*\} (\S+)$', body, re.MULTILINE)
+    return int(float(match.group(1))) if match else 0
+
+
+def restart(lb):
+    """
+    Stop xdp_lb.py and start it again, returns the new process and the restart time in ms
+    """
+    time_start = time.time()
+    lb.terminate()
+    lb.wait()
+    lb = start_lb()
+    return lb, (time.time() - time_start) * 1000
+
+
+if __name__ == "__main__":
+    results = Results("restart_e2e", rate=RATE, duration=DURATION, restarts=RESTARTS, xdp_mode=XDP_MODE)
+    sh("modprobe", "pktgen")
+    setup()
+    os.makedirs(BPFFS, exist_ok=True)
+    sh("mount", "-t", "bpf", "bpf", BPFFS)
+    os.environ["BPF_PIN_DIR"] = os.path.join(BPFFS, "xdp-lb")
+
+    lb = None
+    try:
+        lb = start_lb()
+        lb_mac = sh("ip", "netns", "exec", NS, "cat", f"/sys/class/net/{LB_DEV}/address").strip()
+
+        # XDP_TX frames of a native XDP veth are only received by a peer with XDP (or NAPI) enabled
+        peer = BPF(text="int xdp_pass(struct xdp_md *ctx) { return XDP_PASS; }")
+        peer.attach_xdp(GEN_DEV, peer.load_func("xdp_pass", BPF.XDP), 0)
+
+        pktgen("kpktgend_0", "rem_device_all")
+        pktgen("kpktgend_0", f"add_device {GEN_DEV}")
+        for command in [
+            f"count {int(RATE * DURATION)}",
+            "clone_skb 0",
+            f"pkt_size {FRAME_SIZE - 4}",
+            f"delay {10**9 // RATE}",
+            f"dst {VIP}",
+            f"dst_mac {lb_mac}",
+            f"src_min {GEN_IP}",
+            f"src_max {GEN_IP}",
+            f"udp_dst_min {PORT}",
+            f"udp_dst_max {PORT}",
+            "udp_src_min 1024",
+            f"udp_src_max {1024 + FLOWS - 1}",
+        ]:
+            pktgen(GEN_DEV, command)
+
+        returned = rx_packets(GEN_DEV)
+        # start blocks until count packets are sent
+        generator = threading.Thread(target=pktgen, args=("pgctrl", "start"))
+        generator.start()
+
+        continuous = True
+        restart_ms = []
+        for _ in range(RESTARTS):
+            time.sleep(DURATION / (RESTARTS + 1))
+            before = packets_processed()
+            lb, elapsed = restart(lb)
+            restart_ms.append(elapsed)
+            after = packets_processed()
+            continuous &= after >= before
+            print(f"restarted in {elapsed:.0f} ms, packets processed {before} -> {after}", file=sys.stderr)
+
+        generator.join()
+        # Packets still in flight
+        time.sleep(0.5)
+        returned = rx_packets(GEN_DEV) - returned
+
+        with open(os.path.join(PKTGEN, GEN_DEV)) as f:
+            sent = int(re.search(r"pkts-sofar: (\d+)", f.read()).group(1))
+        # Gratuitous ARPs of the load balancer come back too
+        lost = max(sent - returned, 0)
+
+        results.record({
+            "drop_rate": round(lost / sent, 6) if sent else 0.0,
+            "lost": lost,
+            "sent": sent,
+            "returned": returned,
+            "counters_continuous": continuous,
+            "restart_ms": round(sum(restart_ms) / len(restart_ms), 1) if restart_ms else 0.0,
+        }, frame_size=FRAME_SIZE, flows=FLOWS)
+    finally:
+        if lb:
+            lb.terminate()
+            lb.wait()
+        teardown()
+        subprocess.run(["umount", BPFFS], capture_output=True)
+
+    sys.exit(0 if lost == 0 and continuous else 1)
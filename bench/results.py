@@ -0,0 +1,47 @@
+"""
+JSON lines results of the benchmarks. A run starts with a "run" record (commit, kernel, CPU) followed by one record per
+measurement: its parameters, and its measures under "metrics". Records are printed and appended to OUTPUT when set,
+so that the runs of two commits can be compared with bench/compare.py
+"""
+import json
+import os
+import platform
+import subprocess
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+class Results:
+    def __init__(self, bench: str, **params):
+        self.bench = bench
+        self.path = os.environ.get("OUTPUT", "")
+        self.write({"kind": "run", "commit": git_commit(), "kernel": platform.release(), "cpu": cpu_model(), "cpus": os.cpu_count(), "time": int(time.time()), **params})
+
+    def record(self, metrics: dict, **params):
+        self.write({"kind": "result", **params, "metrics": metrics})
+
+    def write(self, record: dict):
+        line = json.dumps({"bench": self.bench, **record})
+        print(line, flush=True)
+        if self.path:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
@@ -0,0 +1,83 @@
+"""
+Ring buffer consumer throughput: events per second decoded on one core.
+
+Fills an in-memory copy of a BPF ring buffer (same record layout as the kernel: 8 bytes header + struct event)
+and compares:
+- batch: RingBufferConsumer, one NumPy view and copy per batch
+- callback: one ctypes decode and deque append per record, what the bcc ring_buffer_consume() callback did
+
+Does not need root or bcc:
+    python bench/ringbuf_consumer.py
+"""
+import collections
+import ctypes
+import json
+import mmap
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from object import EVENT_DTYPE
+from ringbuf import RingBufferConsumer
+
+SIZE = 4096 * mmap.PAGESIZE
+ROUNDS = int(os.environ.get("ROUNDS", "20"))
+
+
+class Event(ctypes.Structure):
+    _fields_ = [("pkt_size", ctypes.c_int), ("time_delta", ctypes.c_int)]
+
+
+def make_buffer():
+    consumer_page = mmap.mmap(-1, mmap.PAGESIZE)
+    producer_pages = mmap.mmap(-1, mmap.PAGESIZE + 2 * SIZE)
+    consumer = RingBufferConsumer(consumer_page, producer_pages, SIZE, EVENT_DTYPE, 256 * 1024)
+
+    n = SIZE // consumer.record_size
+    records = consumer.data[:n * consumer.record_size].view(consumer.record_dtype)
+    records["len"] = EVENT_DTYPE.itemsize
+    records["event"]["pkt_size"] = 170
+    records["event"]["time_delta"] = np.random.randint(100, 1000, n)
+
+    return consumer, producer_pages, n
+
+
+def produce(consumer, producer_pages, n):
+    # Rewind, the buffer holds n committed records
+    consumer.consumer_pos[0] = 0
+    np.frombuffer(producer_pages, dtype=np.uint64, count=1)[0] = n * consumer.record_size
+
+
+def bench_batch(consumer, producer_pages, n):
+    elapsed = 0
+    for _ in range(ROUNDS):
+        produce(consumer, producer_pages, n)
+        time_start = time.perf_counter()
+        consumer.consume()
+        elapsed += time.perf_counter() - time_start
+    return n * ROUNDS / elapsed
+
+
+def bench_callback(consumer, n):
+    bucket = collections.deque(maxlen=256 * 1024)
+    data = bytes(consumer.data[:n * consumer.record_size])
+    record_size = consumer.record_size
+
+    time_start = time.perf_counter()
+    for offset in range(0, len(data), record_size):
+        event = Event.from_buffer_copy(data, offset + 8)
+        bucket.append(event.time_delta)
+    return n / (time.perf_counter() - time_start)
+
+
+if __name__ == "__main__":
+    consumer, producer_pages, n = make_buffer()
+    print(json.dumps({
+        "records_per_batch": n,
+        "batch_events_per_s": round(bench_batch(consumer, producer_pages, n)),
+        "callback_events_per_s": round(bench_callback(consumer, n)),
+    }))
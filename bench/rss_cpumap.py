@@ -0,0 +1,80 @@
+"""
+Software RSS path end to end with BPF_PROG_TEST_RUN: xdp_cpu_prog loaded and written to cpu_map as set_rss does, then
+UDP packets of FLOWS flows run through xdp_prog in live frames mode, so that the redirects really go through the
+cpumap and the second stage runs on the worker CPUs.
+
+Checks that the cpumap accepts the second stage program (the kernel refuses one loaded with another attach type),
+that the first stage hands every packet to a worker (cpu_redirect) and that the second stage picks a backend for them
+(forward verdicts, aborted since the test has no tx_port). ns_per_packet is the first stage cost, delivered the share
+of packets the second stage processed (the rest overflowed the QUEUE_SIZE queues). Exits 1 on failure.
+
+Needs root and kernel >= 5.18:
+    sudo python bench/rss_cpumap.py
+    sudo WORKERS=0,1,2,3 PACKETS=1000000 python bench/rss_cpumap.py
+"""
+import ctypes
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bcc import BPF
+from scapy.layers.inet import IP, UDP
+from scapy.layers.l2 import Ether
+
+import config
+from object import CpumapVal
+from results import Results
+from testrun import XDP_ACTIONS, load, prog_test_run, prog_test_run_live, set_service
+
+WORKERS = [int(x) for x in os.environ.get("WORKERS", "0,1").split(",")]
+PACKETS = int(os.environ.get("PACKETS", "100000"))
+FLOWS = int(os.environ.get("FLOWS", "16"))
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE", str(config.rss_queue_size)))
+
+VIP, PORT = "10.0.0.1", 5000
+
+
+def verdict_count(b, reason, action=None) -> int:
+    """
+    Packets of slot 0 with a verdict reason (and action), summed over CPUs
+    """
+    actions = range(len(config.xdp_actions)) if action is None else [config.xdp_actions.index(action)]
+    reason = config.verdict_reasons.index(reason)
+    return sum(sum(b["verdicts"][reason * len(config.xdp_actions) + a]) for a in actions)
+
+
+if __name__ == "__main__":
+    results = Results("rss_cpumap", workers=WORKERS, packets=PACKETS, flows=FLOWS, queue_size=QUEUE_SIZE)
+    b, prog_fd = load()
+    set_service(b, VIP, PORT, [(f"10.0.1.{i}", 6000) for i in range(1, 5)])
+
+    cpu_prog = b.load_func("xdp_cpu_prog", BPF.XDP, attach_type=config.BPF_XDP_CPUMAP)
+    for cpu in WORKERS:
+        b["cpu_map"][cpu] = CpumapVal(qsize=QUEUE_SIZE, prog_fd=cpu_prog.fd)
+    for i, cpu in enumerate(WORKERS):
+        b["rss_cpus"][i] = ctypes.c_uint32(cpu)
+    b["rss_cpu_count"][0] = ctypes.c_uint32(len(WORKERS))
+
+    packets = [bytes(Ether(src="02:00:00:00:01:00", dst="02:00:00:00:00:ff") / IP(src="192.168.1.10", dst=VIP) / UDP(sport=40000 + i, dport=PORT)) for i in range(FLOWS)]
+    action, _, _ = prog_test_run(prog_fd, packets[0])
+    if XDP_ACTIONS[action] != "XDP_REDIRECT":
+        raise RuntimeError(f"Packet not handed to a worker: {XDP_ACTIONS[action]}")
+
+    redirected = verdict_count(b, "cpu_redirect", "redirect")
+    durations = [prog_test_run_live(prog_fd, packet, PACKETS // FLOWS) for packet in packets]
+    # The worker queues drain asynchronously
+    time.sleep(0.5)
+
+    redirected = verdict_count(b, "cpu_redirect", "redirect") - redirected
+    processed = verdict_count(b, "forward")
+    ok = redirected == PACKETS // FLOWS * FLOWS and processed > 0
+    results.record({
+        "ns_per_packet": round(sum(durations) / len(durations), 1),
+        "redirected": redirected,
+        "processed": processed,
+        "delivered": round(processed / max(redirected, 1), 3),
+        "ok": ok,
+    })
+    sys.exit(0 if ok else 1)
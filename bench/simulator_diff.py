@@ -0,0 +1,151 @@
+"""
+Differential check of simulator.py against xdp_prog: the same packets go through BPF_PROG_TEST_RUN and through the
+simulator, for each backend selection algorithm, with and without conntrack. Compares per packet the XDP action and
+the backend the packet was sent to, and the verdict counters. Prints one JSON line per case, exits 1 on a mismatch.
+
+Packets come from PCAP (a capture) or are generated: UDP to service and other ports, ICMP echo and echo reply to the
+VIP and another address, TCP, ARP, truncated headers. The process is pinned to CPU 0 so that the per CPU counter of
+round robin is the one the simulator models (rss none).
+
+    sudo python bench/simulator_diff.py
+    sudo PCAP=capture.pcap VIP=172.31.200.200 PORTS=5000 BACKENDS=16 python bench/simulator_diff.py
+"""
+import ctypes
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from object import ConntrackConfig
+from pcap import HEADER_SIZE, read_chunks, write_pcap
+from simulator import VERDICT_REASONS, VERDICT_TRUNCATED, Simulator, ip_to_int
+from testrun import XDP_ACTIONS, load, prog_test_run, set_maglev_table, set_service
+
+PCAP = os.environ.get("PCAP", "")
+PACKETS = int(os.environ.get("PACKETS", "20000"))
+VIP = os.environ.get("VIP", "10.0.0.1")
+PORTS = [int(p) for p in os.environ.get("PORTS", "5000,5001").split(",")]
+BACKENDS = int(os.environ.get("BACKENDS", "7"))
+MAGLEV_TABLE_SIZE = 4099
+CONNTRACK_TIMEOUT_NS = 3600 * 10**9
+
+CLIENT_MAC, LB_MAC = bytes.fromhex("020000000100"), bytes.fromhex("0200000000ff")
+
+
+def frame(src, dst, protocol, l4, ethertype=0x0800):
+    eth = LB_MAC + CLIENT_MAC + struct.pack("!H", ethertype)
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(l4), 0, 0, 64, protocol, 0, socket.inet_aton(src), socket.inet_aton(dst))
+    return eth + ip + l4
+
+
+def synthetic_frames(n, seed=1):
+    rng = random.Random(seed)
+    frames = []
+    for _ in range(n):
+        src = f"192.168.{rng.randint(0, 3)}.{rng.randint(1, 60)}"
+        r = rng.random()
+        if r < 0.75:
+            payload = bytes(rng.randint(0, 300))
+            dport = rng.choice(PORTS + [PORTS[0] + 100])
+            frames.append(frame(src, VIP, socket.IPPROTO_UDP, struct.pack("!HHHH", rng.randint(1024, 1100), dport, 8 + len(payload), 0) + payload))
+        elif r < 0.85:
+            icmp = struct.pack("!BBHHH", rng.choice([8, 0]), 0, 0, 1, 1) + bytes(32)
+            frames.append(frame(src, rng.choice([VIP, "10.9.9.9"]), socket.IPPROTO_ICMP, icmp))
+        elif r < 0.9:
+            frames.append(frame(src, VIP, socket.IPPROTO_TCP, bytes(20)))
+        elif r < 0.95:
+            frames.append(LB_MAC + CLIENT_MAC + struct.pack("!H", 0x0806) + bytes(46))
+        else:
+            # Cut in the IP or UDP header
+            frames.append(frame(src, VIP, socket.IPPROTO_UDP, struct.pack("!HHHH", 1024, PORTS[0], 8, 0))[:rng.choice([20, 38])])
+    return frames
+
+
+def read_frames(path):
+    """
+    Frames of a capture, as the simulator sees them (ethernet headers synthesized for other link types). Frames cut
+    by the capture before the end of their headers are skipped
+    """
+    frames = []
+    for chunk in read_chunks(path):
+        for i in range(len(chunk)):
+            if chunk.caplen[i] < min(chunk.length[i], HEADER_SIZE):
+                continue
+            # Headers of the simulator, padded to the frame length (the program reads nothing further)
+            frames.append(chunk.headers[i].tobytes()[:chunk.caplen[i]] + bytes(max(int(chunk.length[i]) - int(chunk.caplen[i]), 0)))
+    return frames
+
+
+def run_case(frames, path, services, backends, lb_algorithm, conntrack):
+    b, prog_fd = load(max_backends=max(BACKENDS, 1), maglev_table_size=MAGLEV_TABLE_SIZE)
+    for port in PORTS:
+        set_service(b, VIP, port, backends)
+    b["lb_algorithm"][0] = ctypes.c_uint32(["round_robin", "maglev"].index(lb_algorithm))
+    if lb_algorithm == "maglev":
+        set_maglev_table(b, backends, maglev_table_size=MAGLEV_TABLE_SIZE)
+    if conntrack:
+        b["conntrack_config"][0] = ConntrackConfig(timeout_ns=CONNTRACK_TIMEOUT_NS, port_min=10000, port_count=50000)
+
+    actions, backend_keys = [], []
+    for packet in frames:
+        action, out, _ = prog_test_run(prog_fd, packet)
+        actions.append(action)
+        backend_keys.append((ip_to_int(socket.inet_ntoa(out[30:34])) << 16) | struct.unpack("H", out[36:38])[0] if len(out) >= 38 else 0)
+
+    sim = Simulator(services, lb_algorithm=lb_algorithm, maglev_table_size=MAGLEV_TABLE_SIZE,
+                    conntrack_timeout_ns=CONNTRACK_TIMEOUT_NS if conntrack else 0)
+    results = [sim.process(chunk) for chunk in read_chunks(path, 5000)]
+    sim_action = np.concatenate([r["action"] for r in results])
+    sim_backend = np.concatenate([r["backend"] for r in results])
+    sim_key = np.concatenate([r["backend_key"] for r in results])
+
+    actions = np.array(actions)
+    forwarded = sim_backend >= 0
+    mismatch = (actions != sim_action) | (forwarded & (np.array(backend_keys, dtype=np.uint64) != sim_key))
+
+    # Verdict counters of the interface slot 0, summed over CPUs
+    table = b["verdicts"]
+    prog_verdicts = np.zeros((len(VERDICT_REASONS), len(XDP_ACTIONS)), dtype=np.int64)
+    for r in range(len(VERDICT_REASONS)):
+        for a in range(len(XDP_ACTIONS)):
+            prog_verdicts[r, a] = sum(table[r * len(XDP_ACTIONS) + a])
+
+    print(json.dumps({
+        "lb_algorithm": lb_algorithm,
+        "conntrack": conntrack,
+        "packets": len(frames),
+        "forwarded": int(forwarded.sum()),
+        "mismatches": int(mismatch.sum()),
+        "first_mismatches": [{"packet": int(i), "prog": XDP_ACTIONS[actions[i]], "sim": XDP_ACTIONS[sim_action[i]]} for i in np.flatnonzero(mismatch)[:5]],
+        "verdicts_match": bool(np.array_equal(prog_verdicts, sim.verdicts[:VERDICT_TRUNCATED])),
+    }), flush=True)
+    return not mismatch.any() and np.array_equal(prog_verdicts, sim.verdicts[:VERDICT_TRUNCATED])
+
+
+if __name__ == "__main__":
+    os.sched_setaffinity(0, {0})
+
+    backends = [(f"10.1.{i >> 8}.{i & 0xff}", 6000 + i % 3) for i in range(1, BACKENDS + 1)]
+    services = [{"id": 0, "name": "default", "vip": VIP, "ports": PORTS, "backends": backends, "forwarding": ""}]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "packets.pcap")
+        if PCAP:
+            frames = read_frames(PCAP)
+        else:
+            frames = synthetic_frames(PACKETS)
+        write_pcap(path, frames)
+
+        ok = True
+        for lb_algorithm in ["round_robin", "maglev"]:
+            for conntrack in [False, True]:
+                ok &= run_case(frames, path, services, backends, lb_algorithm, conntrack)
+
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,52 @@
+"""
+Cost of one interface stats collection (NIC stats + link info), what packet_rate_counter() does every second.
+
+Compares:
+- old: `ethtool -S` subprocess parsed as text + a new IPRoute socket and dump per call (utils)
+- new: one SIOCETHTOOL ioctl (EthtoolStats) + a persistent rtnetlink socket (LinkMonitor)
+
+    INTERFACE=eth0 python bench/stats_collection.py
+
+The old path is skipped when the ethtool binary is not installed.
+"""
+import json
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+from stats import EthtoolStats, LinkMonitor
+
+INTERFACE = os.environ.get("INTERFACE", "eth0")
+ROUNDS = int(os.environ.get("ROUNDS", "200"))
+
+
+def run(name, collect):
+    collect()
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        collect()
+    elapsed = time.perf_counter() - start
+    print(json.dumps({"collector": name, "interface": INTERFACE, "rounds": ROUNDS, "us_per_collection": round(elapsed / ROUNDS * 1e6, 1)}))
+
+
+def old():
+    utils.get_ethtool_stats(INTERFACE)
+    utils.get_link_info_by_interface(INTERFACE)
+
+
+ethtool_stats = EthtoolStats(INTERFACE)
+link_monitor = LinkMonitor([INTERFACE])
+
+
+def new():
+    ethtool_stats.read()
+    link_monitor.refresh(INTERFACE)
+
+
+if shutil.which("ethtool"):
+    run("old", old)
+run("new", new)
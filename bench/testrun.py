@@ -0,0 +1,139 @@
+"""
+Run xdp_prog on synthetic packets with BPF_PROG_TEST_RUN, no NIC or traffic needed (root, kernel >= 4.12)
+"""
+import ctypes
+import os
+import platform
+import socket
+import struct
+
+import numpy as np
+from bcc import BPF
+
+import maglev
+from object import Backend, MacAddr
+from utils import update_table_batch
+from weights import weighted_round_robin
+
+SRC_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "xdp_prog.c")
+
+# include/uapi/linux/bpf.h
+BPF_PROG_TEST_RUN = 10
+BPF_F_TEST_XDP_LIVE_FRAMES = 1 << 1
+NR_BPF = {"x86_64": 321, "aarch64": 280}[platform.machine()]
+
+XDP_ACTIONS = ["XDP_ABORTED", "XDP_DROP", "XDP_PASS", "XDP_TX", "XDP_REDIRECT"]
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+
+class TestRunAttr(ctypes.Structure):
+    # union bpf_attr, test member
+    _fields_ = [
+        ("prog_fd", ctypes.c_uint32),
+        ("retval", ctypes.c_uint32),
+        ("data_size_in", ctypes.c_uint32),
+        ("data_size_out", ctypes.c_uint32),
+        ("data_in", ctypes.c_uint64),
+        ("data_out", ctypes.c_uint64),
+        ("repeat", ctypes.c_uint32),
+        ("duration", ctypes.c_uint32),
+        ("ctx_size_in", ctypes.c_uint32),
+        ("ctx_size_out", ctypes.c_uint32),
+        ("ctx_in", ctypes.c_uint64),
+        ("ctx_out", ctypes.c_uint64),
+        ("flags", ctypes.c_uint32),
+        ("cpu", ctypes.c_uint32),
+        ("batch_size", ctypes.c_uint32),
+        ("pad", ctypes.c_uint32),
+    ]
+
+
+def prog_test_run(prog_fd: int, packet: bytes, repeat: int = 1) -> tuple[int, bytes, int]:
+    """
+    Run the program repeat times on packet, returns (XDP action, packet after the last run, average ns per run)
+    """
+    data_in = ctypes.create_string_buffer(packet, len(packet))
+    data_out = ctypes.create_string_buffer(len(packet) + 256)
+
+    attr = TestRunAttr(
+        prog_fd=prog_fd,
+        data_size_in=len(packet),
+        data_size_out=len(data_out),
+        data_in=ctypes.addressof(data_in),
+        data_out=ctypes.addressof(data_out),
+        repeat=repeat,
+    )
+    if libc.syscall(NR_BPF, BPF_PROG_TEST_RUN, ctypes.byref(attr), ctypes.sizeof(attr)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"BPF_PROG_TEST_RUN: {os.strerror(errno)}")
+
+    return attr.retval, data_out.raw[:attr.data_size_out], attr.duration
+
+
+def prog_test_run_live(prog_fd: int, packet: bytes, repeat: int) -> int:
+    """
+    Run the program repeat times on packet in live frames mode (kernel >= 5.18): redirected packets are really sent,
+    through a devmap or a cpumap. Returns the average ns per run
+    """
+    data_in = ctypes.create_string_buffer(packet, len(packet))
+
+    attr = TestRunAttr(
+        prog_fd=prog_fd,
+        data_size_in=len(packet),
+        data_in=ctypes.addressof(data_in),
+        repeat=repeat,
+        flags=BPF_F_TEST_XDP_LIVE_FRAMES,
+    )
+    if libc.syscall(NR_BPF, BPF_PROG_TEST_RUN, ctypes.byref(attr), ctypes.sizeof(attr)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"BPF_PROG_TEST_RUN: {os.strerror(errno)}")
+
+    return attr.duration
+
+
+def load(max_services=16, max_backends=1024, maglev_table_size=4099, extra_cflags=()) -> tuple[BPF, int]:
+    """
+    Compile xdp_prog.c like xdp_lb.py does, returns the BPF object and the program fd
+    """
+    b = BPF(src_file=SRC_FILE, cflags=["-w", "-D__MAX_CPU__=%u" % os.cpu_count(), "-D__MAX_SERVICES__=%u" % max_services, "-D__MAX_BACKENDS__=%u" % max_backends, "-D__MAGLEV_TABLE_SIZE__=%u" % maglev_table_size, *extra_cflags], debug=0)
+    return b, b.load_func("xdp_prog", BPF.XDP).fd
+
+
+def ip_to_int(ip: str) -> int:
+    return struct.unpack("I", socket.inet_aton(ip))[0]
+
+
+def set_service(b: BPF, vip: str, port: int, backends: list[tuple[str, int]], service_id=0):
+    """
+    One UDP service with its backends in generation 0, forwarded with XDP_TX
+    """
+    services_table = b["services"]
+    services_table[services_table.Key(vip=ip_to_int(vip), port=socket.htons(port), proto=socket.IPPROTO_UDP, pad=0)] = services_table.Leaf(id=service_id)
+    b["vips"][b["vips"].Key(ip_to_int(vip))] = b["vips"].Leaf(1)
+
+    max_backends = b["backends"].max_entries // (2 * b["backend_generation"].max_entries)
+    for i, (ip, backend_port) in enumerate(backends):
+        b["backends"][service_id * 2 * max_backends + i] = Backend(ip=ip_to_int(ip), port=socket.htons(backend_port), tunnel_port=0, mac=(ctypes.c_ubyte * 6)(2, 0, 0, 0, 0, i + 1))
+    b["backend_counter"][service_id * 2] = ctypes.c_uint32(len(backends))
+
+    b["lb_mac"][0] = MacAddr((ctypes.c_ubyte * 6)(2, 0, 0, 0, 0, 0xff))
+
+
+def set_maglev_table(b: BPF, backends: list[tuple[str, int]], service_id=0, maglev_table_size=4099, weights=None):
+    """
+    Maglev table of the backends of set_service, in generation 0
+    """
+    keys = maglev.backend_keys([ip_to_int(ip) for ip, _ in backends], [socket.htons(port) for _, port in backends])
+    lookup = np.maximum(maglev.build_maglev_table(keys, maglev_table_size, weights), 0)
+    update_table_batch(b["maglev_table"], service_id * 2 * maglev_table_size + np.arange(maglev_table_size), lookup)
+
+
+def set_weighted_rr(b: BPF, weights: list[int], service_id=0):
+    """
+    Weighted round robin sequence of the backends of set_service, in generation 0
+    """
+    size = b["weighted_rr"].max_entries // b["weighted_rr_counter"].max_entries
+    sequence = weighted_round_robin(weights, size)
+    update_table_batch(b["weighted_rr"], service_id * 2 * size + np.arange(len(sequence)), sequence)
+    b["weighted_rr_counter"][service_id * 2] = ctypes.c_uint32(len(sequence))
@@ -0,0 +1,87 @@
+"""
+Check of weighted backends: PACKETS UDP packets of random flows go through xdp_prog with BPF_PROG_TEST_RUN, for each
+backend selection algorithm, with the backends weighted by WEIGHTS. The share of packets of each backend must match
+its share of the weights within TOLERANCE (relative), and drained backends (weight 0) must get none. Prints one JSON
+line per algorithm, exits 1 on a mismatch.
+
+The process is pinned to CPU 0 so that round robin goes over the weighted sequence with a single per CPU counter.
+
+    sudo python bench/weights_check.py
+    sudo WEIGHTS=1,1,4,0,16 PACKETS=200000 TOLERANCE=0.02 python bench/weights_check.py
+"""
+import ctypes
+import json
+import os
+import random
+import socket
+import struct
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from testrun import load, prog_test_run, set_maglev_table, set_service, set_weighted_rr
+
+WEIGHTS = [int(w) for w in os.environ.get("WEIGHTS", "1,2,3,4,0,10").split(",")]
+PACKETS = int(os.environ.get("PACKETS", "100000"))
+TOLERANCE = float(os.environ.get("TOLERANCE", "0.05"))
+VIP, PORT = "10.0.0.1", 5000
+MAGLEV_TABLE_SIZE = 4099
+
+CLIENT_MAC, LB_MAC = bytes.fromhex("020000000100"), bytes.fromhex("0200000000ff")
+
+
+def udp_frame(src, sport):
+    l4 = struct.pack("!HHHH", sport, PORT, 8 + 18, 0) + bytes(18)
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(l4), 0, 0, 64, socket.IPPROTO_UDP, 0, socket.inet_aton(src), socket.inet_aton(VIP))
+    return LB_MAC + CLIENT_MAC + struct.pack("!H", 0x0800) + ip + l4
+
+
+def run_case(lb_algorithm, frames, backends):
+    b, prog_fd = load(maglev_table_size=MAGLEV_TABLE_SIZE)
+    set_service(b, VIP, PORT, backends)
+    b["lb_algorithm"][0] = ctypes.c_uint32(["round_robin", "maglev"].index(lb_algorithm))
+    if lb_algorithm == "maglev":
+        set_maglev_table(b, backends, maglev_table_size=MAGLEV_TABLE_SIZE, weights=WEIGHTS)
+    else:
+        set_weighted_rr(b, WEIGHTS)
+
+    index = {socket.inet_aton(ip): i for i, (ip, _) in enumerate(backends)}
+    packets = np.zeros(len(backends), dtype=np.int64)
+    for packet in frames:
+        _, out, _ = prog_test_run(prog_fd, packet)
+        if len(out) >= 34 and out[30:34] in index:
+            packets[index[out[30:34]]] += 1
+
+    weights = np.array(WEIGHTS)
+    expected = weights / weights.sum()
+    observed = packets / max(packets.sum(), 1)
+    weighted = weights > 0
+    error = float(np.max(np.abs(observed[weighted] - expected[weighted]) / expected[weighted]))
+    ok = packets.sum() == len(frames) and error <= TOLERANCE and not packets[~weighted].any()
+
+    print(json.dumps({
+        "lb_algorithm": lb_algorithm,
+        "packets": len(frames),
+        "forwarded": int(packets.sum()),
+        "backends": [{"weight": int(w), "packets": int(p), "share": round(float(s), 4), "expected": round(float(e), 4)}
+                     for w, p, s, e in zip(weights, packets, observed, expected)],
+        "max_relative_error": round(error, 4),
+        "ok": bool(ok),
+    }), flush=True)
+    return ok
+
+
+if __name__ == "__main__":
+    os.sched_setaffinity(0, {0})
+
+    rng = random.Random(1)
+    frames = [udp_frame(f"192.168.{rng.randint(0, 255)}.{rng.randint(1, 254)}", rng.randint(1024, 65535)) for _ in range(PACKETS)]
+    backends = [(f"10.1.0.{i}", 6000) for i in range(1, len(WEIGHTS) + 1)]
+
+    ok = True
+    for lb_algorithm in ["round_robin", "maglev"]:
+        ok &= run_case(lb_algorithm, frames, backends)
+
+    sys.exit(0 if ok else 1)
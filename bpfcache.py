@@ -0,0 +1,522 @@
+"""
+Cache of the compiled XDP program. bcc runs clang on xdp_prog.c at every start, which takes seconds and ~100MB: the
+first start saves the bytecode of the programs and the layout of the maps to BPF_CACHE_DIR, the next ones create the
+maps and load the programs from there with bpf() syscalls, without the compiler.
+
+Entries are keyed by the source, the cflags (map sizes, __MAX_CPU__), the kernel and bcc: the bytecode is compiled
+against the headers of the running kernel. Fill the cache ahead of time, e.g. before restarting xdp_lb.py:
+    python bpfcache.py
+"""
+import base64
+import ctypes
+import errno
+import hashlib
+import json
+import logging
+import os
+import platform
+import struct
+import time
+from collections import namedtuple
+
+from bcc import BPF
+from bcc.libbcc import lib
+from bcc.version import __version__ as bcc_version
+
+from utils import parse_cpu_list
+
+# include/uapi/linux/bpf.h
+BPF_MAP_CREATE = 0
+BPF_MAP_LOOKUP_ELEM = 1
+BPF_MAP_UPDATE_ELEM = 2
+BPF_MAP_DELETE_ELEM = 3
+BPF_MAP_GET_NEXT_KEY = 4
+BPF_PROG_LOAD = 5
+BPF_OBJ_PIN = 6
+BPF_OBJ_GET = 7
+BPF_OBJ_GET_INFO_BY_FD = 15
+BPF_MAP_LOOKUP_BATCH = 24
+BPF_MAP_UPDATE_BATCH = 26
+
+BPF_MAP_TYPE_PERCPU_HASH = 5
+BPF_MAP_TYPE_PERCPU_ARRAY = 6
+BPF_MAP_TYPE_LRU_PERCPU_HASH = 10
+
+# ld_imm64 with src_reg BPF_PSEUDO_MAP_FD: the immediate is the fd of a map
+BPF_LD_IMM64 = 0x18
+BPF_PSEUDO_MAP_FD = 1
+
+SYS_BPF = {"x86_64": 321, "aarch64": 280, "riscv64": 280, "ppc64le": 361, "s390x": 351, "armv7l": 386}
+
+Function = namedtuple("Function", ["name", "fd"])
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+
+class MapCreateAttr(ctypes.Structure):
+    _fields_ = [
+        ("map_type", ctypes.c_uint32),
+        ("key_size", ctypes.c_uint32),
+        ("value_size", ctypes.c_uint32),
+        ("max_entries", ctypes.c_uint32),
+        ("map_flags", ctypes.c_uint32),
+        ("inner_map_fd", ctypes.c_uint32),
+        ("numa_node", ctypes.c_uint32),
+        ("map_name", ctypes.c_char * 16),
+    ]
+
+
+class MapElemAttr(ctypes.Structure):
+    _fields_ = [
+        ("map_fd", ctypes.c_uint32),
+        ("key", ctypes.c_uint64),
+        ("value", ctypes.c_uint64),
+        ("flags", ctypes.c_uint64),
+    ]
+
+
+class MapBatchAttr(ctypes.Structure):
+    _fields_ = [
+        ("in_batch", ctypes.c_uint64),
+        ("out_batch", ctypes.c_uint64),
+        ("keys", ctypes.c_uint64),
+        ("values", ctypes.c_uint64),
+        ("count", ctypes.c_uint32),
+        ("map_fd", ctypes.c_uint32),
+        ("elem_flags", ctypes.c_uint64),
+        ("flags", ctypes.c_uint64),
+    ]
+
+
+class ProgLoadAttr(ctypes.Structure):
+    _fields_ = [
+        ("prog_type", ctypes.c_uint32),
+        ("insn_cnt", ctypes.c_uint32),
+        ("insns", ctypes.c_uint64),
+        ("license", ctypes.c_uint64),
+        ("log_level", ctypes.c_uint32),
+        ("log_size", ctypes.c_uint32),
+        ("log_buf", ctypes.c_uint64),
+        ("kern_version", ctypes.c_uint32),
+        ("prog_flags", ctypes.c_uint32),
+        ("prog_name", ctypes.c_char * 16),
+        ("prog_ifindex", ctypes.c_uint32),
+        ("expected_attach_type", ctypes.c_uint32),
+    ]
+
+
+class ObjAttr(ctypes.Structure):
+    _fields_ = [
+        ("pathname", ctypes.c_uint64),
+        ("bpf_fd", ctypes.c_uint32),
+        ("file_flags", ctypes.c_uint32),
+    ]
+
+
+class InfoAttr(ctypes.Structure):
+    _fields_ = [
+        ("bpf_fd", ctypes.c_uint32),
+        ("info_len", ctypes.c_uint32),
+        ("info", ctypes.c_uint64),
+    ]
+
+
+class MapInfo(ctypes.Structure):
+    _fields_ = [
+        ("type", ctypes.c_uint32),
+        ("id", ctypes.c_uint32),
+        ("key_size", ctypes.c_uint32),
+        ("value_size", ctypes.c_uint32),
+        ("max_entries", ctypes.c_uint32),
+        ("map_flags", ctypes.c_uint32),
+        ("name", ctypes.c_char * 16),
+    ]
+
+
+class ProgInfo(ctypes.Structure):
+    _fields_ = [
+        ("type", ctypes.c_uint32),
+        ("id", ctypes.c_uint32),
+        ("tag", ctypes.c_uint8 * 8),
+        ("jited_prog_len", ctypes.c_uint32),
+        ("xlated_prog_len", ctypes.c_uint32),
+        ("jited_prog_insns", ctypes.c_uint64),
+        ("xlated_prog_insns", ctypes.c_uint64),
+        ("load_time", ctypes.c_uint64),
+        ("created_by_uid", ctypes.c_uint32),
+        ("nr_map_ids", ctypes.c_uint32),
+        ("map_ids", ctypes.c_uint64),
+        ("name", ctypes.c_char * 16),
+    ]
+
+
+def bpf(cmd: int, attr: ctypes.Structure) -> int:
+    res = libc.syscall(SYS_BPF[platform.machine()], cmd, ctypes.byref(attr), ctypes.sizeof(attr))
+    if res < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return res
+
+
+def possible_cpus() -> list[int]:
+    with open("/sys/devices/system/cpu/possible") as f:
+        return parse_cpu_list(f.read())
+
+
+def map_info(map_fd: int) -> MapInfo:
+    info = MapInfo()
+    bpf(BPF_OBJ_GET_INFO_BY_FD, InfoAttr(bpf_fd=map_fd, info_len=ctypes.sizeof(info), info=ctypes.addressof(info)))
+    return info
+
+
+def prog_info(prog_fd: int) -> tuple[ProgInfo, list[int]]:
+    """
+    Info of a program and ids of the maps it uses
+    """
+    info = ProgInfo()
+    bpf(BPF_OBJ_GET_INFO_BY_FD, InfoAttr(bpf_fd=prog_fd, info_len=ctypes.sizeof(info), info=ctypes.addressof(info)))
+    map_ids = (ctypes.c_uint32 * info.nr_map_ids)()
+    info = ProgInfo(nr_map_ids=len(map_ids), map_ids=ctypes.addressof(map_ids))
+    bpf(BPF_OBJ_GET_INFO_BY_FD, InfoAttr(bpf_fd=prog_fd, info_len=ctypes.sizeof(info), info=ctypes.addressof(info)))
+    return info, list(map_ids)
+
+
+def pin(fd: int, path: str):
+    """
+    Pin a map or program to path in bpffs, replacing what was pinned there in one rename
+    """
+    # bpffs rejects names with dots
+    pathname = ctypes.create_string_buffer((path + "_new").encode())
+    bpf(BPF_OBJ_PIN, ObjAttr(pathname=ctypes.addressof(pathname), bpf_fd=fd))
+    os.replace(path + "_new", path)
+
+
+def get_pinned(path: str) -> int:
+    """
+    fd of the map or program pinned to path, FileNotFoundError if none
+    """
+    pathname = ctypes.create_string_buffer(path.encode())
+    return bpf(BPF_OBJ_GET, ObjAttr(pathname=ctypes.addressof(pathname)))
+
+
+def create_map(spec: dict) -> int:
+    return bpf(BPF_MAP_CREATE, MapCreateAttr(
+        map_type=spec["type"],
+        key_size=spec["key_size"],
+        value_size=spec["value_size"],
+        max_entries=spec["max_entries"],
+        map_flags=spec["flags"],
+        map_name=spec["name"][:15].encode(),
+    ))
+
+
+def load_prog(name: str, insns: bytes, prog_type: int, license: str, attach_type: int) -> int:
+    """
+    BPF_PROG_LOAD, with the verifier log in the error when the kernel rejects the program
+    """
+    code = ctypes.create_string_buffer(insns, len(insns))
+    license_buf = ctypes.create_string_buffer(license.encode())
+    attr = ProgLoadAttr(prog_type=prog_type, insn_cnt=len(insns) // 8, insns=ctypes.addressof(code),
+                        license=ctypes.addressof(license_buf), prog_name=name[:15].encode(),
+                        expected_attach_type=attach_type)
+    try:
+        return bpf(BPF_PROG_LOAD, attr)
+    except OSError as e:
+        log = ctypes.create_string_buffer(1 << 20)
+        attr.log_level, attr.log_size, attr.log_buf = 1, len(log), ctypes.addressof(log)
+        try:
+            return bpf(BPF_PROG_LOAD, attr)
+        except OSError:
+            raise OSError(e.errno, f"{name}: {e.strerror}\n{log.value.decode(errors='replace')[-4096:]}")
+
+
+def relocate(insns: bytes, fds: dict[int, int]) -> bytes:
+    """
+    Replace the map fds of the process that compiled the program by the ones of the maps created here
+    """
+    code = bytearray(insns)
+    for offset in range(0, len(code), 8):
+        # Little endian: src_reg is the high nibble of the registers byte
+        if code[offset] == BPF_LD_IMM64 and code[offset + 1] >> 4 == BPF_PSEUDO_MAP_FD:
+            struct.pack_into("<i", code, offset + 4, fds[struct.unpack_from("<i", code, offset + 4)[0]])
+    return bytes(code)
+
+
+class Table:
+    """
+    Map created from a cache entry, with the part of the bcc table interface used by xdp_lb.py: items by key, Key and
+    Leaf types, map_fd, max_entries, total_cpu, items() and batch lookups and updates
+    """
+
+    def __init__(self, name: str, map_fd: int, map_type: int, max_entries: int, key_type, leaf_type):
+        self.name = name
+        self.map_fd = map_fd
+        self.max_entries = max_entries
+        self.Key = key_type
+        self.Leaf = leaf_type
+
+        if map_type in (BPF_MAP_TYPE_PERCPU_HASH, BPF_MAP_TYPE_PERCPU_ARRAY, BPF_MAP_TYPE_LRU_PERCPU_HASH):
+            # Values of each CPU are 8 bytes aligned, as in bcc
+            self.total_cpu = len(possible_cpus())
+            self.sLeaf = leaf_type
+            if ctypes.sizeof(leaf_type) % 8:
+                leaf_type = {ctypes.c_uint: ctypes.c_uint64, ctypes.c_int: ctypes.c_int64}[leaf_type]
+            self.Leaf = leaf_type * self.total_cpu
+
+    def _key(self, key):
+        return self.Key(key) if isinstance(key, int) else key
+
+    def _elem(self, cmd, key, value=None, flags=0):
+        bpf(cmd, MapElemAttr(map_fd=self.map_fd, key=ctypes.addressof(key),
+                             value=ctypes.addressof(value) if value is not None else 0, flags=flags))
+
+    def __getitem__(self, key):
+        leaf = self.Leaf()
+        try:
+            self._elem(BPF_MAP_LOOKUP_ELEM, self._key(key), leaf)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(key)
+            raise
+        return leaf
+
+    def __setitem__(self, key, leaf):
+        self._elem(BPF_MAP_UPDATE_ELEM, self._key(key), leaf)
+
+    def __delitem__(self, key):
+        try:
+            self._elem(BPF_MAP_DELETE_ELEM, self._key(key))
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(key)
+            raise
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        key = None
+        while True:
+            next_key = self.Key()
+            try:
+                bpf(BPF_MAP_GET_NEXT_KEY, MapElemAttr(map_fd=self.map_fd, key=ctypes.addressof(key) if key is not None else 0,
+                                                      value=ctypes.addressof(next_key)))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    return
+                raise
+            yield next_key
+            key = next_key
+
+    def items(self):
+        items = []
+        for key in self.keys():
+            leaf = self.get(key)
+            # Deleted in the meantime
+            if leaf is not None:
+                items.append((key, leaf))
+        return items
+
+    def items_lookup_batch(self):
+        keys = (self.Key * self.max_entries)()
+        values = (self.Leaf * self.max_entries)()
+        batch = ctypes.c_uint64(0)
+        total = 0
+
+        while total < self.max_entries:
+            attr = MapBatchAttr(in_batch=ctypes.addressof(batch) if total else 0, out_batch=ctypes.addressof(batch),
+                                keys=ctypes.addressof(keys) + ctypes.sizeof(self.Key) * total,
+                                values=ctypes.addressof(values) + ctypes.sizeof(self.Leaf) * total,
+                                count=self.max_entries - total, map_fd=self.map_fd)
+            try:
+                bpf(BPF_MAP_LOOKUP_BATCH, attr)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                total += attr.count
+                break
+            total += attr.count
+
+        for i in range(total):
+            yield self.Key.from_buffer(keys, ctypes.sizeof(self.Key) * i), self.Leaf.from_buffer(values, ctypes.sizeof(self.Leaf) * i)
+
+    def items_update_batch(self, keys, values):
+        bpf(BPF_MAP_UPDATE_BATCH, MapBatchAttr(keys=ctypes.addressof(keys), values=ctypes.addressof(values),
+                                               count=len(keys), map_fd=self.map_fd))
+
+
+class CachedBPF:
+    """
+    Maps and programs of a cache entry, in place of the bcc BPF object: tables by name, load_func, attach_xdp and
+    remove_xdp.
+
+    With pin_dir, maps are pinned there by name and outlive the process. Maps already pinned with the same layout are
+    reused with their content (listed in adopted), the others are created and pinned in their place
+    """
+    attach_xdp = staticmethod(BPF.attach_xdp)
+    remove_xdp = staticmethod(BPF.remove_xdp)
+
+    def __init__(self, entry: dict, pin_dir: str = ""):
+        self.license = entry["license"]
+        self.programs = entry["programs"]
+        self.pin_dir = pin_dir
+        self.tables = {}
+        self.funcs = {}
+        self.adopted = []
+        # fd of each map in the process that compiled the program -> fd here
+        self.fds = {}
+
+        try:
+            if pin_dir:
+                os.makedirs(pin_dir, exist_ok=True)
+            for spec in entry["maps"]:
+                map_fd = self._open_map(spec)
+                self.fds[spec["fd"]] = map_fd
+                self.tables[spec["name"]] = Table(spec["name"], map_fd, spec["type"], spec["max_entries"],
+                                                  BPF._decode_table_type(spec["key_desc"]),
+                                                  BPF._decode_table_type(spec["leaf_desc"]))
+        except Exception:
+            self.close()
+            raise
+
+    def _open_map(self, spec: dict) -> int:
+        if not self.pin_dir:
+            return create_map(spec)
+
+        path = os.path.join(self.pin_dir, spec["name"])
+        try:
+            map_fd = get_pinned(path)
+        except FileNotFoundError:
+            map_fd = None
+
+        if map_fd is not None:
+            info = map_info(map_fd)
+            if (info.type, info.key_size, info.value_size, info.max_entries, info.map_flags) == \
+                    (spec["type"], spec["key_size"], spec["value_size"], spec["max_entries"], spec["flags"]):
+                self.adopted.append(spec["name"])
+                return map_fd
+            logging.warning(f"Pinned map {path} has another layout, replaced by an empty one")
+            os.close(map_fd)
+
+        map_fd = create_map(spec)
+        pin(map_fd, path)
+        return map_fd
+
+    def __getitem__(self, name: str) -> Table:
+        return self.tables[name]
+
+    def load_func(self, name: str, prog_type: int, attach_type: int = -1) -> Function:
+        if name not in self.funcs:
+            insns = relocate(base64.b64decode(self.programs[name]), self.fds)
+            self.funcs[name] = Function(name, load_prog(name, insns, prog_type, self.license, max(attach_type, 0)))
+        return self.funcs[name]
+
+    def close(self):
+        for fd in [*self.fds.values(), *(func.fd for func in self.funcs.values())]:
+            os.close(fd)
+        self.fds, self.funcs = {}, {}
+
+
+def cache_path(cache_dir: str, src_file: str, cflags: list[str]) -> str:
+    digest = hashlib.sha256()
+    with open(src_file, "rb") as f:
+        digest.update(f.read())
+    for part in [*cflags, platform.release(), platform.version(), bcc_version]:
+        digest.update(b"\0" + part.encode())
+    name = os.path.splitext(os.path.basename(src_file))[0]
+    return os.path.join(cache_dir, f"{name}-{digest.hexdigest()[:16]}.json")
+
+
+def make_entry(b: BPF, functions: list[str]) -> dict:
+    """
+    Bytecode of functions and maps of a compiled bcc object
+    """
+    maps = []
+    for i in range(lib.bpf_num_tables(b.module)):
+        map_fd = lib.bpf_table_fd_id(b.module, i)
+        # Sizes as created by bcc (ring buffers have no key and value)
+        info = map_info(map_fd)
+        maps.append({
+            "name": lib.bpf_table_name(b.module, i).decode(),
+            "fd": map_fd,
+            "type": info.type,
+            "key_size": info.key_size,
+            "value_size": info.value_size,
+            "max_entries": info.max_entries,
+            "flags": info.map_flags,
+            "key_desc": json.loads(lib.bpf_table_key_desc_id(b.module, i)),
+            "leaf_desc": json.loads(lib.bpf_table_leaf_desc_id(b.module, i)),
+        })
+
+    return {
+        "license": lib.bpf_module_license(b.module).decode(),
+        "maps": maps,
+        "programs": {name: base64.b64encode(b.dump_func(name)).decode() for name in functions},
+    }
+
+
+def save(entry: dict, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(entry, f)
+    os.replace(path + ".tmp", path)
+
+
+def load(src_file: str, cflags: list[str], functions: list[str], cache_dir: str, pin_dir: str = ""):
+    """
+    BPF object of src_file: created from the cache entry of src_file and cflags in cache_dir, or compiled by bcc and
+    saved to cache_dir. The first of functions is loaded from the entry right away, so that an entry rejected by the
+    kernel falls back to the compiler. No cache if cache_dir is empty.
+
+    With pin_dir, maps are pinned there (see CachedBPF) and a fresh compile is loaded through its entry as well
+    """
+    path = cache_path(cache_dir, src_file, cflags) if cache_dir else ""
+
+    time_start = time.time()
+    if path and os.path.exists(path):
+        b = None
+        try:
+            with open(path) as f:
+                b = CachedBPF(json.load(f), pin_dir)
+            b.load_func(functions[0], BPF.XDP)
+            logging.info(f"BPF program loaded from cache {path} in {(time.time() - time_start) * 1000:.2f} ms (warm start)")
+            return b
+        except Exception as e:
+            if b is not None:
+                b.close()
+            logging.warning(f"Can not load BPF cache {path}, compiling {src_file}: {e}")
+
+    time_start = time.time()
+    b = BPF(src_file=src_file, cflags=cflags, debug=0)
+    logging.info(f"BPF program compiled in {(time.time() - time_start) * 1000:.2f} ms (cold start)")
+
+    if path:
+        try:
+            save(make_entry(b, functions), path)
+            logging.info(f"BPF program cached in {path}")
+        except Exception as e:
+            logging.warning(f"Can not write BPF cache {path}: {e}")
+
+    if pin_dir:
+        # Maps of bcc are not pinned, load the same programs from their entry instead
+        entry = make_entry(b, functions)
+        b.cleanup()
+        b = CachedBPF(entry, pin_dir)
+        b.load_func(functions[0], BPF.XDP)
+    return b
+
+
+if __name__ == "__main__":
+    import config
+
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+    if not config.bpf_cache_dir:
+        raise SystemExit("BPF_CACHE_DIR is empty")
+    # Always compile, the entry may be stale after a bcc or kernel headers update of the same version
+    path = cache_path(config.bpf_cache_dir, "xdp_prog.c", config.bpf_cflags)
+    if os.path.exists(path):
+        os.remove(path)
+    load("xdp_prog.c", config.bpf_cflags, config.bpf_functions, config.bpf_cache_dir)
@@ -4,13 +4,32 @@ from os import cpu_count
 import dotenv
 from bcc import BPF
 from utils import *
+import maglev
 
 dotenv.load_dotenv("env")
 
-# Use arp -n to get destination mac address
+# Use arp -n to get destination mac address. ip:port@weight gives a backend a weight (1 by default, 0 to drain)
 servers = parse_config_backends(os.environ.get("BACKENDS", default="127.0.0.1:5000"))
-device_in = os.environ.get("INTERFACE_IN", default="eth0")
-device_out = os.environ.get("INTERFACE_OUT", default="eth0")
+
+# Interfaces where the XDP program is attached, comma separated. They share the same program and maps (services,
+# backends), each gets its own slot in the per interface maps and metrics
+devices_in = [d.strip() for d in os.environ.get("INTERFACE_IN", default="eth0").split(",")]
+
+# Out interface and XDP mode of each INTERFACE_IN, in the same order. A single value applies to all of them
+devices_out = [d.strip() for d in os.environ.get("INTERFACE_OUT", default="eth0").split(",")]
+xdp_modes = [m.strip() for m in os.environ.get("XDP_MODE", default="XDP_FLAGS_SKB_MODE").split(",")]
+
+for name, values in [("INTERFACE_OUT", devices_out), ("XDP_MODE", xdp_modes)]:
+    if len(values) == 1:
+        values *= len(devices_in)
+    elif len(values) != len(devices_in):
+        raise ValueError(f"{name} must have one value or one per INTERFACE_IN ({len(devices_in)})")
+
+# First interface, used for the VIP default address
+device_in = devices_in[0]
+device_out = devices_out[0]
+xdp_mode = xdp_modes[0]
+
 vip = os.environ.get("INTERFACE_IN_VIP", "")
 filter_ip = get_ip_address(device_in) if vip == "" else vip
 
@@ -18,7 +37,256 @@ listen_host = os.environ.get("LISTEN_HOST", default="0.0.0.0")
 listen_port = int(os.environ.get("LISTEN_PORT", default="8000"))
 
 destination_ports = [int(j) for j in os.environ.get("DESTINATION_PORTS", default=','.join([str(5000+i) for i in range(cpu_count())])).split(",")]
-xdp_mode = os.environ.get("XDP_MODE", default="XDP_FLAGS_SKB_MODE")
+
+# Backend selection: round_robin (per-CPU packet counter) or maglev (consistent hash of the UDP 5-tuple)
+lb_algorithm = os.environ.get("LB_ALGORITHM", default="round_robin")
+
+# IP and UDP checksum update after rewriting addresses and port: incremental (RFC 1624), zero (UDP checksum set to 0)
+# or full (recompute over the header and payload)
+checksum_mode = os.environ.get("CHECKSUM_MODE", default="incremental")
+
+# Services: (vip, protocol, ports) -> backend pool. Declared in SERVICES_FILE (json), or a single default service
+# made of INTERFACE_IN_VIP, DESTINATION_PORTS and BACKENDS
+max_services = int(os.environ.get("MAX_SERVICES", default="16"))
+services_file = os.environ.get("SERVICES_FILE", default="")
+services = parse_config_services(services_file) if services_file != "" else [{
+    "id": 0,
+    "name": "default",
+    "vip": filter_ip,
+    "protocol": "udp",
+    "ports": destination_ports,
+    "backends": servers,
+    "health_check": {},
+    "forwarding": "",
+    "tunnel_port": 0,
+    "rate_limit": {},
+}]
+
+# How packets reach the backends: nat (addresses rewritten, replies through the load balancer), or direct server return
+# with the client packet encapsulated in ipip or gue (backends decapsulate it and reply to the client directly).
+# GUE_PORT is the destination port of gue packets. Services can override both in SERVICES_FILE ("forwarding",
+# "tunnel_port"), backends can override the tunnel port in the API
+forwarding_mode = os.environ.get("FORWARDING_MODE", default="nat")
+gue_port = int(os.environ.get("GUE_PORT", default="6080"))
+
+# Largest IP packet on the path to the backends of DSR services, outer headers included: client packets larger than
+# TUNNEL_MTU - 20 (ipip) or - 28 (gue) are dropped (verdict encap_too_big). 0 for the MTU of each out interface
+tunnel_mtu = int(os.environ.get("TUNNEL_MTU", default="0"))
+
+# UDP health checks of backends: HEALTH_CHECK_PAYLOAD is sent every HEALTH_CHECK_INTERVAL seconds (0 to disable),
+# a backend is down after HEALTH_CHECK_FALL probes without a response starting with HEALTH_CHECK_RESPONSE (any response
+# if empty) within HEALTH_CHECK_TIMEOUT seconds, and up again after HEALTH_CHECK_RISE good ones.
+# Services can override any of these in SERVICES_FILE with a "health_check" object
+health_check = {
+    "interval": float(os.environ.get("HEALTH_CHECK_INTERVAL", default="0")),
+    "timeout": float(os.environ.get("HEALTH_CHECK_TIMEOUT", default="1")),
+    "rise": int(os.environ.get("HEALTH_CHECK_RISE", default="2")),
+    "fall": int(os.environ.get("HEALTH_CHECK_FALL", default="3")),
+    "jitter": float(os.environ.get("HEALTH_CHECK_JITTER", default="0.1")),
+    "payload": os.environ.get("HEALTH_CHECK_PAYLOAD", default="ping"),
+    "response": os.environ.get("HEALTH_CHECK_RESPONSE", default=""),
+    "port": int(os.environ.get("HEALTH_CHECK_PORT", default="0")),
+}
+
+# Flood protection in XDP: each source address of a service (each source /RATE_LIMIT_PREFIX, e.g. 24) gets a token
+# bucket of RATE_LIMIT packets per second and RATE_LIMIT_BURST packets (0 for one second of RATE_LIMIT), packets above
+# it are dropped. Every RX CPU keeps its own buckets, each with 1/RATE_LIMIT_CPUS of the rate and burst: the limit holds
+# for a source whose flows RSS spreads over the RX CPUs, a source with a single flow gets its share. RATE_LIMIT_ALLOW
+# prefixes are never limited, RATE_LIMIT_DENY prefixes are dropped (comma separated, longest prefix wins). RATE_LIMIT 0
+# disables the limiter. Services can override any of these in SERVICES_FILE with a "rate_limit" object, and the API at runtime
+rate_limit = {
+    "rate": int(os.environ.get("RATE_LIMIT", default="0")),
+    "burst": int(os.environ.get("RATE_LIMIT_BURST", default="0")),
+    "prefix": int(os.environ.get("RATE_LIMIT_PREFIX", default="32")),
+    "allow": [p.strip() for p in os.environ.get("RATE_LIMIT_ALLOW", default="").split(",") if p.strip()],
+    "deny": [p.strip() for p in os.environ.get("RATE_LIMIT_DENY", default="").split(",") if p.strip()],
+}
+
+# RX CPUs the rate and burst of a source are split over, 0 for the number of RX queues of the ingress interfaces (at
+# most the number of CPUs)
+rate_limit_cpus = int(os.environ.get("RATE_LIMIT_CPUS", default="0"))
+
+# Capacity of the token bucket table, the least recently used sources are evicted when full. Each source takes
+# 24 bytes per possible CPU
+rate_limit_max_sources = int(os.environ.get("RATE_LIMIT_MAX_SOURCES", default="16384"))
+
+# Capacity of the allow and deny lists over all services
+rate_limit_max_prefixes = int(os.environ.get("RATE_LIMIT_MAX_PREFIXES", default="16384"))
+
+# Sources with the most rate limited packets exported in metrics
+rate_limit_top = int(os.environ.get("RATE_LIMIT_TOP", default="10"))
+
+for service in services:
+    service["health_check"] = {**health_check, **service["health_check"]}
+    service["forwarding"] = service["forwarding"] or forwarding_mode
+    service["tunnel_port"] = service["tunnel_port"] or gue_port
+    service["rate_limit"] = {**rate_limit, **service["rate_limit"]}
+    # Same bounds as the API, a rate above 1e9 packets/s would round the cost of a packet down to 0 (no limit)
+    RateLimitRequest(**service["rate_limit"])
+
+# VIPs that are not addresses of device_in, announced with gratuitous ARP on every ingress interface
+announced_vips = sorted({service["vip"] for service in services} - {get_ip_address(device_in)}) if services_file != "" else ([vip] if vip != "" else [])
+
+# Only UDP is load balanced by the XDP program
+protocols = {
+    "udp": socket.IPPROTO_UDP,
+}
+
+# Capacity of the backends table of each service in the XDP program
+max_backends = int(os.environ.get("MAX_BACKENDS", default="1024"))
+
+# Number of slots in the maglev lookup table, must be a prime much larger than the number of backends (checked at start
+# with LB_ALGORITHM=maglev)
+maglev_table_size = int(os.environ.get("MAGLEV_TABLE_SIZE", default="4099"))
+
+# Longest weighted round robin sequence of a service, backends appear in it in proportion to their weight (weights are
+# scaled down when their sum, divided by their gcd, is larger)
+weighted_rr_size = int(os.environ.get("WEIGHTED_RR_SIZE", default="4096"))
+
+# Software RSS: UDP packets of services are handed to these worker CPUs (e.g. 2-9,12) by flow hash and rewritten and
+# sent there, whatever CPU received them. Empty to process packets on the RX CPU. Can be changed at runtime
+rss_cpus = parse_cpu_list(os.environ.get("RSS_CPUS", default=""))
+
+# Packets queued per worker CPU (cpumap qsize, at most 16384)
+rss_queue_size = int(os.environ.get("RSS_QUEUE_SIZE", default="2048"))
+
+# Connection tracking (full-NAT): each flow (client 5-tuple) keeps its backend and gets its own source port from
+# NAT_PORT_RANGE, backend replies are translated back to the client in XDP. Flows are forgotten after CONNTRACK_TIMEOUT
+# idle seconds, 0 disables conntrack (packets keep the client source port and replies go through the kernel)
+conntrack_timeout = float(os.environ.get("CONNTRACK_TIMEOUT", default="0"))
+
+# Capacity of the flow tables, the least recently used flows are evicted when full
+conntrack_max_flows = int(os.environ.get("CONNTRACK_MAX_FLOWS", default="65536"))
+
+# Source ports of tracked flows, must not overlap ports of services or of local sockets on the source address
+nat_port_min, nat_port_max = [int(port) for port in os.environ.get("NAT_PORT_RANGE", default="10000-32767").split("-")]
+
+# Send 1 in EVENT_SAMPLE_RATE forwarded packets to the event ring buffer, 0 to disable. Can be changed at runtime
+event_sample_rate = int(os.environ.get("EVENT_SAMPLE_RATE", default="0"))
+
+# Number of sampled events kept in memory
+event_buffer_size = int(os.environ.get("EVENT_BUFFER_SIZE", default=str(256 * 1024)))
+
+# Flow telemetry: the headers (5-tuple, size, backend, CPU) of 1 in FLOW_SAMPLE_RATE forwarded packets, picked at
+# random, are aggregated into the top flows, sources, destinations and backends over the last FLOW_WINDOW seconds, made
+# of FLOW_WINDOW_SLOTS sub-windows. 0 disables sampling. Can be changed at runtime
+flow_sample_rate = int(os.environ.get("FLOW_SAMPLE_RATE", default="0"))
+flow_window = float(os.environ.get("FLOW_WINDOW", default="60"))
+flow_window_slots = int(os.environ.get("FLOW_WINDOW_SLOTS", default="6"))
+
+# Heavy hitters of each dimension and sub-window: a count-min sketch of FLOW_SKETCH_DEPTH x FLOW_SKETCH_WIDTH counters
+# and the FLOW_TOP_CAPACITY keys with the most packets. Memory and CPU do not depend on the number of flows
+flow_sketch_width = int(os.environ.get("FLOW_SKETCH_WIDTH", default="4096"))
+flow_sketch_depth = int(os.environ.get("FLOW_SKETCH_DEPTH", default="4"))
+flow_top_capacity = int(os.environ.get("FLOW_TOP_CAPACITY", default="1024"))
+
+# IPFIX collector (host:port, UDP) receiving the FLOW_EXPORT_TOP flows with the most packets of each sub-window, empty
+# to disable
+ipfix_collector = os.environ.get("IPFIX_COLLECTOR", default="")
+flow_export_top = int(os.environ.get("FLOW_EXPORT_TOP", default="100"))
+
+# Compiled XDP programs and map layouts, keyed by source, cflags, kernel and bcc version, so that restarts skip the
+# compiler (see bpfcache.py). Empty to compile at every start
+bpf_cache_dir = os.environ.get("BPF_CACHE_DIR", default="/var/cache/xdp-lb")
+
+# bpffs directory where the maps and the XDP program are pinned. The program stays attached when the process exits, and
+# the next run adopts it and the content of the maps (backends, counters, flows), replacing the program in place when
+# it changed. Empty to detach the program on exit and start from empty maps
+bpf_pin_dir = os.environ.get("BPF_PIN_DIR", default="")
+
+# Sizes of the maps of xdp_prog.c
+bpf_cflags = [
+    "-w",
+    "-D__MAX_CPU__=%u" % cpu_count(),
+    "-D__MAX_INTERFACES__=%u" % len(devices_in),
+    "-D__MAX_SERVICES__=%u" % max_services,
+    "-D__MAX_BACKENDS__=%u" % max_backends,
+    "-D__MAGLEV_TABLE_SIZE__=%u" % maglev_table_size,
+    "-D__WEIGHTED_RR_SIZE__=%u" % weighted_rr_size,
+    "-D__MAX_FLOWS__=%u" % conntrack_max_flows,
+    "-D__MAX_RATE_LIMITED__=%u" % rate_limit_max_sources,
+    "-D__MAX_SOURCE_PREFIXES__=%u" % rate_limit_max_prefixes,
+]
+
+# Programs of xdp_prog.c: entry point of the ingress interfaces, second stage of software RSS
+bpf_functions = ["xdp_prog", "xdp_cpu_prog"]
+
+# Must match LB_ALGORITHM_* in xdp_prog.c
+lb_algorithms = {
+    "round_robin": 0,
+    "maglev": 1,
+}
+
+# Must match FORWARDING_* in xdp_prog.c
+forwarding_modes = {
+    "nat": 0,
+    "ipip": 1,
+    "gue": 2,
+}
+
+# Must match CSUM_MODE_* in xdp_prog.c
+checksum_modes = {
+    "incremental": 0,
+    "zero": 1,
+    "full": 2,
+}
+
+if lb_algorithm not in lb_algorithms:
+    raise ValueError(f"Unknown LB_ALGORITHM {lb_algorithm}, must be one of {', '.join(lb_algorithms)}")
+if checksum_mode not in checksum_modes:
+    raise ValueError(f"Unknown CHECKSUM_MODE {checksum_mode}, must be one of {', '.join(checksum_modes)}")
+if lb_algorithm == "maglev":
+    maglev.check_table_size(maglev_table_size, max_backends)
+
+# Must match VERDICT_* in xdp_prog.c
+verdict_reasons = [
+    "forward",
+    "icmp_echo",
+    "short_packet",
+    "not_ipv4",
+    "not_vip",
+    "icmp_not_echo",
+    "not_udp",
+    "no_service",
+    "no_backends",
+    "bad_backend",
+    "map_lookup",
+    "no_lb_mac",
+    "cpu_redirect",
+    "reply",
+    "no_nat_port",
+    "encap_failed",
+    "rate_limited",
+    "denied",
+    "encap_too_big",
+]
+
+# Must match SOURCE_* in xdp_prog.c
+source_actions = {
+    "allow": 1,
+    "deny": 2,
+}
+
+# Must match CT_EVENT_* in xdp_prog.c
+conntrack_events = [
+    "created",
+    "expired",
+    "reassigned",
+]
+
+# enum xdp_action
+xdp_actions = ["aborted", "drop", "pass", "tx", "redirect"]
+
+# enum bpf_attach_type in include/uapi/linux/bpf.h, expected attach type of the second stage program (xdp_cpu_prog).
+# The kernel refuses a cpumap entry whose program was loaded with another one
+BPF_XDP_CPUMAP = 35
+
+# Mode of an attached program (IFLA_XDP_ATTACHED) -> flags
+xdp_attach_modes = {
+    "xdp": "XDP_FLAGS_DRV_MODE",
+    "xdpgeneric": "XDP_FLAGS_SKB_MODE",
+    "xdpoffload": "XDP_FLAGS_HW_MODE",
+}
 
 # https://docs.ebpf.io/linux/program-type/BPF_PROG_TYPE_XDP
 flags = {
@@ -0,0 +1,63 @@
+import logging
+import time
+
+
+class ConntrackTables:
+    """
+    Flow tables of xdp_prog.c: conntrack (client 5-tuple -> backend and source port) and conntrack_reverse (reply
+    5-tuple -> client). The XDP program evicts the least recently used flows when a table is full and reuses the
+    source ports of idle flows, sweep() removes idle flows so that the tables only hold live ones.
+
+    Both entries of a flow are refreshed together, an idle reply entry means an idle flow
+    """
+
+    def __init__(self, flows, replies):
+        self.flows = flows
+        self.replies = replies
+        self.active = 0
+
+    def _reply_items(self):
+        try:
+            # BPF_MAP_LOOKUP_BATCH, kernel >= 5.6
+            return list(self.replies.items_lookup_batch())
+        except Exception as e:
+            logging.debug(f"Batch lookup is not available, reading flows one by one: {e}")
+            return list(self.replies.items())
+
+    def sweep(self, timeout_ns: int) -> int:
+        """
+        Remove flows idle for more than timeout_ns, returns the number of flows left
+        """
+        # Same clock as bpf_ktime_get_ns()
+        now = time.clock_gettime_ns(time.CLOCK_MONOTONIC)
+        active = 0
+        expired = []
+
+        for key, nat in self._reply_items():
+            if now - nat.last_seen <= timeout_ns:
+                active += 1
+            else:
+                expired.append((key, nat))
+
+        for key, nat in expired:
+            flow_key = self.flows.Key(saddr=nat.client_ip, daddr=nat.vip, sport=nat.client_port, dport=nat.vport, proto=key.proto)
+            flow = self.flows.get(flow_key)
+
+            # The client may have a newer flow with another backend or port
+            if flow is not None and (flow.backend_ip, flow.backend_port, flow.nat_port) == (key.backend_ip, key.backend_port, key.nat_port):
+                self._delete(self.flows, flow_key)
+            self._delete(self.replies, key)
+
+        if expired:
+            logging.debug(f"{len(expired)} idle flows removed, {active} left")
+
+        self.active = active
+        return active
+
+    @staticmethod
+    def _delete(table, key):
+        try:
+            del table[key]
+        except KeyError:
+            # Evicted or reused in the meantime
+            pass
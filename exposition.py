@@ -0,0 +1,53 @@
+import gzip
+import hashlib
+from typing import NamedTuple
+
+from prometheus_client import exposition
+from prometheus_client.openmetrics import exposition as openmetrics
+
+
+class Exposition(NamedTuple):
+    content_type: str
+    body: bytes
+    body_gzip: bytes
+    etag: str
+
+
+class MetricsSnapshot(NamedTuple):
+    """
+    Rendered /metrics bodies of one collection, never modified once built
+    """
+    text: Exposition
+    openmetrics: Exposition
+    timestamp: float
+
+
+def render_exposition(content_type: str, body: bytes) -> Exposition:
+    # Weak ETag of the uncompressed content, shared by the gzip body. Unchanged metrics get 304
+    etag = 'W/"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+    return Exposition(content_type, body, gzip.compress(body, compresslevel=5, mtime=0), etag)
+
+
+def render_snapshot(registry, timestamp: float) -> MetricsSnapshot:
+    return MetricsSnapshot(
+        text=render_exposition(exposition.CONTENT_TYPE_LATEST, exposition.generate_latest(registry)),
+        openmetrics=render_exposition(openmetrics.CONTENT_TYPE_LATEST, openmetrics.generate_latest(registry)),
+        timestamp=timestamp,
+    )
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() in ("gzip", "*") and params.replace(" ", "") != "q=0":
+            return True
+    return False
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison (RFC 9110 13.1.2)
+    return etag.removeprefix("W/") in (t.strip().removeprefix("W/") for t in if_none_match.split(","))
@@ -0,0 +1,397 @@
+"""
+Fleet control: brings the services of many xdp_lb.py nodes to the desired state of a JSON file, backends (with weights)
+and rate limits, through their APIs. Nodes are changed concurrently, in waves: after each wave the health gates
+compare the verdict counters and packet rate of its nodes before and after the change, then every node of the wave
+must report the desired state in /api/v1/configs. A failed wave is rolled back and stops the rollout.
+
+    python fleet.py fleet.json diff
+    python fleet.py fleet.json apply
+    python fleet.py fleet.json apply --waves 1,25%,100% --settle 2
+
+Only needs the standard library, see fleet.example.json for the state file.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import re
+import sys
+import time
+from urllib.parse import urlsplit
+
+# Reasons of packets that a node failed to forward, see VERDICT_* in xdp_prog.c
+FAILURE_REASONS = {"no_backends", "bad_backend", "map_lookup", "no_lb_mac", "no_nat_port", "encap_failed", "encap_too_big"}
+
+DEFAULT_GATES = {
+    # Seconds between the change of a wave and the gates, 0 to skip the gates
+    "settle": 2.0,
+    # Largest share of failed forwards (FAILURE_REASONS) of a node while settling
+    "max_failure_ratio": 0.01,
+    # Lowest packet rate of a node after the change, relative to before. Nodes under min_rate pps are not checked
+    "min_rate_ratio": 0.5,
+    "min_rate": 100,
+}
+
+VERDICT_LINE = re.compile(r'^xdp_verdict_total\{(.*)\} (\S+)$', re.MULTILINE)
+LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+
+def describe_error(e: BaseException) -> str:
+    # Timeouts have no message
+    return str(e) or type(e).__name__
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, body: bytes):
+        super().__init__(f"HTTP {status}: {body[:200].decode(errors='replace')}")
+        self.status = status
+
+
+class Node:
+    """
+    API of one xdp_lb.py, over a pool of up to `connections` HTTP/1.1 keep-alive connections
+    """
+
+    def __init__(self, url: str, connections: int = 4, timeout: float = 2.0):
+        parts = urlsplit(url)
+        self.url = url.rstrip("/")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.netloc = parts.netloc
+        self.timeout = timeout
+        self.idle = []
+        self.slots = asyncio.Semaphore(connections)
+
+    async def request(self, method: str, path: str, body=None) -> bytes:
+        async with self.slots:
+            while True:
+                pooled = bool(self.idle)
+                reader, writer = self.idle.pop() if pooled else await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+                try:
+                    status, data, keep_alive = await asyncio.wait_for(self._exchange(reader, writer, method, path, body), self.timeout)
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    # A pooled connection may have been closed by the node since, try the next one
+                    if not pooled:
+                        raise
+                except BaseException:
+                    writer.close()
+                    raise
+
+            if keep_alive:
+                self.idle.append((reader, writer))
+            else:
+                writer.close()
+
+        if status >= 400:
+            raise HttpError(status, data)
+        return data
+
+    async def _exchange(self, reader, writer, method, path, body):
+        payload = b"" if body is None else json.dumps(body).encode()
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.netloc}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n"
+        writer.write(head.encode() + payload)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the node")
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while size := int((await reader.readline()).split(b";")[0], 16):
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            await reader.readline()
+            data = b"".join(chunks)
+        else:
+            data = await reader.readexactly(int(headers.get("content-length", "0")))
+
+        return int(status_line.split()[1]), data, headers.get("connection", "").lower() != "close"
+
+    async def get_json(self, path: str):
+        return json.loads(await self.request("GET", path))
+
+    async def put_json(self, path: str, body):
+        return json.loads(await self.request("PUT", path, body))
+
+    async def services(self) -> dict[int, dict]:
+        configs = await self.get_json("/api/v1/configs")
+        return {service["id"]: service for service in configs["services"]}
+
+    async def health(self) -> dict:
+        """
+        Counters of the health gates: forwarded and failed packets since start, packet rate of the last second
+        """
+        metrics, rates = await asyncio.gather(self.request("GET", "/metrics"), self.get_json("/api/v1/rates"))
+        forwarded = failed = 0.0
+        for labels, value in VERDICT_LINE.findall(metrics.decode()):
+            reason = dict(LABEL.findall(labels)).get("reason")
+            if reason == "forward":
+                forwarded += float(value)
+            elif reason in FAILURE_REASONS:
+                failed += float(value)
+        return {"forwarded": forwarded, "failed": failed, "packet_rate": sum(rates["packet_rate"])}
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+def parse_backend(backend) -> dict:
+    """
+    ip:port[@weight] or {"ip", "port", "weight", "mac", "tunnel_port"} (BackendRequest)
+    """
+    if isinstance(backend, str):
+        address, _, weight = backend.strip().partition("@")
+        host, port = address.rsplit(":", 1)
+        return {"ip": host, "port": int(port), "weight": int(weight or 1)}
+    return {"weight": 1, **backend}
+
+
+def load_state(path: str) -> dict:
+    with open(path) as f:
+        return parse_state(json.load(f))
+
+
+def parse_state(state: dict) -> dict:
+    """
+    Desired state: "nodes" (API URLs), "services" (id -> "backends" and an optional "rate_limit"), optional "waves"
+    and "gates"
+    """
+    return {
+        "nodes": state["nodes"],
+        "services": {int(service_id): {
+            "backends": [parse_backend(backend) for backend in service["backends"]],
+            **({"rate_limit": service["rate_limit"]} if "rate_limit" in service else {}),
+        } for service_id, service in state["services"].items()},
+        "waves": state.get("waves", ["100%"]),
+        "gates": {**DEFAULT_GATES, **state.get("gates", {})},
+    }
+
+
+def parse_waves(waves, n: int) -> list[range]:
+    """
+    Node indexes of each wave from cumulative sizes, a number of nodes or a percentage of the fleet (1,25%,100%).
+    The last wave always reaches every node
+    """
+    if isinstance(waves, str):
+        waves = waves.split(",")
+
+    result, done = [], 0
+    for wave in waves:
+        wave = str(wave).strip()
+        target = math.ceil(n * float(wave[:-1]) / 100) if wave.endswith("%") else int(wave)
+        target = min(max(target, done), n)
+        if target > done:
+            result.append(range(done, target))
+            done = target
+    if done < n:
+        result.append(range(done, n))
+    return result
+
+
+def diff_service(desired: dict, current: dict) -> list[str]:
+    """
+    Differences between the desired and current (/api/v1/configs) state of a service, empty when converged
+    """
+    wanted = {(be["ip"], be["port"]): be for be in desired["backends"]}
+    declared = {(be["ip"], be["port"]): be for be in current.get("declared", current["backends"])}
+
+    changes = [f"+{ip}:{port}" for ip, port in sorted(wanted.keys() - declared.keys())]
+    changes += [f"-{ip}:{port}" for ip, port in sorted(declared.keys() - wanted.keys())]
+    for key in sorted(wanted.keys() & declared.keys()):
+        for field in ["weight", "mac", "tunnel_port"]:
+            if field in wanted[key] and wanted[key][field] != declared[key].get(field):
+                changes.append(f"{key[0]}:{key[1]} {field} {declared[key].get(field)} -> {wanted[key][field]}")
+
+    for field, value in desired.get("rate_limit", {}).items():
+        if current.get("rate_limit", {}).get(field) != value:
+            changes.append(f"rate_limit.{field} {current.get('rate_limit', {}).get(field)} -> {value}")
+
+    return changes
+
+
+def diff_node(desired: dict, services: dict[int, dict]) -> dict[int, list[str]]:
+    """
+    Differences of each service of a node that is not in the desired state
+    """
+    diff = {}
+    for service_id, service in desired.items():
+        if service_id not in services:
+            diff[service_id] = ["service not configured on the node"]
+        elif changes := diff_service(service, services[service_id]):
+            diff[service_id] = changes
+    return diff
+
+
+def backend_requests(backends) -> list[dict]:
+    """
+    BackendRequest bodies of the declared backends of a node, to put them back. MAC addresses are left to the node
+    """
+    return [{"ip": be["ip"], "port": be["port"], "weight": be["weight"], **({"tunnel_port": be["tunnel_port"]} if be.get("tunnel_port") else {})} for be in backends]
+
+
+class Fleet:
+    """
+    The nodes of a desired state file, changed concurrently
+    """
+
+    def __init__(self, state: dict, connections: int = 4, timeout: float = 2.0):
+        self.state = state
+        self.nodes = [Node(url, connections, timeout) for url in state["nodes"]]
+
+    async def gather(self, nodes, fn):
+        """
+        fn(node) on every node at once, exceptions are returned
+        """
+        return await asyncio.gather(*(fn(node) for node in nodes), return_exceptions=True)
+
+    async def diff(self, nodes=None) -> dict[str, dict]:
+        """
+        Differences of each node with the desired state, or the error reading its state
+        """
+        nodes = self.nodes if nodes is None else nodes
+        results = await self.gather(nodes, Node.services)
+        return {node.url: ({"error": describe_error(services)} if isinstance(services, BaseException) else diff_node(self.state["services"], services))
+                for node, services in zip(nodes, results)}
+
+    async def push(self, node: Node, services: dict[int, dict], desired: dict[int, dict]):
+        """
+        Put the backends and rate limits of the services that differ from desired, every service at once
+        """
+        requests = []
+        for service_id, service in desired.items():
+            current = services[service_id]
+            changes = diff_service(service, current)
+            if any(not change.startswith("rate_limit.") for change in changes):
+                requests.append(node.put_json(f"/api/v1/services/{service_id}/backends", service["backends"]))
+            if any(change.startswith("rate_limit.") for change in changes):
+                requests.append(node.put_json(f"/api/v1/services/{service_id}/rate_limit", {**current.get("rate_limit", {}), **service["rate_limit"]}))
+        await asyncio.gather(*requests)
+
+    async def rollback(self, nodes, previous: dict[str, dict]):
+        """
+        Put back the backends and rate limits read before the change
+        """
+        async def restore(node):
+            services = previous[node.url]
+            desired = {service_id: {"backends": backend_requests(service.get("declared", service["backends"])), "rate_limit": service.get("rate_limit", {})}
+                       for service_id, service in services.items() if service_id in self.state["services"]}
+            await self.push(node, await node.services(), desired)
+
+        for node, result in zip(nodes, await self.gather(nodes, restore)):
+            if isinstance(result, BaseException):
+                logging.error(f"Rollback of {node.url} failed: {describe_error(result)}")
+            else:
+                logging.info(f"Rolled back {node.url}")
+
+    async def apply_wave(self, nodes, gates: dict) -> dict[str, list[str]]:
+        """
+        Change the nodes of a wave, check the health gates and convergence. Failures of each node, empty when all passed
+        """
+        failures = {node.url: [] for node in nodes}
+        settle = gates["settle"] > 0
+
+        before = dict(zip([node.url for node in nodes], await self.gather(nodes, Node.services)))
+        health_before = dict(zip([node.url for node in nodes], await self.gather(nodes, Node.health))) if settle else {}
+        pushed = []
+        for node in nodes:
+            for result in [before[node.url], health_before.get(node.url)]:
+                if isinstance(result, BaseException):
+                    failures[node.url].append(f"read: {describe_error(result)}")
+            if failures[node.url]:
+                continue
+            missing = [service_id for service_id in self.state["services"] if service_id not in before[node.url]]
+            if missing:
+                failures[node.url].append(f"services {missing} not configured on the node")
+            else:
+                pushed.append(node)
+
+        for node, result in zip(pushed, await self.gather(pushed, lambda node: self.push(node, before[node.url], self.state["services"]))):
+            if isinstance(result, BaseException):
+                failures[node.url].append(f"push: {describe_error(result)}")
+
+        if settle:
+            await asyncio.sleep(gates["settle"])
+            for node, health in zip(pushed, await self.gather(pushed, Node.health)):
+                if isinstance(health, BaseException):
+                    failures[node.url].append(f"health: {describe_error(health)}")
+                    continue
+                start = health_before[node.url]
+                failed = health["failed"] - start["failed"]
+                forwarded = health["forwarded"] - start["forwarded"]
+                if failed > gates["max_failure_ratio"] * max(failed + forwarded, 1):
+                    failures[node.url].append(f"{failed:.0f} failed forwards out of {failed + forwarded:.0f} packets")
+                if start["packet_rate"] >= gates["min_rate"] and health["packet_rate"] < gates["min_rate_ratio"] * start["packet_rate"]:
+                    failures[node.url].append(f"packet rate {start['packet_rate']} -> {health['packet_rate']} pps")
+
+        for url, diff in (await self.diff(pushed)).items():
+            if diff:
+                failures[url].append(f"not converged: {json.dumps(diff)}")
+
+        if any(failures.values()):
+            await self.rollback(pushed, before)
+
+        return {url: reasons for url, reasons in failures.items() if reasons}
+
+    async def apply(self, waves=None, gates=None) -> bool:
+        """
+        Roll the desired state out wave by wave, stops at the first wave with a failure (rolled back)
+        """
+        waves = parse_waves(self.state["waves"] if waves is None else waves, len(self.nodes))
+        gates = {**self.state["gates"], **(gates or {})}
+
+        start = time.perf_counter()
+        for i, wave in enumerate(waves):
+            nodes = [self.nodes[j] for j in wave]
+            wave_start = time.perf_counter()
+            failures = await self.apply_wave(nodes, gates)
+            logging.info(f"Wave {i + 1}/{len(waves)}: {len(nodes)} nodes in {time.perf_counter() - wave_start:.3f} s" + (f", failures: {json.dumps(failures)}" if failures else ""))
+            if failures:
+                logging.error(f"Wave {i + 1}/{len(waves)} failed on {len(failures)} nodes, stopping")
+                return False
+
+        logging.info(f"{len(self.nodes)} nodes converged in {time.perf_counter() - start:.3f} s")
+        return True
+
+    def close(self):
+        for node in self.nodes:
+            node.close()
+
+
+async def main(args) -> int:
+    fleet = Fleet(load_state(args.state), args.connections, args.timeout)
+    try:
+        if args.command == "diff":
+            diff = await fleet.diff()
+            print(json.dumps(diff, indent=2))
+            return 1 if any(diff.values()) else 0
+
+        gates = {key: value for key, value in [("settle", args.settle), ("max_failure_ratio", args.max_failure_ratio), ("min_rate_ratio", args.min_rate_ratio)] if value is not None}
+        return 0 if await fleet.apply(args.waves, gates) else 1
+    finally:
+        fleet.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='[%(asctime)s,%(msecs)d] [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Bring the services of xdp_lb.py nodes to a desired state, in waves with health gates")
+    parser.add_argument("state", help="desired state json file (see fleet.example.json)")
+    parser.add_argument("command", choices=["diff", "apply"], help="diff: print what differs on each node, apply: roll out the desired state")
+    parser.add_argument("--waves", default=None, help="cumulative wave sizes, nodes or percentages (1,25%%,100%%), overrides the state file")
+    parser.add_argument("--settle", type=float, default=None, help="seconds before the health gates of a wave, 0 to skip them")
+    parser.add_argument("--max-failure-ratio", type=float, default=None, help="largest share of failed forwards while settling")
+    parser.add_argument("--min-rate-ratio", type=float, default=None, help="lowest packet rate after a change, relative to before")
+    parser.add_argument("--connections", type=int, default=4, help="HTTP connections per node")
+    parser.add_argument("--timeout", type=float, default=2.0, help="seconds per request")
+
+    sys.exit(asyncio.run(main(parser.parse_args())))
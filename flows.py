@@ -0,0 +1,312 @@
+import socket
+import struct
+import threading
+
+import numpy as np
+
+# Key of a heavy hitter, two words so that a UDP 5-tuple fits
+KEY_DTYPE = np.dtype([("hi", np.uint64), ("lo", np.uint64)])
+
+# Where the packets of a key went, from its last sample (network byte order)
+INFO_DTYPE = np.dtype([("backend_ip", np.uint32), ("backend_port", np.uint16), ("service_id", np.uint16), ("cpu", np.uint16)])
+
+# Columns of the counts: estimated packets and bytes
+PACKETS = 0
+BYTES = 1
+
+
+def _mix64(x: np.ndarray) -> np.ndarray:
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def _ip(addr) -> str:
+    return socket.inet_ntoa(struct.pack("I", int(addr)))
+
+
+def _port(port) -> int:
+    return socket.ntohs(int(port))
+
+
+def _keys(hi, lo) -> np.ndarray:
+    keys = np.empty(len(hi), dtype=KEY_DTYPE)
+    keys["hi"] = hi
+    keys["lo"] = lo
+    return keys
+
+
+def _u64(values) -> np.ndarray:
+    return values.astype(np.uint64)
+
+
+# Dimensions the samples are aggregated over: key of each sample, fields of a key
+DIMENSIONS = {
+    "flow": (
+        lambda s: _keys(_u64(s["saddr"]) << np.uint64(32) | _u64(s["daddr"]),
+                        _u64(s["sport"]) << np.uint64(24) | _u64(s["dport"]) << np.uint64(8) | _u64(s["proto"])),
+        lambda hi, lo: {
+            "source": f"{_ip(hi >> 32)}:{_port(lo >> 24 & 0xffff)}",
+            "destination": f"{_ip(hi & 0xffffffff)}:{_port(lo >> 8 & 0xffff)}",
+            "protocol": lo & 0xff,
+        },
+    ),
+    "source": (
+        lambda s: _keys(np.zeros(len(s), dtype=np.uint64), _u64(s["saddr"])),
+        lambda hi, lo: {"source": _ip(lo)},
+    ),
+    "destination": (
+        lambda s: _keys(_u64(s["daddr"]), _u64(s["dport"])),
+        lambda hi, lo: {"destination": f"{_ip(hi)}:{_port(lo)}"},
+    ),
+    "backend": (
+        lambda s: _keys(_u64(s["backend_ip"]), _u64(s["backend_port"])),
+        lambda hi, lo: {"backend": f"{_ip(hi)}:{_port(lo)}"},
+    ),
+}
+
+
+class CountMinSketch:
+    """
+    Packets and bytes of keys in depth rows of width counters, a key is counted in one counter per row (one hash per
+    row). The estimate of a key is the minimum of its counters: never below its true count, and above it by at most
+    e / width of the total with probability 1 - exp(-depth). Sketches of the same shape add up
+    """
+
+    def __init__(self, width: int, depth: int):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width, 2), dtype=np.int64)
+        self.seeds = _mix64(np.arange(1, depth + 1, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+
+    def columns(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Counter of each key in each row, a matrix (depth x keys)
+        """
+        h = _mix64(keys["hi"] ^ _mix64(keys["lo"]))
+        return (_mix64(h[None, :] ^ self.seeds[:, None]) % np.uint64(self.width)).astype(np.int64)
+
+    def add(self, keys: np.ndarray, counts: np.ndarray):
+        columns = self.columns(keys)
+        for row in range(self.depth):
+            np.add.at(self.table[row], columns[row], counts)
+
+    def estimate(self, keys: np.ndarray, table: np.ndarray = None) -> np.ndarray:
+        """
+        Estimated packets and bytes of keys (keys x 2), from this sketch or from table, a sum of sketches
+        """
+        table = self.table if table is None else table
+        return table[np.arange(self.depth)[:, None], self.columns(keys)].min(axis=0)
+
+    def clear(self):
+        self.table[:] = 0
+
+
+class WindowedHeavyHitters:
+    """
+    Keys with the most packets over a sliding window of `slots` sub-windows of `slot_seconds`. Each sub-window has a
+    count-min sketch and keeps the `capacity` keys with the highest estimates as candidates. Estimates over several
+    sub-windows come from the sum of their sketches, the heavy hitters are found among their candidates. Memory stays
+    slots * (depth * width + capacity) entries whatever the number of distinct keys
+    """
+
+    def __init__(self, capacity: int, width: int, depth: int, slots: int, slot_seconds: float):
+        self.capacity = capacity
+        self.slots = slots
+        self.slot_seconds = slot_seconds
+        self.sketches = [CountMinSketch(width, depth) for _ in range(slots)]
+        self.keys = [np.empty(0, dtype=KEY_DTYPE) for _ in range(slots)]
+        self.info = [np.empty(0, dtype=INFO_DTYPE) for _ in range(slots)]
+        # Sub-window (time // slot_seconds) held by each slot, -1 when empty
+        self.epochs = np.full(slots, -1, dtype=np.int64)
+
+    def epoch(self, now: float) -> int:
+        return int(now // self.slot_seconds)
+
+    def _slot(self, epoch: int) -> int:
+        i = epoch % self.slots
+        if self.epochs[i] != epoch:
+            self.sketches[i].clear()
+            self.keys[i] = np.empty(0, dtype=KEY_DTYPE)
+            self.info[i] = np.empty(0, dtype=INFO_DTYPE)
+            self.epochs[i] = epoch
+        return i
+
+    def add(self, keys: np.ndarray, counts: np.ndarray, info: np.ndarray, now: float):
+        """
+        Count keys (packets and bytes of each, keys x 2) in the sub-window of now, keeping the info of their last sample
+        """
+        if not len(keys):
+            return
+        i = self._slot(self.epoch(now))
+
+        unique, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.ravel()
+        totals = np.zeros((len(unique), 2), dtype=np.int64)
+        np.add.at(totals, inverse, counts)
+        last = np.zeros(len(unique), dtype=np.int64)
+        np.maximum.at(last, inverse, np.arange(len(keys)))
+        self.sketches[i].add(unique, totals)
+
+        # np.unique keeps the first occurrence, new info goes first
+        candidates, first = np.unique(np.concatenate([unique, self.keys[i]]), return_index=True)
+        candidate_info = np.concatenate([info[last], self.info[i]])[first]
+        if len(candidates) > self.capacity:
+            estimates = self.sketches[i].estimate(candidates)[:, PACKETS]
+            top = np.argpartition(-estimates, self.capacity - 1)[:self.capacity]
+            candidates, candidate_info = candidates[top], candidate_info[top]
+
+        self.keys[i] = candidates
+        self.info[i] = candidate_info
+
+    def top(self, n: int, epochs) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The n keys with the most packets over the given sub-windows: keys, info and estimates (keys x 2)
+        """
+        live = sorted((i for i in range(self.slots) if self.epochs[i] in epochs), key=lambda i: -self.epochs[i])
+        if not live:
+            return np.empty(0, dtype=KEY_DTYPE), np.empty(0, dtype=INFO_DTYPE), np.empty((0, 2), dtype=np.int64)
+
+        # Newest sub-window first, for its info
+        candidates, first = np.unique(np.concatenate([self.keys[i] for i in live]), return_index=True)
+        info = np.concatenate([self.info[i] for i in live])[first]
+        estimates = self.sketches[live[0]].estimate(candidates, sum(self.sketches[i].table for i in live))
+
+        order = np.argsort(-estimates[:, PACKETS], kind="stable")[:n]
+        return candidates[order], info[order], estimates[order]
+
+    def window(self, now: float) -> range:
+        """
+        Sub-windows of the sliding window ending at now
+        """
+        epoch = self.epoch(now)
+        return range(epoch - self.slots + 1, epoch + 1)
+
+
+class FlowTelemetry:
+    """
+    Heavy hitters of sampled packet headers (FLOW_SAMPLE_DTYPE) for each dimension: flows (5-tuple), sources,
+    destinations (VIP and port) and backends. A sample stands for sample_rate packets, estimates are in packets.
+    Samples are added by the consumer thread and read by the API
+    """
+
+    def __init__(self, capacity=1024, width=4096, depth=4, slots=6, slot_seconds=10.0):
+        self.dimensions = {name: WindowedHeavyHitters(capacity, width, depth, slots, slot_seconds) for name in DIMENSIONS}
+        self.samples = 0
+        # Last sub-window handed to finished()
+        self.finished_epoch = None
+        self.lock = threading.Lock()
+
+    def add(self, samples: np.ndarray, sample_rate: int, now: float):
+        counts = np.empty((len(samples), 2), dtype=np.int64)
+        counts[:, PACKETS] = sample_rate
+        counts[:, BYTES] = samples["pkt_size"].astype(np.int64) * sample_rate
+
+        info = np.empty(len(samples), dtype=INFO_DTYPE)
+        for field in INFO_DTYPE.names:
+            info[field] = samples[field]
+
+        with self.lock:
+            for name, (keys_of, _) in DIMENSIONS.items():
+                self.dimensions[name].add(keys_of(samples), counts, info, now)
+            self.samples += len(samples)
+
+    def top(self, dimension: str, n: int, now: float) -> list[dict]:
+        """
+        The n keys of dimension with the most packets over the sliding window
+        """
+        heavy_hitters = self.dimensions[dimension]
+        with self.lock:
+            keys, info, estimates = heavy_hitters.top(n, heavy_hitters.window(now))
+
+        describe = DIMENSIONS[dimension][1]
+        return [{
+            **describe(int(key["hi"]), int(key["lo"])),
+            **({"backend": f"{_ip(i['backend_ip'])}:{_port(i['backend_port'])}", "service": int(i["service_id"]), "cpu": int(i["cpu"])} if dimension == "flow" else {}),
+            "packets": int(estimate[PACKETS]),
+            "bytes": int(estimate[BYTES]),
+        } for key, i, estimate in zip(keys, info, estimates)]
+
+    def finished(self, n: int, now: float) -> list[tuple]:
+        """
+        The n top flows of each sub-window finished since the last call: (start, end, keys, info, estimates)
+        """
+        flows = self.dimensions["flow"]
+        epoch = flows.epoch(now)
+        if self.finished_epoch is None:
+            self.finished_epoch = epoch - 1
+
+        windows = []
+        with self.lock:
+            for finished in range(max(self.finished_epoch + 1, epoch - flows.slots + 1), epoch):
+                windows.append((finished * flows.slot_seconds, (finished + 1) * flows.slot_seconds, *flows.top(n, [finished])))
+        self.finished_epoch = epoch - 1
+
+        return windows
+
+
+# IPFIX information elements of the exported flow records (https://www.iana.org/assignments/ipfix): name, id and
+# dtype. Addresses and ports keep the bytes loaded by xdp_prog (network byte order), counters are big endian
+IPFIX_FIELDS = [
+    ("sourceIPv4Address", 8, np.uint32),
+    ("destinationIPv4Address", 12, np.uint32),
+    ("sourceTransportPort", 7, np.uint16),
+    ("destinationTransportPort", 11, np.uint16),
+    ("protocolIdentifier", 4, np.uint8),
+    ("postNATDestinationIPv4Address", 226, np.uint32),
+    ("postNAPTDestinationTransportPort", 228, np.uint16),
+    ("packetDeltaCount", 2, ">u8"),
+    ("octetDeltaCount", 1, ">u8"),
+    ("flowStartMilliseconds", 152, ">u8"),
+    ("flowEndMilliseconds", 153, ">u8"),
+]
+IPFIX_RECORD_DTYPE = np.dtype([(name, dtype) for name, _, dtype in IPFIX_FIELDS])
+
+
+class IpfixExporter:
+    """
+    IPFIX (RFC 7011) over UDP to a collector: flows with their estimated packets and bytes over a sub-window. Every
+    message carries the template, so that a collector can start at any time
+    """
+    VERSION = 10
+    TEMPLATE_SET_ID = 2
+    TEMPLATE_ID = 256
+    # Records per message, within a 1500 bytes MTU
+    MAX_RECORDS = 24
+
+    def __init__(self, collector: str, observation_domain: int = 0):
+        host, port = collector.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.observation_domain = observation_domain
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Data records sent, sequence number of the next message
+        self.sequence = 0
+
+        fields = b"".join(struct.pack("!HH", ie, np.dtype(dtype).itemsize) for _, ie, dtype in IPFIX_FIELDS)
+        record = struct.pack("!HH", self.TEMPLATE_ID, len(IPFIX_FIELDS)) + fields
+        self.template = struct.pack("!HH", self.TEMPLATE_SET_ID, 4 + len(record)) + record
+
+    @staticmethod
+    def records(start: float, end: float, keys: np.ndarray, info: np.ndarray, estimates: np.ndarray) -> np.ndarray:
+        records = np.zeros(len(keys), dtype=IPFIX_RECORD_DTYPE)
+        records["sourceIPv4Address"] = keys["hi"] >> np.uint64(32)
+        records["destinationIPv4Address"] = keys["hi"] & np.uint64(0xffffffff)
+        records["sourceTransportPort"] = keys["lo"] >> np.uint64(24) & np.uint64(0xffff)
+        records["destinationTransportPort"] = keys["lo"] >> np.uint64(8) & np.uint64(0xffff)
+        records["protocolIdentifier"] = keys["lo"] & np.uint64(0xff)
+        records["postNATDestinationIPv4Address"] = info["backend_ip"]
+        records["postNAPTDestinationTransportPort"] = info["backend_port"]
+        records["packetDeltaCount"] = estimates[:, PACKETS]
+        records["octetDeltaCount"] = estimates[:, BYTES]
+        records["flowStartMilliseconds"] = int(start * 1000)
+        records["flowEndMilliseconds"] = int(end * 1000)
+        return records
+
+    def export(self, records: np.ndarray, now: float):
+        for i in range(0, len(records), self.MAX_RECORDS):
+            chunk = records[i:i + self.MAX_RECORDS]
+            data = struct.pack("!HH", self.TEMPLATE_ID, 4 + chunk.nbytes) + chunk.tobytes()
+            header = struct.pack("!HHIII", self.VERSION, 16 + len(self.template) + len(data), int(now), self.sequence, self.observation_domain)
+            self.sock.sendto(header + self.template + data, self.address)
+            self.sequence += len(chunk)
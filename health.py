@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Callable, NamedTuple
+
+
+class HealthCheck(NamedTuple):
+    interval: float   # seconds between probes of a backend
+    timeout: float    # seconds to wait for the response
+    rise: int         # consecutive successes to mark a down backend up
+    fall: int         # consecutive failures to mark an up backend down
+    jitter: float     # +/- fraction of interval, spreads probes of many backends
+    payload: bytes    # sent to the backend
+    response: bytes   # expected prefix of the response, empty accepts any response
+    port: int = 0     # probe port, 0 for the backend port
+
+
+class BackendHealth:
+    def __init__(self):
+        # Backends start up, a new backend takes traffic until it fails `fall` probes
+        self.up = True
+        self.successes = 0
+        self.failures = 0
+        self.rtt = 0.0
+        self.last_check = 0.0
+        self.last_error = ""
+
+
+class ProbeProtocol(asyncio.DatagramProtocol):
+    """
+    One UDP socket for every probe, responses are matched to the pending probe by source address
+    """
+
+    def __init__(self):
+        self.transport = None
+        # Several services can probe the same address
+        self.pending: dict[tuple[str, int], set[asyncio.Future]] = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        for future in self.pending.pop(addr[:2], ()):
+            if not future.done():
+                future.set_result(data)
+
+    def error_received(self, exc):
+        # ICMP port unreachable of a probe, the probe times out
+        logging.debug(f"Health check socket error: {exc}")
+
+
+class HealthChecker:
+    """
+    Probe backends with UDP datagrams from one asyncio task per backend.
+    on_change(service_id) is called from a worker thread each time a backend of the service goes up or down
+    """
+
+    def __init__(self, on_change: Callable[[int], None]):
+        self.on_change = on_change
+        self.checks: dict[int, HealthCheck] = {}
+        self.states: dict[tuple[int, str, int], BackendHealth] = {}
+        self.tasks: dict[tuple[int, str, int], asyncio.Task] = {}
+        self.loop: asyncio.AbstractEventLoop = None
+        self.protocol: ProbeProtocol = None
+        # Services waiting for on_change, many backends going down at once cause a single rebuild
+        self.pending_changes: set[int] = set()
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        _, self.protocol = await self.loop.create_datagram_endpoint(ProbeProtocol, local_addr=("0.0.0.0", 0))
+
+    def set_targets(self, service_id: int, check: HealthCheck, backends: list[tuple[str, int]]):
+        """
+        Probe exactly these backends of the service, can be called from any thread
+        """
+        self.loop.call_soon_threadsafe(self._set_targets, service_id, check, backends)
+
+    def _set_targets(self, service_id, check, backends):
+        self.checks[service_id] = check
+        keys = {(service_id, ip, port) for ip, port in backends}
+
+        for key in [key for key in self.tasks if key[0] == service_id and key not in keys]:
+            self.tasks.pop(key).cancel()
+            self.states.pop(key, None)
+
+        for key in keys - self.tasks.keys():
+            self.states[key] = BackendHealth()
+            self.tasks[key] = self.loop.create_task(self._run(key))
+
+    def is_up(self, service_id: int, ip: str, port: int) -> bool:
+        state = self.states.get((service_id, ip, port))
+        return state is None or state.up
+
+    async def _run(self, key):
+        service_id, ip, port = key
+
+        # Spread the first probes over one interval
+        await asyncio.sleep(random.uniform(0, self.checks[service_id].interval))
+
+        while True:
+            check = self.checks[service_id]
+            ok, rtt, error = await self._probe((ip, check.port or port), check)
+            self._record(key, check, ok, rtt, error)
+
+            await asyncio.sleep(check.interval * (1 + random.uniform(-check.jitter, check.jitter)))
+
+    async def _probe(self, addr, check: HealthCheck):
+        future = self.loop.create_future()
+        self.protocol.pending.setdefault(addr, set()).add(future)
+
+        start = time.perf_counter()
+        try:
+            self.protocol.transport.sendto(check.payload, addr)
+            data = await asyncio.wait_for(future, check.timeout)
+        except asyncio.TimeoutError:
+            return False, 0.0, "timeout"
+        except OSError as e:
+            return False, 0.0, str(e)
+        finally:
+            waiting = self.protocol.pending.get(addr)
+            if waiting:
+                waiting.discard(future)
+                if not waiting:
+                    del self.protocol.pending[addr]
+
+        rtt = time.perf_counter() - start
+        if not data.startswith(check.response):
+            return False, rtt, "unexpected response"
+
+        return True, rtt, ""
+
+    def _record(self, key, check: HealthCheck, ok: bool, rtt: float, error: str):
+        state = self.states.get(key)
+        if state is None:
+            return
+
+        state.last_check = time.time()
+        state.rtt = rtt
+        state.last_error = error
+
+        if ok:
+            state.successes += 1
+            state.failures = 0
+        else:
+            state.failures += 1
+            state.successes = 0
+
+        changed = False
+        if state.up and state.failures >= check.fall:
+            state.up = False
+            changed = True
+        elif not state.up and state.successes >= check.rise:
+            state.up = True
+            changed = True
+
+        if changed:
+            service_id, ip, port = key
+            logging.warning(f"Backend {ip}:{port} of service {service_id} is {'up' if state.up else 'down'} ({error or 'ok'})")
+            # The backend tables are rebuilt off the event loop
+            if service_id not in self.pending_changes:
+                self.pending_changes.add(service_id)
+                self.loop.run_in_executor(None, self._notify, service_id)
+
+    def _notify(self, service_id):
+        # Changes from here on schedule another call, on_change reads the states after this point
+        self.pending_changes.discard(service_id)
+        try:
+            self.on_change(service_id)
+        except Exception as e:
+            logging.exception(e)
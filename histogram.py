@@ -0,0 +1,75 @@
+import numpy as np
+
+# Must match HIST_* in xdp_prog.c
+# Values below HIST_SUB_BUCKETS get their own bucket, then every power of two is split in HIST_SUB_BUCKETS buckets
+HIST_SUB_BITS = 4
+HIST_SUB_BUCKETS = 1 << HIST_SUB_BITS
+HIST_BUCKETS = 512
+
+
+def bucket_bounds(n=HIST_BUCKETS) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Lower (inclusive) and upper (exclusive) value of each bucket
+    """
+    b = np.arange(n, dtype=np.int64)
+    exponent = np.maximum(b // HIST_SUB_BUCKETS - 1, 0)
+    mantissa = np.where(b < HIST_SUB_BUCKETS, b, HIST_SUB_BUCKETS + b % HIST_SUB_BUCKETS)
+
+    low = mantissa.astype(np.float64) * np.exp2(exponent)
+    high = (mantissa + 1).astype(np.float64) * np.exp2(exponent)
+    return low, high
+
+
+def bucket_index(values) -> np.ndarray:
+    """
+    Vectorized copy of hist_bucket() in xdp_prog.c
+    """
+    v = np.asarray(values, dtype=np.uint64)
+    exponent = np.floor(np.log2(np.maximum(v, 1).astype(np.float64))).astype(np.int64)
+    shift = np.maximum(exponent - HIST_SUB_BITS, 0).astype(np.uint64)
+    bucket = (exponent - HIST_SUB_BITS + 1) * HIST_SUB_BUCKETS + ((v >> shift) & np.uint64(HIST_SUB_BUCKETS - 1)).astype(np.int64)
+    bucket = np.where(v < HIST_SUB_BUCKETS, v.astype(np.int64), bucket)
+    return np.minimum(bucket, HIST_BUCKETS - 1)
+
+
+LOW, HIGH = bucket_bounds()
+
+
+def cumulative_counts(counts: np.ndarray, upper_bounds) -> list[float]:
+    """
+    Number of values below each bound, bounds must be powers of two >= HIST_SUB_BUCKETS so they fall on bucket edges
+    """
+    cumulative = np.cumsum(counts)
+    # Last bucket whose upper edge is <= bound
+    edges = np.searchsorted(HIGH, np.asarray(upper_bounds, dtype=np.float64), side="right") - 1
+    return [float(cumulative[e]) if e >= 0 else 0.0 for e in edges]
+
+
+def summarize(counts: np.ndarray, percentiles=(25, 50, 90, 95, 99)) -> dict:
+    """
+    mean, min, max, std and percentiles of the values in a histogram, interpolated inside buckets
+    """
+    total = counts.sum()
+    if total == 0:
+        return {"mean": 0.0, "min": 0.0, "max": 0.0, "std": 0.0, **{f"p{p}": 0.0 for p in percentiles}}
+
+    middle = (LOW + HIGH - 1) / 2
+    mean = float((counts * middle).sum() / total)
+    non_empty = np.flatnonzero(counts)
+
+    summary = {
+        "mean": mean,
+        "min": float(LOW[non_empty[0]]),
+        "max": float(HIGH[non_empty[-1]] - 1),
+        "std": float(np.sqrt((counts * (middle - mean) ** 2).sum() / total)),
+    }
+
+    cumulative = np.cumsum(counts)
+    for p in percentiles:
+        rank = total * p / 100
+        b = int(np.searchsorted(cumulative, rank, side="left"))
+        below = cumulative[b - 1] if b > 0 else 0
+        fraction = (rank - below) / counts[b] if counts[b] else 0.0
+        summary[f"p{p}"] = float(LOW[b] + fraction * (HIGH[b] - LOW[b]))
+
+    return summary
@@ -0,0 +1,125 @@
+import numpy as np
+
+from weights import apportion
+
+# Must match FLOW_HASH_SEED in xdp_prog.c
+FLOW_HASH_SEED = 0x9E3779B9
+
+_OFFSET_SEED = np.uint64(0x2545F4914F6CDD1D)
+_SKIP_SEED = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _splitmix64(x: np.ndarray) -> np.ndarray:
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def backend_keys(ips, ports) -> np.ndarray:
+    """
+    Maglev key of each backend: (ip << 16) | port, both as stored in the backends map (network byte order)
+    """
+    return (np.asarray(ips, dtype=np.uint64) << np.uint64(16)) | np.asarray(ports, dtype=np.uint64)
+
+
+def is_prime(n: int) -> bool:
+    if n < 2:
+        return False
+    return all(n % d for d in range(2, int(n ** 0.5) + 1))
+
+
+def check_table_size(size: int, max_backends: int):
+    """
+    Raise ValueError unless size is a prime larger than max_backends. With another size, the permutation of a backend
+    whose skip shares a factor with size only visits part of the slots, and the table can never be filled
+    """
+    if not is_prime(size):
+        raise ValueError(f"Maglev table size {size} is not a prime (e.g. 4099, 65537)")
+    if size <= max_backends:
+        raise ValueError(f"Maglev table size {size} must be larger than the number of backends ({max_backends})")
+
+
+def permutation_params(keys: np.ndarray, size: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    offset and skip of each backend permutation: slot(j) = (offset + j * skip) % size
+    """
+    with np.errstate(over="ignore"):
+        offset = _splitmix64(keys ^ _OFFSET_SEED) % np.uint64(size)
+        skip = _splitmix64(keys ^ _SKIP_SEED) % np.uint64(size - 1) + np.uint64(1)
+
+    return offset.astype(np.int64), skip.astype(np.int64)
+
+
+def build_maglev_table(keys, size: int, weights=None) -> np.ndarray:
+    """
+    Build a Maglev lookup table of `size` slots (size must be prime), each slot holds a backend index.
+
+    Backends claim their next preferred free slot in turns, one slot per backend per round, so every backend owns
+    size / len(keys) slots (+-1). A round is resolved for all backends at once: when several backends want the same
+    slot, the lowest index wins and the others move on to their next preference.
+    With weights (at least one > 0), each backend stops claiming once it owns its share of the slots (see apportion),
+    backends with weight 0 own none.
+    https://research.google/pubs/maglev-a-fast-and-reliable-software-network-load-balancer/
+    """
+    keys = np.asarray(keys, dtype=np.uint64)
+    check_table_size(size, len(keys))
+    table = np.full(size, -1, dtype=np.int64)
+
+    n = len(keys)
+    if n == 0:
+        return table
+
+    offset, skip = permutation_params(keys, size)
+    next_pref = np.zeros(n, dtype=np.int64)
+    all_backends = np.arange(n)
+    share = np.full(n, size, dtype=np.int64) if weights is None else apportion(weights, size)
+    owned = np.zeros(n, dtype=np.int64)
+    filled = 0
+
+    while filled < size:
+        pending = all_backends[owned < share]
+        while pending.size and filled < size:
+            candidate = (offset[pending] + next_pref[pending] * skip[pending]) % size
+
+            # Skip preferences that are already taken in previous rounds
+            taken = table[candidate] >= 0
+            while taken.any():
+                next_pref[pending[taken]] += 1
+                candidate[taken] = (offset[pending[taken]] + next_pref[pending[taken]] * skip[pending[taken]]) % size
+                taken = table[candidate] >= 0
+
+            # pending is sorted, so the first occurrence of a slot belongs to the lowest backend index
+            _, first = np.unique(candidate, return_index=True)
+            first = np.sort(first)[:size - filled]
+
+            winners = pending[first]
+            table[candidate[first]] = winners
+            next_pref[winners] += 1
+            owned[winners] += 1
+            filled += len(winners)
+
+            lost = np.ones(len(pending), dtype=bool)
+            lost[first] = False
+            pending = pending[lost]
+
+    return table
+
+
+def flow_hash(saddr, daddr, sport, dport, protocol) -> np.ndarray:
+    """
+    Vectorized copy of flow_hash() in xdp_prog.c, inputs are raw header fields as loaded by the XDP program
+    """
+
+    def mix32(h):
+        h = h ^ (h >> np.uint32(16))
+        h = h * np.uint32(0x85EBCA6B)
+        h = h ^ (h >> np.uint32(13))
+        h = h * np.uint32(0xC2B2AE35)
+        return h ^ (h >> np.uint32(16))
+
+    with np.errstate(over="ignore"):
+        h = mix32(np.asarray(saddr, dtype=np.uint32) ^ np.uint32(FLOW_HASH_SEED))
+        h = mix32(h ^ np.asarray(daddr, dtype=np.uint32))
+        h = mix32(h ^ ((np.asarray(sport, dtype=np.uint32) << np.uint32(16)) | np.asarray(dport, dtype=np.uint32)))
+        return mix32(h ^ np.asarray(protocol, dtype=np.uint32))
@@ -0,0 +1,123 @@
+import logging
+import socket
+import threading
+from typing import Callable, Optional
+
+from pyroute2 import IPRoute
+from pyroute2.netlink.rtnl import RTMGRP_IPV4_ROUTE, RTMGRP_NEIGH
+from pyroute2.netlink.rtnl.ndmsg import NUD_FAILED, NUD_INCOMPLETE, NUD_NOARP
+
+# Neighbor states without a usable link layer address
+NUD_UNUSABLE = NUD_FAILED | NUD_INCOMPLETE | NUD_NOARP
+
+# Port of the datagram that makes the kernel resolve a next hop (discard)
+RESOLVE_PORT = 9
+
+
+class NeighborCache:
+    """
+    IPv4 neighbors (ip -> mac) and next hops (destination -> gateway or itself), dumped once from rtnetlink then
+    kept current by RTM_NEWNEIGH/RTM_DELNEIGH/RTM_NEWROUTE/RTM_DELROUTE events from a background thread.
+
+    on_neighbor(ip, mac) is called when the MAC of a neighbor changes, on_route() when any route changes
+    """
+
+    def __init__(self):
+        self.ipr = IPRoute()
+        self.lock = threading.Lock()
+        self.neighbors: dict[str, str] = {}
+        self.next_hops: dict[str, str] = {}
+        self.on_neighbor: Optional[Callable[[str, str], None]] = None
+        self.on_route: Optional[Callable[[], None]] = None
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        for msg in self.ipr.get_neighbours(family=socket.AF_INET):
+            self._update_neighbor(msg)
+
+        logging.info(f"{len(self.neighbors)} neighbors in cache")
+
+    def _update_neighbor(self, msg) -> Optional[tuple[str, Optional[str]]]:
+        """
+        Apply a neighbor message, returns (ip, mac) when the MAC of ip changed (mac None when removed)
+        """
+        ip = msg.get_attr("NDA_DST")
+        mac = msg.get_attr("NDA_LLADDR")
+        if not ip:
+            return None
+
+        if msg.get("event") == "RTM_DELNEIGH" or not mac or msg["state"] & NUD_UNUSABLE:
+            mac = None
+
+        with self.lock:
+            previous = self.neighbors.get(ip)
+            if mac:
+                self.neighbors[ip] = mac
+            else:
+                self.neighbors.pop(ip, None)
+
+        return (ip, mac) if previous != mac else None
+
+    def next_hop(self, ip: str) -> str:
+        """
+        Gateway of the route to ip, or ip itself when it is on link
+        """
+        with self.lock:
+            next_hop = self.next_hops.get(ip)
+        if next_hop:
+            return next_hop
+
+        try:
+            route = self.ipr.route("get", dst=ip)[0]
+            next_hop = route.get_attr("RTA_GATEWAY") or ip
+        except Exception as e:
+            logging.warning(f"No route to {ip}: {e}")
+            return ip
+
+        with self.lock:
+            self.next_hops[ip] = next_hop
+        return next_hop
+
+    def lookup(self, ip: str) -> Optional[str]:
+        """
+        MAC address of the next hop to ip, None until it is resolved
+        """
+        return self.neighbors.get(self.next_hop(ip))
+
+    def resolve(self, ip: str):
+        """
+        Make the kernel resolve the next hop to ip, the result comes back as a RTM_NEWNEIGH event
+        """
+        try:
+            self.sock.sendto(b"", (ip, RESOLVE_PORT))
+        except OSError as e:
+            logging.warning(f"Can not resolve {ip}: {e}")
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        events = IPRoute()
+        events.bind(groups=RTMGRP_NEIGH | RTMGRP_IPV4_ROUTE)
+
+        while True:
+            for msg in events.get():
+                event = msg.get("event")
+
+                if event in ("RTM_NEWNEIGH", "RTM_DELNEIGH") and msg.get("family") == socket.AF_INET:
+                    changed = self._update_neighbor(msg)
+                    if changed and changed[1] and self.on_neighbor:
+                        logging.info(f"Neighbor {changed[0]} is now at {changed[1]}")
+                        self._notify(self.on_neighbor, *changed)
+
+                elif event in ("RTM_NEWROUTE", "RTM_DELROUTE"):
+                    with self.lock:
+                        self.next_hops.clear()
+                    if self.on_route:
+                        self._notify(self.on_route)
+
+    @staticmethod
+    def _notify(callback, *args):
+        try:
+            callback(*args)
+        except Exception as e:
+            logging.exception(e)
@@ -1,6 +1,7 @@
 import ctypes
-from typing import Optional
+from typing import List, Optional
 
+import numpy as np
 from pydantic import BaseModel, Field
 
 
@@ -8,10 +9,24 @@ class Backend(ctypes.Structure):
     _fields_ = [
         ("ip", ctypes.c_uint32),
         ("port", ctypes.c_uint16),
-        ("pad", ctypes.c_uint16),
+        ("tunnel_port", ctypes.c_uint16),
         ("mac", ctypes.c_ubyte * 6),
+        ("weight", ctypes.c_uint16),
     ]
 
+# struct backend_stats_t
+BACKEND_STATS_DTYPE = np.dtype([("packets", np.uint64), ("bytes", np.uint64)])
+
+# struct event
+EVENT_DTYPE = np.dtype([("pkt_size", np.int32), ("time_delta", np.int32)])
+
+# struct flow_sample_t, addresses and ports in network byte order
+FLOW_SAMPLE_DTYPE = np.dtype([
+    ("saddr", np.uint32), ("daddr", np.uint32), ("sport", np.uint16), ("dport", np.uint16),
+    ("backend_ip", np.uint32), ("backend_port", np.uint16), ("pkt_size", np.uint16), ("service_id", np.uint16),
+    ("cpu", np.uint16), ("proto", np.uint8), ("pad", np.uint8, 3),
+])
+
 class BackendRequest(BaseModel):
     ip: str = Field(..., description="Backend IP", example="172.30.0.5")
     port: int = Field(..., description="Backend port", example=8000)
@@ -21,6 +36,85 @@ class BackendRequest(BaseModel):
         example="00:11:22:33:44:55",
         pattern=r"^([0-9a-f]{2}:){5}([0-9a-f]{2})$"
     )
+    tunnel_port: Optional[int] = Field(
+        default=None,
+        ge=1,
+        le=65535,
+        description="GUE destination port of the backend (gue services only). If leave empty, the tunnel port of the service",
+        example=6080
+    )
+    weight: int = Field(default=1, ge=0, le=65535, description="Share of new flows relative to the other backends, 0 to drain", example=1)
+
+
+class BackendWeightRequest(BaseModel):
+    service: int = Field(default=0, description="Service id", example=0)
+    ip: str = Field(..., description="Backend IP", example="172.30.0.5")
+    port: int = Field(..., description="Backend port", example=8000)
+    weight: int = Field(..., ge=0, le=65535, description="Share of new flows relative to the other backends, 0 to drain", example=4)
+
+
+class BackendPatchRequest(BaseModel):
+    add: List[BackendRequest] = Field(default=[], description="Backends to add, or whose MAC address to update")
+    remove: List[BackendRequest] = Field(default=[], description="Backends to remove (ip and port)")
+
+
+class SamplingRequest(BaseModel):
+    rate: int = Field(..., ge=0, description="Send 1 in rate forwarded packets to the event ring buffer, 0 to disable", example=100)
+
+
+class FlowSamplingRequest(BaseModel):
+    rate: int = Field(..., ge=0, description="Sample the headers of 1 in rate forwarded packets for flow telemetry, 0 to disable", example=1000)
+
+
+class RssRequest(BaseModel):
+    cpus: List[int] = Field(..., description="Worker CPUs of the second stage, empty to process packets on the RX CPU", example=[2, 3, 4, 5])
+    queue_size: int = Field(default=2048, ge=1, le=16384, description="Packets queued per worker CPU", example=2048)
+
+
+class RateLimitRequest(BaseModel):
+    rate: int = Field(..., ge=0, le=10**9, description="Packets per second of each source (or source prefix), 0 to disable the limiter", example=1000)
+    burst: int = Field(default=0, ge=0, le=10**9, description="Packets a source can send at once, 0 for one second of rate", example=2000)
+    prefix: int = Field(default=32, ge=0, le=32, description="Length of the source prefixes sharing a bucket: 32 per address, 24 per /24", example=32)
+    allow: List[str] = Field(default=[], description="Source prefixes never rate limited", example=["10.0.0.0/8"])
+    deny: List[str] = Field(default=[], description="Source prefixes dropped", example=["192.0.2.0/24"])
+
+
+# struct rtnl_link_stats64, include/uapi/linux/if_link.h
+class LinkStats64(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_uint64) for name in [
+        "rx_packets", "tx_packets", "rx_bytes", "tx_bytes", "rx_errors", "tx_errors", "rx_dropped", "tx_dropped",
+        "multicast", "collisions", "rx_length_errors", "rx_over_errors", "rx_crc_errors", "rx_frame_errors",
+        "rx_fifo_errors", "rx_missed_errors", "tx_aborted_errors", "tx_carrier_errors", "tx_fifo_errors",
+        "tx_heartbeat_errors", "tx_window_errors", "rx_compressed", "tx_compressed", "rx_nohandler",
+        "rx_otherhost_dropped",
+    ]]
+
+
+# struct bpf_cpumap_val, include/uapi/linux/bpf.h. qsize 0 removes the entry
+class CpumapVal(ctypes.Structure):
+    _fields_ = [
+        ("qsize", ctypes.c_uint32),
+        ("prog_fd", ctypes.c_int32),
+    ]
+
+
+# struct conntrack_config_t
+class ConntrackConfig(ctypes.Structure):
+    _fields_ = [
+        ("timeout_ns", ctypes.c_uint64),
+        ("port_min", ctypes.c_uint32),
+        ("port_count", ctypes.c_uint32),
+    ]
+
+
+# struct rate_limit_t
+class RateLimit(ctypes.Structure):
+    _fields_ = [
+        ("cost", ctypes.c_uint64),
+        ("burst", ctypes.c_uint64),
+        ("mask", ctypes.c_uint32),
+        ("lists", ctypes.c_uint32),
+    ]
 
 
 class MacAddr(ctypes.Structure):
@@ -31,7 +125,8 @@ def get_empty_backend():
     return Backend(
         ip=0,
         port=0,
-        pad=0,
-        mac=(ctypes.c_ubyte * 6)(*mac)
+        tunnel_port=0,
+        mac=(ctypes.c_ubyte * 6)(*mac),
+        weight=0
     )
 
@@ -0,0 +1,248 @@
+import struct
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator
+
+import numpy as np
+
+# Bytes of each packet kept for the simulator: ethernet, IPv4 and UDP headers (xdp_prog reads nothing further)
+HEADER_SIZE = 42
+
+# Link types, https://www.tcpdump.org/linktypes.html
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+
+ETH_HLEN = 14
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86DD
+
+PCAP_MAGIC_US = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_IDB = 1
+PCAPNG_SPB = 3
+PCAPNG_EPB = 6
+PCAPNG_OPT_IF_TSRESOL = 9
+
+READ_SIZE = 64 * 1024 * 1024
+
+
+@dataclass
+class PacketChunk:
+    """
+    Packets of a capture as seen by the XDP program of an ethernet interface, one row per packet
+    """
+    time_ns: np.ndarray   # int64, capture timestamp
+    length: np.ndarray    # int64, frame length (ctx->data_end - ctx->data)
+    caplen: np.ndarray    # int64, bytes of headers actually captured, at most HEADER_SIZE
+    headers: np.ndarray   # uint8 (n, HEADER_SIZE), first bytes of the frame, zero padded
+
+    def __len__(self):
+        return len(self.length)
+
+
+class _Packets:
+    """
+    Packets of a buffer being parsed: frame offset in the buffer, captured and original lengths, link type. Lists
+    appended to one packet at a time, or arrays
+    """
+
+    def __init__(self):
+        self.time_ns, self.offset, self.incl, self.orig, self.linktype = [], [], [], [], []
+
+    def append(self, time_ns, offset, incl, orig, linktype):
+        self.time_ns.append(time_ns)
+        self.offset.append(offset)
+        self.incl.append(incl)
+        self.orig.append(orig)
+        self.linktype.append(linktype)
+
+    def __len__(self):
+        return len(self.offset)
+
+    def chunk(self, buf: bytes) -> PacketChunk:
+        data = np.frombuffer(buf, dtype=np.uint8)
+        offset = np.asarray(self.offset, dtype=np.int64)
+        incl = np.asarray(self.incl, dtype=np.int64)
+        orig = np.asarray(self.orig, dtype=np.int64)
+        linktype = np.asarray(self.linktype, dtype=np.int64)
+        n = len(offset)
+
+        # Link layer header length, replaced by an ethernet header of the same protocol
+        l2_len = np.select([linktype == LINKTYPE_ETHERNET, linktype == LINKTYPE_LINUX_SLL], [ETH_HLEN, 16], 0)
+        headers = np.zeros((n, HEADER_SIZE), dtype=np.uint8)
+
+        is_eth = linktype == LINKTYPE_ETHERNET
+        l3_start = np.where(is_eth, 0, ETH_HLEN)
+        copied = np.clip(np.where(is_eth, incl, incl - l2_len + ETH_HLEN), 0, HEADER_SIZE)
+
+        # Gather the first bytes of every frame at once
+        columns = np.arange(HEADER_SIZE)
+        valid = (columns >= l3_start[:, None]) & (columns < copied[:, None])
+        source = offset[:, None] + np.where(is_eth, 0, l2_len - ETH_HLEN)[:, None] + columns
+        headers[valid] = data[np.minimum(source, len(data) - 1)[valid]]
+
+        # Protocol of the synthesized ethernet header
+        sll = linktype == LINKTYPE_LINUX_SLL
+        if sll.any():
+            protocol = data[np.minimum(offset[sll] + 14, len(data) - 1)].astype(np.uint16) << 8 | data[np.minimum(offset[sll] + 15, len(data) - 1)]
+            headers[sll, 12], headers[sll, 13] = protocol >> 8, protocol & 0xff
+        raw = (linktype == LINKTYPE_RAW) | (linktype == LINKTYPE_IPV4)
+        if raw.any():
+            version = headers[raw, ETH_HLEN] >> 4
+            protocol = np.where(version == 6, ETH_P_IPV6, ETH_P_IP)
+            headers[raw, 12], headers[raw, 13] = protocol >> 8, protocol & 0xff
+
+        return PacketChunk(
+            time_ns=np.asarray(self.time_ns, dtype=np.int64),
+            length=orig + np.where(is_eth, 0, ETH_HLEN - l2_len),
+            caplen=copied,
+            headers=headers,
+        )
+
+
+def _check_linktype(linktype):
+    if linktype not in (LINKTYPE_ETHERNET, LINKTYPE_RAW, LINKTYPE_LINUX_SLL, LINKTYPE_IPV4):
+        raise ValueError(f"Unsupported link type {linktype}, expected ethernet, raw IP or Linux cooked capture")
+
+
+def _pcap_records(f: BinaryIO, header: bytes, chunk_packets: int) -> Iterator[PacketChunk]:
+    magic = struct.unpack("<I", header[:4])[0]
+    endian = "<" if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS) else ">"
+    magic = struct.unpack(endian + "I", header[:4])[0]
+    scale = 1 if magic == PCAP_MAGIC_NS else 1000
+    linktype = struct.unpack(endian + "I", header[20:24])[0] & 0xFFFF
+    _check_linktype(linktype)
+    incl_len = struct.Struct(endian + "I")
+    record_dtype = np.dtype(endian + "u4")
+
+    def chunk(buf, offsets):
+        # Record headers of all packets at once: ts_sec, ts_usec (or ts_nsec), incl_len, orig_len
+        offsets = np.array(offsets, dtype=np.int64)
+        records = np.frombuffer(buf, dtype=np.uint8)[offsets[:, None] + np.arange(16)].copy().view(record_dtype).astype(np.int64)
+        packets = _Packets()
+        packets.time_ns = records[:, 0] * 1_000_000_000 + records[:, 1] * scale
+        packets.offset = offsets + 16
+        packets.incl, packets.orig = records[:, 2], records[:, 3]
+        packets.linktype = np.full(len(offsets), linktype)
+        return packets.chunk(buf)
+
+    buf = b""
+    pos = 0
+    while True:
+        data = f.read(READ_SIZE)
+        buf = buf[pos:] + data
+        pos = 0
+        end = len(buf)
+        offsets = []
+        # Only the walk from record to record is sequential
+        while pos + 16 <= end:
+            next_pos = pos + 16 + incl_len.unpack_from(buf, pos + 8)[0]
+            if next_pos > end:
+                break
+            offsets.append(pos)
+            pos = next_pos
+
+            if len(offsets) == chunk_packets:
+                yield chunk(buf, offsets)
+                offsets = []
+
+        if offsets:
+            yield chunk(buf, offsets)
+        if not data:
+            return
+
+
+def _pcapng_records(f: BinaryIO, header: bytes, chunk_packets: int) -> Iterator[PacketChunk]:
+    endian = "<"
+    # (link type, ns per timestamp unit) of each interface of the current section
+    interfaces = []
+
+    buf = header
+    pos = 0
+    while True:
+        data = f.read(READ_SIZE)
+        buf = buf[pos:] + data
+        pos = 0
+        packets = _Packets()
+
+        while pos + 12 <= len(buf):
+            block_type = struct.unpack_from(endian + "I", buf, pos)[0]
+            if block_type == PCAPNG_SHB:
+                endian = "<" if struct.unpack_from("<I", buf, pos + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC else ">"
+                interfaces = []
+            block_len = struct.unpack_from(endian + "I", buf, pos + 4)[0]
+            if block_len < 12 or pos + block_len > len(buf):
+                break
+            body = pos + 8
+
+            if block_type == PCAPNG_IDB:
+                linktype = struct.unpack_from(endian + "H", buf, body)[0]
+                interfaces.append((linktype, _pcapng_ts_unit(buf, body + 8, pos + block_len - 4, endian)))
+            elif block_type == PCAPNG_EPB:
+                interface, ts_high, ts_low, incl, orig = struct.unpack_from(endian + "IIIII", buf, body)
+                linktype, unit = interfaces[interface]
+                _check_linktype(linktype)
+                packets.append(int(((ts_high << 32) | ts_low) * unit), body + 20, incl, orig, linktype)
+            elif block_type == PCAPNG_SPB:
+                orig = struct.unpack_from(endian + "I", buf, body)[0]
+                linktype, _ = interfaces[0]
+                _check_linktype(linktype)
+                packets.append(0, body + 4, min(orig, block_len - 16), orig, linktype)
+            pos += block_len
+
+            if len(packets) == chunk_packets:
+                yield packets.chunk(buf)
+                packets = _Packets()
+
+        if len(packets):
+            yield packets.chunk(buf)
+        if not data:
+            return
+
+
+def _pcapng_ts_unit(buf: bytes, start: int, end: int, endian: str) -> float:
+    """
+    ns per timestamp unit of an interface, from its if_tsresol option (microseconds by default)
+    """
+    while start + 4 <= end:
+        code, length = struct.unpack_from(endian + "HH", buf, start)
+        if code == 0:
+            break
+        if code == PCAPNG_OPT_IF_TSRESOL and length >= 1:
+            resolution = buf[start + 4]
+            return 1e9 / (2 ** (resolution & 0x7F) if resolution & 0x80 else 10 ** resolution)
+        start += 4 + (length + 3) // 4 * 4
+    return 1000.0
+
+
+def read_chunks(path: str, chunk_packets: int = 1_000_000) -> Iterator[PacketChunk]:
+    """
+    Stream a pcap or pcapng capture in chunks of at most chunk_packets packets
+    """
+    with open(path, "rb") as f:
+        header = f.read(24)
+        if len(header) < 24:
+            raise ValueError(f"{path} is not a pcap or pcapng capture")
+
+        magic = struct.unpack("<I", header[:4])[0]
+        if magic == PCAPNG_SHB:
+            yield from _pcapng_records(f, header, chunk_packets)
+        elif magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS) or struct.unpack(">I", header[:4])[0] in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            yield from _pcap_records(f, header, chunk_packets)
+        else:
+            raise ValueError(f"{path} is not a pcap or pcapng capture")
+
+
+def write_pcap(path: str, frames: list[bytes], times_ns: list[int] = None):
+    """
+    Write ethernet frames to a classic pcap file (nanosecond timestamps)
+    """
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IHHiIII", PCAP_MAGIC_NS, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET))
+        for i, frame in enumerate(frames):
+            t = times_ns[i] if times_ns else i * 1000
+            f.write(struct.pack("<IIII", t // 1_000_000_000, t % 1_000_000_000, len(frame), len(frame)))
+            f.write(frame)
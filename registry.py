@@ -0,0 +1,89 @@
+import socket
+import struct
+from typing import Iterable
+
+from object import Backend
+
+# (ip, port) of a backend
+BackendKey = tuple[str, int]
+
+
+def backend_key(backend: Backend) -> BackendKey:
+    return socket.inet_ntoa(struct.pack("I", backend.ip)), socket.ntohs(backend.port)
+
+
+class BackendRegistry:
+    """
+    Declared backends of one service keyed by (ip, port), in insertion order.
+    Source of truth of the control plane, the XDP tables are derived from it and never read back
+    """
+
+    def __init__(self, backends: Iterable[Backend] = ()):
+        self.backends: dict[BackendKey, Backend] = {}
+        self.add(backends)
+
+    def add(self, backends: Iterable[Backend]):
+        """
+        Add backends, or update the MAC of the ones already declared
+        """
+        for backend in backends:
+            self.backends[backend_key(backend)] = backend
+
+    def remove(self, keys: Iterable[BackendKey]) -> int:
+        """
+        Remove backends, unknown keys are ignored. Returns the number of backends removed
+        """
+        return sum(self.backends.pop(key, None) is not None for key in keys)
+
+    def set_weights(self, weights: dict[BackendKey, int]) -> list[BackendKey]:
+        """
+        Set the weight of declared backends, returns the keys that are not declared
+        """
+        for key, weight in weights.items():
+            if key in self.backends:
+                # Copies share the Backend objects, replace it
+                backend = Backend.from_buffer_copy(self.backends[key])
+                backend.weight = weight
+                self.backends[key] = backend
+        return [key for key in weights if key not in self.backends]
+
+    def copy(self):
+        registry = BackendRegistry()
+        registry.backends = dict(self.backends)
+        return registry
+
+    def __contains__(self, key: BackendKey):
+        return key in self.backends
+
+    def __iter__(self):
+        return iter(self.backends.values())
+
+    def __len__(self):
+        return len(self.backends)
+
+
+def layout_slots(current: list[BackendKey], desired: list[BackendKey]) -> list[BackendKey]:
+    """
+    Slots of the desired backends, given the current slots. Backends still desired keep their slot, new backends take
+    the freed slots first and then go at the end, remaining holes are filled with the last slots so the table stays
+    contiguous. A change of k backends moves at most 2k slots
+    """
+    desired_set = set(desired)
+    current_set = set(current)
+    new = iter([key for key in desired if key not in current_set])
+
+    slots = [key if key in desired_set else next(new, None) for key in current]
+    slots.extend(new)
+
+    # Move the last backends into the holes
+    while slots and slots[-1] is None:
+        slots.pop()
+    for i in range(len(slots)):
+        if i >= len(slots):
+            break
+        if slots[i] is None:
+            slots[i] = slots.pop()
+            while slots and slots[-1] is None:
+                slots.pop()
+
+    return slots
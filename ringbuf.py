@@ -0,0 +1,117 @@
+import mmap
+import select
+
+import numpy as np
+
+# include/uapi/linux/bpf.h
+BPF_RINGBUF_BUSY_BIT = 1 << 31
+BPF_RINGBUF_DISCARD_BIT = 1 << 30
+BPF_RINGBUF_HDR_SZ = 8
+
+
+class RingBufferConsumer:
+    """
+    Consume a BPF_RINGBUF_OUTPUT map of fixed-size records straight from its mmapped memory.
+
+    The data pages are mapped twice back to back by the kernel, so the records between consumer_pos and producer_pos
+    are always contiguous: they are read as one NumPy structured array view and copied in a single operation into
+    a preallocated circular buffer of `capacity` events. No Python object is created per record.
+    """
+
+    def __init__(self, consumer_page, producer_pages, size: int, dtype: np.dtype, capacity: int):
+        self.size = size
+        self.mask = size - 1
+        self.dtype = np.dtype(dtype)
+
+        # Header (u32 len, u32 pg_off) then the event, rounded up to 8 bytes
+        self.record_size = (BPF_RINGBUF_HDR_SZ + self.dtype.itemsize + 7) & ~7
+        self.record_dtype = np.dtype({
+            "names": ["len", "pg_off", "event"],
+            "formats": [np.uint32, np.uint32, self.dtype],
+            "offsets": [0, 4, BPF_RINGBUF_HDR_SZ],
+            "itemsize": self.record_size,
+        })
+
+        self.consumer_pos = np.frombuffer(consumer_page, dtype=np.uint64, count=1)
+        self.producer_pos = np.frombuffer(producer_pages, dtype=np.uint64, count=1)
+        self.data = np.frombuffer(producer_pages, dtype=np.uint8, offset=mmap.PAGESIZE)
+
+        self.capacity = capacity
+        self.events = np.zeros(capacity, dtype=self.dtype)
+        # Number of events ever written to self.events
+        self.total = 0
+
+        self._mmaps = (consumer_page, producer_pages)
+        self._epoll = None
+
+    @classmethod
+    def from_map_fd(cls, map_fd: int, size: int, dtype: np.dtype, capacity: int):
+        # Page 0: consumer position (read-write). Page 1: producer position, then the data pages mapped twice (read-only)
+        consumer_page = mmap.mmap(map_fd, mmap.PAGESIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE, offset=0)
+        producer_pages = mmap.mmap(map_fd, mmap.PAGESIZE + 2 * size, mmap.MAP_SHARED, mmap.PROT_READ, offset=mmap.PAGESIZE)
+
+        consumer = cls(consumer_page, producer_pages, size, dtype, capacity)
+        consumer._epoll = select.epoll()
+        consumer._epoll.register(map_fd, select.EPOLLIN)
+        return consumer
+
+    def poll(self, timeout: float) -> bool:
+        """
+        Wait until the kernel signals new data or timeout (seconds) expires
+        """
+        if self._epoll is None:
+            return True
+
+        return len(self._epoll.poll(timeout)) > 0
+
+    def consume(self) -> int:
+        """
+        Move every committed record to the circular buffer, returns the number of events consumed
+        """
+        consumer = int(self.consumer_pos[0])
+        producer = int(self.producer_pos[0])
+
+        n = (producer - consumer) // self.record_size
+        if n == 0:
+            return 0
+
+        offset = consumer & self.mask
+        records = self.data[offset:offset + n * self.record_size].view(self.record_dtype)
+
+        # Records are committed out of order across CPUs, stop at the first one still being written
+        lengths = records["len"]
+        busy = np.flatnonzero(lengths & BPF_RINGBUF_BUSY_BIT)
+        if busy.size:
+            n = int(busy[0])
+            records = records[:n]
+            lengths = lengths[:n]
+
+        if n == 0:
+            return 0
+
+        if np.any((lengths & ~np.uint32(BPF_RINGBUF_BUSY_BIT | BPF_RINGBUF_DISCARD_BIT)) != self.dtype.itemsize):
+            raise ValueError(f"Ring buffer records are not {self.dtype.itemsize} bytes events")
+
+        events = records["event"][(lengths & BPF_RINGBUF_DISCARD_BIT) == 0]
+        self._push(events)
+
+        # Release the space to the producers
+        self.consumer_pos[0] = consumer + n * self.record_size
+
+        return len(events)
+
+    def _push(self, events: np.ndarray):
+        if len(events) > self.capacity:
+            self.total += len(events) - self.capacity
+            events = events[-self.capacity:]
+
+        index = (self.total + np.arange(len(events))) % self.capacity
+        self.events[index] = events
+        self.total += len(events)
+
+    def latest(self, n: int) -> np.ndarray:
+        """
+        Copy of the last n events, oldest first
+        """
+        n = min(n, self.total, self.capacity)
+        return self.events[(self.total - n + np.arange(n)) % self.capacity]
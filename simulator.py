@@ -0,0 +1,528 @@
+import argparse
+import json
+import os
+import socket
+import struct
+import sys
+
+import numpy as np
+
+import maglev
+from pcap import ETH_P_IP, PacketChunk, read_chunks
+from weights import equal_weights, weighted_round_robin
+
+# Must match VERDICT_* in xdp_prog.c, same order as config.verdict_reasons
+VERDICT_REASONS = [
+    "forward", "icmp_echo", "short_packet", "not_ipv4", "not_vip", "icmp_not_echo", "not_udp", "no_service",
+    "no_backends", "bad_backend", "map_lookup", "no_lb_mac", "cpu_redirect", "reply", "no_nat_port", "encap_failed",
+    "rate_limited", "denied", "encap_too_big",
+]
+VERDICT_FORWARD = 0
+VERDICT_ICMP_ECHO = 1
+VERDICT_SHORT_PACKET = 2
+VERDICT_NOT_IPV4 = 3
+VERDICT_NOT_VIP = 4
+VERDICT_ICMP_NOT_ECHO = 5
+VERDICT_NOT_UDP = 6
+VERDICT_NO_SERVICE = 7
+VERDICT_NO_BACKENDS = 8
+VERDICT_CPU_REDIRECT = 12
+# Not a verdict of xdp_prog: the capture is cut before a header the program reads (snaplen)
+VERDICT_TRUNCATED = len(VERDICT_REASONS)
+
+XDP_ACTIONS = ["XDP_ABORTED", "XDP_DROP", "XDP_PASS", "XDP_TX", "XDP_REDIRECT"]
+XDP_PASS = 2
+XDP_TX = 3
+XDP_REDIRECT = 4
+
+ICMP_ECHO = 8
+
+RSS_MODELS = ["none", "toeplitz", "software"]
+
+# Key of the Microsoft RSS verification suite, the default of many drivers (others pick a random one at boot)
+TOEPLITZ_KEY = bytes.fromhex("6d5a56da255b0ec24167253d43a38fb0d0ca2bcbae7b30b477cb2da38030f20c6a42b73bbeac01fa")
+RSS_INDIR_SIZE = 128
+
+
+def ip_to_int(ip: str) -> int:
+    return struct.unpack("I", socket.inet_aton(ip))[0]
+
+
+def load_services(path: str) -> list[dict]:
+    """
+    Services of a SERVICES_FILE (see services.example.json), backends as (ip, port, weight)
+    """
+    with open(path) as f:
+        declared = json.load(f)
+
+    services = []
+    for i, service in enumerate(declared):
+        backends = service.get("backends", [])
+        if isinstance(backends, str):
+            backends = backends.split(",")
+        services.append({
+            "id": i,
+            "name": service.get("name", f"service-{i}"),
+            "vip": service["vip"],
+            "ports": [int(port) for port in service["ports"]],
+            "backends": [parse_backend(backend) for backend in backends],
+            "forwarding": service.get("forwarding", ""),
+        })
+    return services
+
+
+def parse_backend(s: str) -> tuple[str, int, int]:
+    """
+    ip:port or ip:port@weight (config.BACKENDS syntax)
+    """
+    address, _, weight = s.strip().partition("@")
+    host, port = address.rsplit(":", 1)
+    return host, int(port), int(weight or 1)
+
+
+def backend_weights(backends) -> list[int] | None:
+    """
+    Weights of (ip, port[, weight]) backends as xdp_lb.py applies them: None when they do not change the selection,
+    all 1 when every backend is drained
+    """
+    weights = [backend[2] if len(backend) > 2 else 1 for backend in backends]
+    if backends and not any(weights):
+        weights = [1] * len(backends)
+    return None if equal_weights(weights) else weights
+
+
+def toeplitz_hash(data: np.ndarray, key: bytes = TOEPLITZ_KEY) -> np.ndarray:
+    """
+    Toeplitz hash of each row of data (uint8, network byte order) as computed by NICs for RSS
+    """
+    key_int = int.from_bytes(key, "big")
+    key_bits = len(key) * 8
+
+    h = np.zeros(len(data), dtype=np.uint32)
+    for j in range(data.shape[1]):
+        # XOR of the 32 bit key windows of the bits set in each byte value, at byte position j
+        windows = np.array([(key_int >> (key_bits - 32 - (8 * j + b))) & 0xFFFFFFFF for b in range(8)], dtype=np.uint32)
+        bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(bool)
+        table = np.bitwise_xor.reduce(np.where(bits, windows, np.uint32(0)), axis=1)
+        h ^= table[data[:, j]]
+    return h
+
+
+class FlowSet:
+    """
+    Distinct flows seen over chunks, with a flag per flow (set if any of its packets had it)
+    """
+
+    DTYPE = np.dtype([("addrs", np.uint64), ("ports", np.uint32)])
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=self.DTYPE)
+        self.flags = np.empty(0, dtype=bool)
+
+    def add(self, keys: np.ndarray, flags: np.ndarray):
+        keys = np.concatenate([self.keys, keys])
+        flags = np.concatenate([self.flags, flags])
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.flags = np.zeros(len(self.keys), dtype=bool)
+        np.logical_or.at(self.flags, inverse.ravel(), flags)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class Simulator:
+    """
+    Decisions of xdp_prog on captured packets, vectorized over chunks of packets: filtering, ICMP echo, service
+    lookup, backend selection with the per CPU packet counter of round robin under an RSS model, and conntrack
+    stickiness. Assumes one ingress interface with its LB MAC set, an empty conntrack (replies of backends are not
+    recognized) and flows expiring exactly after conntrack_timeout_ns (xdp_prog refreshes them once per second)
+    """
+
+    def __init__(self, services: list[dict], lb_algorithm="round_robin", maglev_table_size=4099, rss="none", cpus=1,
+                 rss_fields=4, conntrack_timeout_ns=0, redirect=False, weighted_rr_size=4096):
+        if rss not in RSS_MODELS:
+            raise ValueError(f"RSS model must be one of {RSS_MODELS}")
+
+        self.services = services
+        self.lb_algorithm = lb_algorithm
+        self.maglev_table_size = maglev_table_size
+        self.rss = rss
+        self.cpus = cpus if rss != "none" else 1
+        self.rss_fields = rss_fields
+        self.conntrack_timeout_ns = conntrack_timeout_ns
+        self.redirect = redirect or rss == "software"
+
+        # Service lookup: sorted (vip << 16 | port) keys, fields as loaded by xdp_prog
+        keys, ids = [], []
+        for service in services:
+            for port in service["ports"]:
+                keys.append((ip_to_int(service["vip"]) << 16) | socket.htons(port))
+                ids.append(service["id"])
+        order = np.argsort(np.array(keys, dtype=np.uint64))
+        self.service_keys = np.array(keys, dtype=np.uint64)[order]
+        self.service_ids = np.array(ids, dtype=np.int64)[order]
+        self.vips = np.array(sorted({ip_to_int(service["vip"]) for service in services}), dtype=np.uint32)
+
+        n = max([service["id"] for service in services], default=-1) + 1
+        self.backend_counts = np.zeros(n, dtype=np.int64)
+        self.tracked = np.zeros(n, dtype=bool)
+        # Backend key (ip << 16 | port, as stored in the backends map) of each service and slot
+        self.backend_keys = np.zeros((n, max([len(service["backends"]) for service in services], default=0) or 1), dtype=np.uint64)
+        self.maglev_tables = np.zeros((n, maglev_table_size), dtype=np.int64)
+        # Weighted round robin sequence of each service, length 0 for plain round robin
+        self.rr_sequences = np.zeros((n, weighted_rr_size), dtype=np.int64)
+        self.rr_lengths = np.zeros(n, dtype=np.int64)
+        for service in services:
+            backends = service["backends"]
+            weights = backend_weights(backends)
+            self.backend_counts[service["id"]] = len(backends)
+            self.tracked[service["id"]] = service.get("forwarding", "") in ("", "nat")
+            keys = maglev.backend_keys([ip_to_int(backend[0]) for backend in backends], [socket.htons(backend[1]) for backend in backends])
+            self.backend_keys[service["id"], :len(backends)] = keys
+            if lb_algorithm == "maglev":
+                self.maglev_tables[service["id"]] = np.maximum(maglev.build_maglev_table(keys, maglev_table_size, weights), 0)
+            elif weights:
+                sequence = weighted_round_robin(weights, weighted_rr_size)
+                self.rr_sequences[service["id"], :len(sequence)] = sequence
+                self.rr_lengths[service["id"]] = len(sequence)
+
+        # Per CPU packet counter of the interface
+        self.counters = np.zeros(self.cpus, dtype=np.int64)
+        # Conntrack flows alive at the end of the last chunk
+        self.flows = np.empty(0, dtype=FlowSet.DTYPE)
+        self.flow_last_seen = np.empty(0, dtype=np.int64)
+        self.flow_index = np.empty(0, dtype=np.int64)
+
+        # Totals
+        self.verdicts = np.zeros((len(VERDICT_REASONS) + 1, len(XDP_ACTIONS)), dtype=np.int64)
+        self.cpu_packets = np.zeros(self.cpus, dtype=np.int64)
+        self.cpu_bytes = np.zeros(self.cpus, dtype=np.int64)
+        self.backend_packets = np.zeros(self.backend_keys.shape, dtype=np.int64)
+        self.backend_bytes = np.zeros(self.backend_keys.shape, dtype=np.int64)
+        self.packets = 0
+        self.bytes = 0
+
+    def rx_cpu(self, fields: dict) -> np.ndarray:
+        """
+        CPU receiving each packet: RX queue of the NIC RSS (toeplitz), CPU 0 otherwise
+        """
+        n = len(fields["saddr"])
+        if self.rss != "toeplitz":
+            return np.zeros(n, dtype=np.int64)
+
+        headers = fields["headers"]
+        udp = fields["ipv4"] & (fields["protocol"] == socket.IPPROTO_UDP) & (self.rss_fields == 4)
+        data = np.zeros((n, 12), dtype=np.uint8)
+        data[:, :8] = headers[:, 26:34]
+        data[udp, 8:] = headers[udp, 34:38]
+        h = toeplitz_hash(data)
+
+        indir = np.arange(RSS_INDIR_SIZE) % self.cpus
+        return np.where(fields["ipv4"], indir[h % RSS_INDIR_SIZE], 0).astype(np.int64)
+
+    @staticmethod
+    def parse(chunk: PacketChunk) -> dict:
+        """
+        Header fields of each packet, as loaded by xdp_prog (network byte order in host integers)
+        """
+        headers = chunk.headers
+
+        def field(start, size, dtype):
+            return np.ascontiguousarray(headers[:, start:start + size]).view(dtype).ravel()
+
+        return {
+            "headers": headers,
+            "ipv4": (headers[:, 12].astype(np.uint16) << 8 | headers[:, 13]) == ETH_P_IP,
+            "protocol": headers[:, 23],
+            "saddr": field(26, 4, np.uint32),
+            "daddr": field(30, 4, np.uint32),
+            "sport": field(34, 2, np.uint16),
+            "dport": field(36, 2, np.uint16),
+            "icmp_type": headers[:, 34],
+        }
+
+    def process(self, chunk: PacketChunk) -> dict:
+        """
+        Run the packets of chunk, returns per packet arrays: reason (VERDICT_*), action, service id, backend slot and
+        backend key (-1 / 0 when not forwarded), CPU of the counter
+        """
+        n = len(chunk)
+        length, caplen = chunk.length, chunk.caplen
+        f = self.parse(chunk)
+
+        reason = np.full(n, -1, dtype=np.int64)
+        action = np.full(n, XDP_PASS, dtype=np.int64)
+
+        def decide(mask, verdict, xdp_action=XDP_PASS):
+            mask = mask & (reason < 0)
+            reason[mask] = verdict
+            action[mask] = xdp_action
+
+        # Checks in the order of xdp_prog, headers beyond the capture length are unknown
+        decide(length < 14, VERDICT_SHORT_PACKET)
+        decide(caplen < 14, VERDICT_TRUNCATED)
+        decide(~f["ipv4"], VERDICT_NOT_IPV4)
+        decide(length < 34, VERDICT_SHORT_PACKET)
+        decide(caplen < 34, VERDICT_TRUNCATED)
+
+        icmp = f["protocol"] == socket.IPPROTO_ICMP
+        decide(icmp & ~np.isin(f["daddr"], self.vips), VERDICT_NOT_VIP)
+        decide(icmp & (length < 42), VERDICT_SHORT_PACKET)
+        decide(icmp & (caplen < 42), VERDICT_TRUNCATED)
+        decide(icmp & (f["icmp_type"] != ICMP_ECHO), VERDICT_ICMP_NOT_ECHO)
+        decide(icmp, VERDICT_ICMP_ECHO, XDP_TX)
+
+        decide(f["protocol"] != socket.IPPROTO_UDP, VERDICT_NOT_UDP)
+        decide(length < 42, VERDICT_SHORT_PACKET)
+        decide(caplen < 42, VERDICT_TRUNCATED)
+
+        # Service lookup
+        service = np.full(n, -1, dtype=np.int64)
+        udp = reason < 0
+        key = (f["daddr"].astype(np.uint64) << np.uint64(16)) | f["dport"].astype(np.uint64)
+        pos = np.minimum(np.searchsorted(self.service_keys, key), max(len(self.service_keys) - 1, 0))
+        found = udp & (len(self.service_keys) > 0)
+        found[found] = self.service_keys[pos[found]] == key[found]
+        service[found] = self.service_ids[pos[found]]
+        decide(udp & ~found, VERDICT_NO_SERVICE)
+
+        # CPU of the packet counter: RX CPU, or the worker CPU picked by flow hash with software RSS
+        flow_hash = maglev.flow_hash(f["saddr"], f["daddr"], f["sport"], f["dport"], f["protocol"])
+        cpu = self.rx_cpu(f)
+        if self.rss == "software":
+            cpu[found] = flow_hash[found] % self.cpus
+            self.verdicts[VERDICT_CPU_REDIRECT, XDP_REDIRECT] += int(found.sum())
+
+        counted = np.flatnonzero(found)
+        pktcnt = self.count(cpu[counted])
+        counts = self.backend_counts[service[counted]]
+        no_backends = np.zeros(n, dtype=bool)
+        no_backends[counted[counts == 0]] = True
+        decide(no_backends, VERDICT_NO_BACKENDS)
+
+        # Backend selection
+        has_backends = counts > 0
+        selected, svc, pktcnt, counts = counted[has_backends], service[counted[has_backends]], pktcnt[has_backends], counts[has_backends]
+        if self.lb_algorithm == "maglev":
+            index = self.maglev_tables[svc, flow_hash[selected] % self.maglev_table_size]
+        else:
+            lengths = self.rr_lengths[svc]
+            index = np.where(lengths > 0, self.rr_sequences[svc, pktcnt % np.maximum(lengths, 1)], pktcnt % counts)
+
+        if self.conntrack_timeout_ns:
+            tracked = self.tracked[svc]
+            index[tracked] = self.sticky(f, selected[tracked], index[tracked], chunk.time_ns[selected[tracked]])
+
+        backend = np.full(n, -1, dtype=np.int64)
+        backend[selected] = index
+        decide(backend >= 0, VERDICT_FORWARD, XDP_REDIRECT if self.redirect else XDP_TX)
+
+        backend_key = np.zeros(n, dtype=np.uint64)
+        backend_key[selected] = self.backend_keys[svc, index]
+
+        # Totals
+        truncated = reason == VERDICT_TRUNCATED
+        np.add.at(self.verdicts, (reason[~truncated], action[~truncated]), 1)
+        self.verdicts[VERDICT_TRUNCATED, XDP_PASS] += int(truncated.sum())
+        self.cpu_packets += np.bincount(cpu, minlength=self.cpus)
+        self.cpu_bytes += np.bincount(cpu, weights=length, minlength=self.cpus).astype(np.int64)
+        np.add.at(self.backend_packets, (svc, index), 1)
+        np.add.at(self.backend_bytes, (svc, index), length[selected])
+        self.packets += n
+        self.bytes += int(length.sum())
+
+        return {"reason": reason, "action": action, "service": service, "backend": backend, "backend_key": backend_key, "cpu": cpu}
+
+    def count(self, cpu: np.ndarray) -> np.ndarray:
+        """
+        Value of the per CPU counter after each increment, packets in order
+        """
+        order = np.argsort(cpu, kind="stable")
+        sorted_cpu = cpu[order]
+        rank = np.arange(len(cpu)) - np.searchsorted(sorted_cpu, sorted_cpu, side="left")
+
+        pktcnt = np.empty(len(cpu), dtype=np.int64)
+        pktcnt[order] = self.counters[sorted_cpu] + rank + 1
+        self.counters += np.bincount(cpu, minlength=self.cpus)
+        return pktcnt
+
+    def sticky(self, f: dict, packets: np.ndarray, index: np.ndarray, time_ns: np.ndarray) -> np.ndarray:
+        """
+        Conntrack: packets of a flow keep the backend picked for the first packet, until the flow is idle for longer
+        than the timeout. Flows alive at the end of the chunk are carried to the next one
+        """
+        keys = flow_keys(f, packets)
+        n_carried = len(self.flows)
+
+        # Carried flows first, as packets at their last seen time that already have a backend
+        all_keys = np.concatenate([self.flows, keys])
+        all_time = np.concatenate([self.flow_last_seen, time_ns])
+        all_index = np.concatenate([self.flow_index, index])
+        order = np.lexsort((all_time, all_keys["ports"], all_keys["addrs"]))
+
+        sorted_keys, sorted_time = all_keys[order], all_time[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (sorted_keys[1:] != sorted_keys[:-1]) | (sorted_time[1:] - sorted_time[:-1] > self.conntrack_timeout_ns)
+
+        # Backend of the first packet of each session
+        session = np.cumsum(first) - 1
+        session_index = all_index[order][first][session]
+        result = np.empty(len(order), dtype=np.int64)
+        result[order] = session_index
+
+        # Flows carried: last packet of each flow, if it can still be continued
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = sorted_keys[1:] != sorted_keys[:-1]
+        end = all_time.max() if len(all_time) else 0
+        alive = last & (sorted_time >= end - self.conntrack_timeout_ns)
+        self.flows = sorted_keys[alive]
+        self.flow_last_seen = sorted_time[alive]
+        self.flow_index = session_index[alive]
+
+        return result[n_carried:]
+
+    def report(self) -> dict:
+        def imbalance(values, weights=None):
+            # Per unit of weight, drained backends left out
+            if weights is not None:
+                values = values[weights > 0] / weights[weights > 0]
+            mean = values.mean() if len(values) else 0
+            return round(float(values.max() / mean), 4) if mean else None
+
+        verdicts = {}
+        for r, a in zip(*np.nonzero(self.verdicts)):
+            name = VERDICT_REASONS[r] if r < len(VERDICT_REASONS) else "truncated"
+            verdicts[f"{name}/{XDP_ACTIONS[a]}"] = int(self.verdicts[r, a])
+
+        services = []
+        for service in self.services:
+            i, n = service["id"], len(service["backends"])
+            packets, nbytes = self.backend_packets[i, :n], self.backend_bytes[i, :n]
+            weights = backend_weights(service["backends"])
+            weights = np.array(weights if weights else [1] * n)
+            services.append({
+                "name": service["name"],
+                "packets": int(packets.sum()),
+                "bytes": int(nbytes.sum()),
+                "packet_imbalance": imbalance(packets, weights),
+                "byte_imbalance": imbalance(nbytes, weights),
+                "backends": [{
+                    "backend": f"{backend[0]}:{backend[1]}",
+                    "weight": int(weights[j]),
+                    "packets": int(packets[j]),
+                    "bytes": int(nbytes[j]),
+                    "packet_share": round(float(packets[j] / packets.sum()), 6) if packets.sum() else 0.0,
+                } for j, backend in enumerate(service["backends"])],
+            })
+
+        return {
+            "packets": self.packets,
+            "bytes": self.bytes,
+            "verdicts": verdicts,
+            "cpus": [{"cpu": i, "packets": int(self.cpu_packets[i]), "bytes": int(self.cpu_bytes[i])} for i in range(self.cpus)],
+            "cpu_imbalance": imbalance(self.cpu_packets),
+            "services": services,
+        }
+
+
+def flow_keys(f: dict, packets: np.ndarray) -> np.ndarray:
+    keys = np.empty(len(packets), dtype=FlowSet.DTYPE)
+    keys["addrs"] = (f["saddr"][packets].astype(np.uint64) << np.uint64(32)) | f["daddr"][packets]
+    keys["ports"] = (f["sport"][packets].astype(np.uint32) << np.uint32(16)) | f["dport"][packets]
+    return keys
+
+
+class Remap:
+    """
+    Packets and flows whose backend differs between two simulators run on the same packets
+    """
+
+    def __init__(self, services: list[dict]):
+        self.services = services
+        self.packets = np.zeros(len(services), dtype=np.int64)
+        self.remapped = np.zeros(len(services), dtype=np.int64)
+        self.flows = [FlowSet() for _ in services]
+
+    def add(self, chunk: PacketChunk, a: dict, b: dict):
+        f = Simulator.parse(chunk)
+        both = (a["backend"] >= 0) & (b["backend"] >= 0)
+        for i, service in enumerate(self.services):
+            packets = np.flatnonzero(both & (a["service"] == service["id"]))
+            moved = a["backend_key"][packets] != b["backend_key"][packets]
+            self.packets[i] += len(packets)
+            self.remapped[i] += int(moved.sum())
+            self.flows[i].add(flow_keys(f, packets), moved)
+
+    def report(self) -> list[dict]:
+        return [{
+            "name": service["name"],
+            "packets": int(self.packets[i]),
+            "packets_remapped_percent": round(float(self.remapped[i] / self.packets[i] * 100), 4) if self.packets[i] else 0.0,
+            "flows": len(self.flows[i]),
+            "flows_remapped_percent": round(float(self.flows[i].flags.mean() * 100), 4) if len(self.flows[i]) else 0.0,
+        } for i, service in enumerate(self.services)]
+
+
+def services_from_args(services_file, vip, ports, backends) -> list[dict]:
+    if services_file:
+        return load_services(services_file)
+    return [{
+        "id": 0,
+        "name": "default",
+        "vip": vip,
+        "ports": [int(port) for port in ports.split(",")],
+        "backends": [parse_backend(backend) for backend in backends.split(",") if backend],
+        "forwarding": "",
+    }]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a pcap/pcapng capture through a model of xdp_prog and report how packets spread over backends and CPUs")
+    parser.add_argument("capture", help="pcap or pcapng file (ethernet, raw IP or Linux cooked capture)")
+    parser.add_argument("--services", default=os.environ.get("SERVICES_FILE", ""), help="services json file (SERVICES_FILE)")
+    parser.add_argument("--vip", default=os.environ.get("INTERFACE_IN_VIP", ""), help="VIP of the single service without --services")
+    parser.add_argument("--ports", default=os.environ.get("DESTINATION_PORTS", "5000"), help="ports of the single service")
+    parser.add_argument("--backends", default=os.environ.get("BACKENDS", ""), help="ip:port[@weight],... of the single service")
+    parser.add_argument("--lb-algorithm", default=os.environ.get("LB_ALGORITHM", "round_robin"), choices=["round_robin", "maglev"])
+    parser.add_argument("--maglev-table-size", type=int, default=int(os.environ.get("MAGLEV_TABLE_SIZE", "4099")))
+    parser.add_argument("--weighted-rr-size", type=int, default=int(os.environ.get("WEIGHTED_RR_SIZE", "4096")))
+    parser.add_argument("--rss", default="none", choices=RSS_MODELS, help="CPU of each packet: none (one CPU), toeplitz (NIC RSS), software (RSS_CPUS workers)")
+    parser.add_argument("--cpus", type=int, default=1, help="RX queues (toeplitz) or worker CPUs (software)")
+    parser.add_argument("--rss-fields", type=int, default=4, choices=[2, 4], help="NIC hash of UDP on addresses (2) or addresses and ports (4)")
+    parser.add_argument("--conntrack-timeout", type=float, default=float(os.environ.get("CONNTRACK_TIMEOUT", "0")), help="seconds, 0 without conntrack")
+    parser.add_argument("--compare-services", default="", help="services json file of the backends to compare with")
+    parser.add_argument("--compare-backends", default="", help="ip:port,... to compare with, single service")
+    parser.add_argument("--chunk", type=int, default=1_000_000, help="packets per chunk")
+    args = parser.parse_args()
+
+    if not args.services and not args.vip:
+        sys.exit("--services or --vip is required")
+    try:
+        if args.lb_algorithm == "maglev":
+            maglev.check_table_size(args.maglev_table_size, int(os.environ.get("MAX_BACKENDS", "1024")))
+    except ValueError as e:
+        parser.error(str(e))
+
+    def simulator(services):
+        return Simulator(services, lb_algorithm=args.lb_algorithm, maglev_table_size=args.maglev_table_size, rss=args.rss,
+                         cpus=args.cpus, rss_fields=args.rss_fields, conntrack_timeout_ns=int(args.conntrack_timeout * 1e9),
+                         weighted_rr_size=args.weighted_rr_size)
+
+    services = services_from_args(args.services, args.vip, args.ports, args.backends)
+    sim = simulator(services)
+
+    other = remap = None
+    if args.compare_services or args.compare_backends:
+        other = simulator(services_from_args(args.compare_services, args.vip, args.ports, args.compare_backends))
+        remap = Remap(services)
+
+    for chunk in read_chunks(args.capture, args.chunk):
+        result = sim.process(chunk)
+        if other:
+            remap.add(chunk, result, other.process(chunk))
+
+    report = sim.report()
+    if other:
+        report["compared"] = other.report()
+        report["remap"] = remap.report()
+    print(json.dumps(report, indent=2))
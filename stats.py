@@ -0,0 +1,169 @@
+import ctypes
+import fcntl
+import logging
+import socket
+import struct
+import threading
+from typing import NamedTuple, Optional
+
+import numpy as np
+from pyroute2 import IPRoute
+from pyroute2.netlink.rtnl import RTMGRP_LINK
+
+from object import LinkStats64
+
+# include/uapi/linux/sockios.h, include/uapi/linux/ethtool.h
+SIOCETHTOOL = 0x8946
+ETHTOOL_GSTRINGS = 0x1b
+ETHTOOL_GSTATS = 0x1d
+ETHTOOL_GSSET_INFO = 0x37
+ETH_SS_STATS = 1
+ETH_GSTRING_LEN = 32
+
+
+class EthtoolStats:
+    """
+    NIC statistics of one interface with the SIOCETHTOOL ioctl, same counters as `ethtool -S <interface>`.
+    Stat names are read once, each read() is a single ioctl into a preallocated NumPy buffer
+    """
+
+    def __init__(self, interface: str):
+        self.interface = interface
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.names = self._read_names()
+
+        # struct ethtool_stats: u32 cmd, u32 n_stats, u64 data[n_stats]
+        self.buffer = np.zeros(1 + len(self.names), dtype=np.uint64)
+
+    def _ioctl(self, buffer_address: int):
+        ifreq = struct.pack("16sP", self.interface.encode("utf-8")[:15], buffer_address)
+        ifreq += b"\0" * (40 - len(ifreq))
+        fcntl.ioctl(self.sock.fileno(), SIOCETHTOOL, ifreq)
+
+    def _read_names(self) -> list[str]:
+        # struct ethtool_sset_info: u32 cmd, u32 reserved, u64 sset_mask, u32 data[]
+        sset_info = ctypes.create_string_buffer(struct.pack("IIQI", ETHTOOL_GSSET_INFO, 0, 1 << ETH_SS_STATS, 0))
+        try:
+            self._ioctl(ctypes.addressof(sset_info))
+        except OSError as e:
+            logging.warning(f"ethtool stats are not available on {self.interface}: {e}")
+            return []
+
+        _, _, sset_mask, n_stats = struct.unpack("IIQI", sset_info.raw[:struct.calcsize("IIQI")])
+        if not sset_mask or not n_stats:
+            return []
+
+        # struct ethtool_gstrings: u32 cmd, u32 string_set, u32 len, u8 data[len * ETH_GSTRING_LEN]
+        gstrings = ctypes.create_string_buffer(struct.pack("III", ETHTOOL_GSTRINGS, ETH_SS_STATS, n_stats) + b"\0" * (n_stats * ETH_GSTRING_LEN))
+        self._ioctl(ctypes.addressof(gstrings))
+
+        data = gstrings.raw[12:12 + n_stats * ETH_GSTRING_LEN]
+        return [data[i:i + ETH_GSTRING_LEN].split(b"\0", 1)[0].decode() for i in range(0, len(data), ETH_GSTRING_LEN)]
+
+    def read(self) -> np.ndarray:
+        """
+        Current value of each stat, ordered like self.names. The array is reused by the next read()
+        """
+        if not self.names:
+            return self.buffer[1:]
+
+        self.buffer[0] = ETHTOOL_GSTATS | (len(self.names) << 32)
+        self._ioctl(self.buffer.ctypes.data)
+        return self.buffer[1:]
+
+    def read_dict(self) -> dict:
+        return dict(zip(self.names, self.read().tolist()))
+
+
+class LinkInfo(NamedTuple):
+    ifname: str
+    ifindex: int
+    operstate: str
+    mtu: int
+    num_tx_queues: int
+    num_rx_queues: int
+    qdisc: str
+    stats64: LinkStats64
+    xdp_attached: Optional[str]
+    xdp_prog_id: int
+    af_inet: dict
+
+
+def decode_link(msg) -> LinkInfo:
+    """
+    Decode a RTM_NEWLINK message. IFLA_STATS64 is copied as is into struct rtnl_link_stats64
+    """
+    stats64 = LinkStats64()
+    nla = msg.get_attr("IFLA_STATS64")
+    if nla is not None:
+        # Skip the 4 bytes nla header, older kernels send less counters
+        raw = nla.data[nla.offset + 4:nla.offset + nla.length]
+        ctypes.memmove(ctypes.addressof(stats64), raw, min(len(raw), ctypes.sizeof(stats64)))
+
+    xdp = msg.get_attr("IFLA_XDP")
+    af_spec = msg.get_attr("IFLA_AF_SPEC")
+    af_inet = af_spec.get_attr("AF_INET") if af_spec is not None else None
+
+    return LinkInfo(
+        ifname=msg.get_attr("IFLA_IFNAME"),
+        ifindex=msg["index"],
+        operstate=msg.get_attr("IFLA_OPERSTATE"),
+        mtu=msg.get_attr("IFLA_MTU"),
+        num_tx_queues=msg.get_attr("IFLA_NUM_TX_QUEUES"),
+        num_rx_queues=msg.get_attr("IFLA_NUM_RX_QUEUES"),
+        qdisc=msg.get_attr("IFLA_QDISC"),
+        stats64=stats64,
+        xdp_attached=xdp.get_attr("IFLA_XDP_ATTACHED") if xdp is not None else None,
+        xdp_prog_id=(xdp.get_attr("IFLA_XDP_PROG_ID") or 0) if xdp is not None else 0,
+        af_inet={name: af_inet[name] for name, _ in af_inet.fields} if af_inet is not None else {},
+    )
+
+
+class LinkMonitor:
+    """
+    Link info of a set of interfaces from one persistent rtnetlink socket.
+    Counters are polled with refresh(), link state and XDP attachment changes are pushed by RTNLGRP_LINK
+    into self.links from a background thread started by start(), and passed to on_change
+    """
+
+    def __init__(self, interfaces):
+        self.interfaces = set(interfaces)
+        self.ipr = IPRoute()
+        self.links: dict[str, LinkInfo] = {}
+        self.lock = threading.Lock()
+        self.on_change = None
+
+        for interface in self.interfaces:
+            self.refresh(interface)
+
+    def refresh(self, interface: str) -> LinkInfo:
+        with self.lock:
+            msg = self.ipr.get_links(socket.if_nametoindex(interface))[0]
+
+        link = decode_link(msg)
+        self.links[interface] = link
+        return link
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        events = IPRoute()
+        events.bind(groups=RTMGRP_LINK)
+
+        while True:
+            for msg in events.get():
+                if msg.get("event") != "RTM_NEWLINK":
+                    continue
+
+                link = decode_link(msg)
+                if link.ifname not in self.interfaces:
+                    continue
+
+                previous = self.links.get(link.ifname)
+                if previous and (previous.operstate, previous.xdp_attached, previous.xdp_prog_id) != (link.operstate, link.xdp_attached, link.xdp_prog_id):
+                    logging.warning(f"Link {link.ifname} changed: state {link.operstate}, xdp {link.xdp_attached} (prog id {link.xdp_prog_id})")
+
+                self.links[link.ifname] = link
+                if self.on_change:
+                    self.on_change(link)
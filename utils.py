@@ -1,6 +1,10 @@
+import errno
 import logging
+import os
 import socket
 import fcntl
+import ipaddress
+import glob
 import subprocess
 
 from object import *
@@ -10,6 +14,8 @@ from pyroute2 import IPRoute
 import json
 
 import ast
+import numpy as np
+from bcc.libbcc import lib
 
 def get_ip_address(ifname: str) -> str:
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -21,6 +27,11 @@ def get_ip_address(ifname: str) -> str:
         )[20:24]
     )
 
+def get_mtu(ifname: str) -> int:
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    ifreq = fcntl.ioctl(s.fileno(), 0x8921, struct.pack('16sI', ifname[:15].encode('utf-8'), 0))  # SIOCGIFMTU
+    return struct.unpack('16sI', ifreq)[1]
+
 def mac_string_to_int(mac_str: str) -> tuple:
     return tuple(int(b, 16) for b in mac_str.split(":"))
 
@@ -29,34 +40,6 @@ def get_mac_tuple(interface: str):
         mac_str = f.readline()
         return  mac_string_to_int(mac_str)
 
-def read_arp_table():
-    arp_table = []
-    with open("/proc/net/arp") as f:
-        next(f)  # skip header
-        for line in f:
-            fields = line.split()
-            entry = {
-                "ip": fields[0],
-                "hw_type": fields[1],
-                "flags": fields[2],
-                "mac": fields[3],
-                "mask": fields[4],
-                "device": fields[5],
-            }
-            arp_table.append(entry)
-    return arp_table
-
-def get_route_mac(ip):
-
-    for arp_entry in read_arp_table():
-        if arp_entry["ip"] == ip:
-            mac_array = mac_string_to_int(arp_entry["mac"])
-            arp_entry["mac_array"] = mac_array
-            return arp_entry
-
-    return None
-
-
 def get_link_attrs(attrs):
     try:
         return json.loads(str(attrs).replace('\'', '\"'))
@@ -98,6 +81,29 @@ def get_loaded_xdp_program(interface):
 
     return None
 
+def get_xdp_attachment(interface: str) -> tuple[int, str]:
+    """
+    Id of the XDP program attached to interface (0 if none) and its mode: "xdp", "xdpgeneric" or "xdpoffload"
+    """
+    with IPRoute() as ipr:
+        xdp = ipr.get_links(socket.if_nametoindex(interface))[0].get_attr("IFLA_XDP")
+
+    if xdp is None or not xdp.get_attr("IFLA_XDP_ATTACHED"):
+        return 0, ""
+    return xdp.get_attr("IFLA_XDP_PROG_ID") or 0, xdp.get_attr("IFLA_XDP_ATTACHED")
+
+def replace_xdp(interface: str, prog_fd: int, expected_fd: int, flags: int):
+    """
+    Swap the XDP program of interface in one netlink request, only if expected_fd is the one attached
+    (XDP_FLAGS_REPLACE in flags, kernel >= 5.7)
+    """
+    with IPRoute() as ipr:
+        ipr.link("set", index=socket.if_nametoindex(interface), xdp={"attrs": [
+            ("IFLA_XDP_FD", prog_fd),
+            ("IFLA_XDP_FLAGS", flags),
+            ("IFLA_XDP_EXPECTED_FD", expected_fd),
+        ]})
+
 def get_ethtool_stats(interface: str) -> dict:
     """
     Get NIC statistics from ethtool -S <interface>
@@ -127,51 +133,199 @@ def get_ethtool_stats(interface: str) -> dict:
 
     return stats
 
+def update_table_batch(table, keys, values):
+    """
+    Write many entries of a bcc table with one BPF_MAP_UPDATE_BATCH syscall (kernel >= 5.6),
+    falls back to one update per entry on older kernels
+    """
+    keys = np.ascontiguousarray(keys, dtype=np.dtype(table.Key))
+    values = np.ascontiguousarray(values, dtype=np.dtype(table.Leaf))
+    if len(keys) == 0:
+        return
+
+    try:
+        table.items_update_batch(
+            (table.Key * len(keys)).from_buffer(keys),
+            (table.Leaf * len(values)).from_buffer(values)
+        )
+    except Exception as e:
+        logging.debug(f"Batch update is not available, updating entries one by one: {e}")
+        for i in range(len(keys)):
+            table[table.Key.from_buffer(keys, i * keys.itemsize)] = table.Leaf.from_buffer(values, i * values.itemsize)
+
+
+def read_percpu_table(table, dtype=np.uint64) -> np.ndarray:
+    """
+    Read every entry of a BPF_PERCPU_ARRAY with BPF_MAP_LOOKUP_BATCH (kernel >= 5.6) straight into NumPy,
+    falls back to one lookup per entry on older kernels.
+    Returns a matrix (cpus x entries) of dtype
+    """
+    n = table.max_entries
+    cpus = table.total_cpu
+    values = np.zeros((n, cpus), dtype=dtype)
+    row_size = values.itemsize * cpus
+
+    keys = (table.Key * n)()
+    values_buffer = (ctypes.c_char * values.nbytes).from_buffer(values)
+    count = ctypes.c_uint32(n)
+    cursor = ctypes.c_uint32(0)
+    out_batch = ctypes.c_uint32(0)
+    total = 0
+
+    try:
+        while total < n:
+            count.value = n - total
+            res = lib.bpf_lookup_batch(table.map_fd,
+                                       ctypes.byref(cursor) if total else None,
+                                       ctypes.byref(out_batch),
+                                       ctypes.byref(keys, ctypes.sizeof(table.Key) * total),
+                                       ctypes.byref(values_buffer, row_size * total),
+                                       ctypes.byref(count),
+                                       None)
+            err = ctypes.get_errno()
+            total += count.value
+            cursor.value = out_batch.value
+
+            if res != 0:
+                if err != errno.ENOENT:
+                    raise OSError(err, os.strerror(err))
+                break
+
+    except OSError as e:
+        logging.debug(f"Batch lookup is not available, reading entries one by one: {e}")
+        for i in range(n):
+            values[i] = np.frombuffer(bytes(table[table.Key(i)]), dtype=dtype, count=cpus)
+        return values.T
+
+    # Array maps return entries in key order
+    return values.T
+
+
 def get_default_gateway_ip():
     gws = netifaces.gateways()
     return gws['default'][netifaces.AF_INET][0]
 
-def get_mac_str_by_ip(ip):
-    with open("/proc/net/arp") as f:
-        for line in f.readlines()[1:]:  # skip header
-            fields = line.split()
-            if fields[0] == ip:
-                return fields[3]  # MAC address column
-
-    return None
-
-def make_backend(ip_str: str, port: int, mac: tuple[int]):
-    logging.info(f"Backend {ip_str}:{port} via mac " + "[" + ", ".join(f"0x{b:02X}" for b in mac) + "]")
+def make_backend(ip_str: str, port: int, mac: tuple[int], weight: int = 1):
+    logging.info(f"Backend {ip_str}:{port} weight {weight} via mac " + "[" + ", ".join(f"0x{b:02X}" for b in mac) + "]")
     return Backend(
         ip=struct.unpack("I", socket.inet_aton(ip_str))[0],
         port=socket.htons(port),
-        pad=0,
-        mac=(ctypes.c_ubyte * 6)(*mac)
+        tunnel_port=0,
+        mac=(ctypes.c_ubyte * 6)(*mac),
+        weight=weight
     )
 
 
-def get_backends(config_servers: list[tuple[str, int]]):
-    backends = []
-    for i, (ip, port) in enumerate(config_servers):
-        ip_mac = get_route_mac(ip)
-        if not ip_mac:
-            default_gw_mac = get_mac_str_by_ip(get_default_gateway_ip())
-            logging.warning(f"Backend IP {ip} not exist in routing table, using default gateway mac address {default_gw_mac}")
-            backends.append(make_backend(ip, port, mac_string_to_int(default_gw_mac)))
+def backend_to_dict(backend: Backend) -> dict:
+    return {
+        "ip": socket.inet_ntoa(struct.pack("I", backend.ip)),
+        "port": socket.ntohs(backend.port),
+        "mac": ":".join(f"{mac_bin:02x}" for mac_bin in backend.mac),
+        "tunnel_port": socket.ntohs(backend.tunnel_port),
+        "weight": backend.weight,
+    }
 
-        else:
-            backends.append(make_backend(ip, port, ip_mac["mac_array"]))
 
-    return backends
+def parse_probe_bytes(s: str) -> bytes:
+    """
+    Health check payload from config, backslash escapes (\\x00, \\n, ...) allowed for binary protocols
+    """
+    return s.encode("latin-1", "backslashreplace").decode("unicode_escape").encode("latin-1")
+
 
 def parse_config_backends(s):
+    """
+    Backends (ip, port, weight) of a list like "172.30.30.21:5555,172.30.30.22:5555@3", weight 1 when not given
+    """
     result = []
     for entry in s.split(","):
+        entry, _, weight = entry.partition("@")
         if ":" in entry:
             host, port = entry.rsplit(":", 1)
         else:
             # Assume last 4–5 digits are the port if no colon
             # (works for your "172.30.23.25555" example)
             host, port = entry[:-5], entry[-5:]
-        result.append((host.strip(), int(port)))
-    return result
\ No newline at end of file
+        result.append((host.strip(), int(port), int(weight or 1)))
+    return result
+
+
+def parse_cpu_list(s: str) -> list[int]:
+    """
+    CPUs of a list like "2-5,8" (same format as /sys/devices/system/cpu/online), empty for none
+    """
+    cpus = []
+    for entry in s.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        if "-" in entry:
+            first, last = entry.split("-", 1)
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(entry))
+    return cpus
+
+
+# Must match RATE_LIMIT_SHIFT in xdp_prog.c
+RATE_LIMIT_SHIFT = 10
+
+
+def token_bucket(rate: int, burst: int, cpus: int = 1) -> tuple[int, int]:
+    """
+    Cost of a packet and size of a bucket of burst packets (0 for one second of rate) at rate packets per second, in
+    the credit units of xdp_prog.c. Each of the cpus RX CPUs has its own bucket, with its share of the rate and burst.
+    Cost 0 when rate is 0 (no limit)
+    """
+    if not rate:
+        return 0, 0
+    cost = (10**9 << RATE_LIMIT_SHIFT) * cpus // rate
+    # Below 2^63, so that credit + earned credit never overflows in xdp_prog.c
+    return cost, min(-(-(burst or rate) // cpus) * cost, 2**63 - 1)
+
+
+def get_rx_cpus(devices: list[str]) -> int:
+    """
+    Number of CPUs receiving the packets of the devices, one per RX queue and at most the number of CPUs
+    """
+    queues = sum(len(glob.glob(f"/sys/class/net/{device}/queues/rx-*")) for device in devices)
+    return max(min(queues, os.cpu_count()), 1)
+
+
+def parse_source_prefix(prefix: str):
+    """
+    Address (network byte order) and length of an IPv4 prefix, 10.0.0.0/8 or a single address
+    """
+    network = ipaddress.IPv4Network(prefix, strict=False)
+    return struct.unpack("I", network.network_address.packed)[0], network.prefixlen
+
+
+def parse_config_services(path):
+    """
+    Load services from a json file:
+    [
+        {"name": "game", "vip": "172.31.200.200", "protocol": "udp", "ports": [5000, 5001], "backends": ["172.30.30.21:5555"]},
+        ...
+    ]
+    Services get ids in file order
+    """
+    with open(path) as f:
+        declared = json.load(f)
+
+    services = []
+    for i, service in enumerate(declared):
+        backends = service.get("backends", [])
+        services.append({
+            "id": i,
+            "name": service.get("name", f"service-{i}"),
+            "vip": service["vip"],
+            "protocol": service.get("protocol", "udp"),
+            "ports": [int(port) for port in service["ports"]],
+            "backends": parse_config_backends(backends if isinstance(backends, str) else ",".join(backends)) if backends else [],
+            "health_check": service.get("health_check", {}),
+            "forwarding": service.get("forwarding", ""),
+            "tunnel_port": int(service.get("tunnel_port", 0)),
+            "rate_limit": service.get("rate_limit", {}),
+        })
+
+    return services
@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def equal_weights(weights) -> bool:
+    """
+    True when the weights do not change the plain selection: all the same (and not 0)
+    """
+    return len(set(weights)) <= 1 and 0 not in weights
+
+
+def apportion(weights, total: int) -> np.ndarray:
+    """
+    Split total slots between backends in proportion to their weights (largest remainder, lowest index on ties).
+    Backends with weight 0 get no slot, at least one weight must be > 0
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    quotas = weights * total / weights.sum()
+    slots = np.floor(quotas).astype(np.int64)
+
+    order = np.lexsort((np.arange(len(weights)), slots - quotas))
+    slots[order[:total - slots.sum()]] += 1
+    return slots
+
+
+def weighted_round_robin(weights, size: int) -> np.ndarray:
+    """
+    Sequence of backend indexes where each backend appears in proportion to its weight, at most size long (weights
+    are scaled down to fit, see apportion). Backends are interleaved (smooth weighted round robin, as in nginx) so that
+    consecutive packets go to different backends. At least one weight must be > 0
+    """
+    weights = np.asarray(weights, dtype=np.int64)
+    counts = weights // np.gcd.reduce(weights[weights > 0])
+    if counts.sum() > size:
+        counts = apportion(weights, size)
+
+    total = int(counts.sum())
+    sequence = np.empty(total, dtype=np.int64)
+    current = np.zeros(len(counts), dtype=np.int64)
+    for i in range(total):
+        current += counts
+        # argmax picks the lowest index on ties
+        j = int(np.argmax(current))
+        sequence[i] = j
+        current[j] -= total
+
+    return sequence
@@ -1,12 +1,14 @@
-import collections
+import heapq
 import json
 import os
 import sys
 import threading
 import time
-from contextlib import asynccontextmanager
+from email.utils import formatdate
+from contextlib import ExitStack, asynccontextmanager
 from multiprocessing import cpu_count
 from typing import List
+import bpfcache
 import config
 import numpy as np
 import schedule
@@ -16,10 +18,24 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.openapi.utils import get_openapi
 from prometheus_client import *
+from prometheus_client.core import CounterMetricFamily, HistogramMetricFamily
+from prometheus_client.registry import Collector
 from scapy.arch import get_if_hwaddr
 from scapy.layers.l2 import ARP, Ether
 from scapy.sendrecv import sendp
+from starlette.requests import Request
 from starlette.responses import Response
+from conntrack import ConntrackTables
+import exposition
+from flows import DIMENSIONS, FlowTelemetry, IpfixExporter
+from health import HealthCheck, HealthChecker
+from neighbors import NeighborCache
+from registry import BackendRegistry, backend_key, layout_slots
+from weights import equal_weights, weighted_round_robin
+import histogram
+import maglev
+from ringbuf import RingBufferConsumer
+from stats import EthtoolStats, LinkMonitor
 import utils
 from utils import *
 
@@ -31,17 +47,115 @@ logging.basicConfig(filename="/dev/stdout",
                     )
 
 HOSTNAME = socket.gethostname()
-b = BPF(src_file="xdp_prog.c", cflags=["-w", "-D__MAX_CPU__=%u" % cpu_count()], debug=0)
+b = bpfcache.load("xdp_prog.c", config.bpf_cflags, config.bpf_functions, config.bpf_cache_dir, config.bpf_pin_dir)
 
-packet_counter_per_cpus_last_1s = [0] * cpu_count()
-packet_counter_rate_per_cpus_last_1s = [0] * cpu_count()
-packet_latency_bucket = collections.deque(maxlen=256 * 1024)
+# Serialize writers of the double-buffered backend tables
+backends_lock = threading.Lock()
+
+# Processed packets of each ingress interface per CPU, and their rate over the last second
+packet_counter_per_cpus_last_1s = {device: [0] * cpu_count() for device in config.devices_in}
+packet_counter_rate_per_cpus_last_1s = {device: [0] * cpu_count() for device in config.devices_in}
+
+# Histograms of forwarded packets merged over CPUs, one row per ingress interface: totals since start and counts of
+# the last second
+latency_hist_total = np.zeros((len(config.devices_in), histogram.HIST_BUCKETS), dtype=np.uint64)
+pkt_size_hist_total = np.zeros((len(config.devices_in), histogram.HIST_BUCKETS), dtype=np.uint64)
+latency_hist_last_1s = np.zeros((len(config.devices_in), histogram.HIST_BUCKETS), dtype=np.uint64)
+pkt_size_hist_last_1s = np.zeros((len(config.devices_in), histogram.HIST_BUCKETS), dtype=np.uint64)
+hist_sum_total = np.zeros((len(config.devices_in), 2), dtype=np.uint64)
+
+# Sampled events from the rb ring buffer, created at startup
+event_consumer: RingBufferConsumer = None
+
+# Sampled packet headers from the flow_rb ring buffer, created at startup, and their heavy hitters
+flow_consumer: RingBufferConsumer = None
+flow_telemetry = FlowTelemetry(config.flow_top_capacity, config.flow_sketch_width, config.flow_sketch_depth, config.flow_window_slots, config.flow_window / config.flow_window_slots)
+flow_sample_rate = 0
+# Top flows of each finished sub-window sent to IPFIX_COLLECTOR
+ipfix_exporter = IpfixExporter(config.ipfix_collector) if config.ipfix_collector else None
+
+# Flow samples kept by the consumer between two polls, older ones are skipped
+FLOW_SAMPLE_BATCH = 64 * 1024
+
+# Interface counters, created at startup. ethtool stats of each ingress interface
+link_monitor: LinkMonitor = None
+ethtool_stats: dict[str, EthtoolStats] = {}
+
+# Software RSS: second stage program, loaded when first enabled, and current worker CPUs
+cpu_prog = None
+rss_cpus: list[int] = []
+rss_queue_size = config.rss_queue_size
+
+# /metrics bodies, rendered by the scheduler after each collection
+metrics_snapshot: exposition.MetricsSnapshot = None
+
+# Packets per (interface, reason, action) summed over CPUs, see verdicts in xdp_prog.c
+verdicts_total = np.zeros((len(config.devices_in), len(config.verdict_reasons), len(config.xdp_actions)), dtype=np.uint64)
+
+# Conntrack events summed over CPUs, see CT_EVENT_* in xdp_prog.c
+conntrack_events_total = np.zeros(len(config.conntrack_events), dtype=np.uint64)
+
+# Sources with the most packets dropped by the rate limiter, read by the scheduler
+rate_limited_sources = []
+
+# RX CPUs the limit of a source is split over, each has its own token bucket for the source
+rate_limit_cpus = config.rate_limit_cpus or get_rx_cpus(config.devices_in)
+
+# Flow tables, swept for idle flows when conntrack is enabled
+conntrack_tables = ConntrackTables(b["conntrack"], b["conntrack_reverse"])
+
+# Exported histogram buckets (powers of two)
+LATENCY_HIST_BOUNDS = [2 ** k for k in range(4, 26)]
+PKT_SIZE_HIST_BOUNDS = [2 ** k for k in range(6, 17)]
+
+# Configured services: id -> {"name", "vip", "protocol", "ports"}
+services = {}
+
+# Backends declared for each service (healthy or not), service id -> BackendRegistry. Healthy ones are written to the XDP tables
+service_backends = {}
+
+# Serialize the changes of the declared backends of each service, from reading the registry to the flip of the tables
+service_locks = {}
+
+# What was last written to each copy (pool = service id * 2 + generation) of the backend tables, the kernel maps are
+# only read back once when adopting pinned maps: backend keys and Backend bytes per slot, maglev lookup table and
+# weighted round robin sequence
+pool_keys = {}
+pool_entries = {}
+pool_maglev = {}
+pool_weighted_rr = {}
+
+# Active generation of each service, mirror of backend_generation
+backend_generations = {}
+
+# UDP probes of the backends, None when health checks are disabled in every service
+health_checker: HealthChecker = None
+
+# Next hop MAC addresses of the backends, created at startup
+neighbor_cache: NeighborCache = None
+
+# Addresses of the load balancer, read at startup
+host_configs = {}
+
+# "ip:port" of each slot in the backends table, per service id
+backend_labels = {}
+
+# backend_stats (summed over CPUs) at the last collection, indexed like it (service id * max_backends + slot). Slots
+# are reused by other backends, so packets and bytes are credited to the backend holding the slot since then
+backend_stats_last = np.zeros((2, 0), dtype=np.uint64)
+# Packets and bytes of each (service id, "ip:port") since start, and over the last second
+backend_totals: dict[tuple[int, str], np.ndarray] = {}
+backend_last_1s: dict[tuple[int, str], np.ndarray] = {}
+# Credits since the last rate computation
+backend_pending: dict[tuple[int, str], np.ndarray] = {}
+backend_stats_lock = threading.Lock()
 
 xdp_collector_registry = CollectorRegistry()
 
 packet_processed_rate = Gauge(name="xdp_packet_processed_rate", documentation="Instant processed packets per second", labelnames=["cpu", "interface", "host"], registry=xdp_collector_registry)
 packet_processed = Gauge(name="xdp_packet_processed", documentation="Packets processed", labelnames=["cpu", "interface", "host"], registry=xdp_collector_registry)
 packet_latency = Gauge(name="xdp_packet_latency_ns", documentation="Packets processing latency in nanoseconds", labelnames=["type", "interface", "host"], registry=xdp_collector_registry)
+packet_size = Gauge(name="xdp_packet_size_bytes", documentation="Size of forwarded packets in bytes", labelnames=["type", "interface", "host"], registry=xdp_collector_registry)
 
 interface_stat = Gauge(name="xdp_interfaces_stat", documentation="Interface runtime stats",labelnames=["interface", "type", "host"], registry=xdp_collector_registry)
 interface_ethtool_stat = Gauge(name="xdp_interfaces_ethtool_stat", documentation="Interface runtime stats from ethtool, may contains vendor-specific stats", labelnames=["interface", "type", "host"], registry=xdp_collector_registry)
@@ -51,75 +165,517 @@ interface_qdisk = Gauge(name="xdp_interface_qdisk", documentation="Interface que
 xdp_mode = Gauge(name="xdp_mode", documentation="Information", labelnames=["interface", "host", "mode"], registry=xdp_collector_registry)
 xdp_prog_id = Counter(name="xdp_prog_id", documentation="Information", labelnames=["interface", "host"], registry=xdp_collector_registry)
 
+events_consumed = Gauge(name="xdp_events_consumed", documentation="Sampled events consumed from the ring buffer", labelnames=["host"], registry=xdp_collector_registry)
+flow_samples_consumed = Gauge(name="xdp_flow_samples_consumed", documentation="Sampled flow headers consumed from the flow ring buffer", labelnames=["host"], registry=xdp_collector_registry)
+
+backend_packets = Counter(name="xdp_backend_packets", documentation="Packets sent to backend", labelnames=["service", "backend", "host"], registry=xdp_collector_registry)
+backend_bytes = Counter(name="xdp_backend_bytes", documentation="Bytes sent to backend", labelnames=["service", "backend", "host"], registry=xdp_collector_registry)
+backend_packets_rate = Gauge(name="xdp_backend_packets_rate", documentation="Instant packets per second sent to backend", labelnames=["service", "backend", "host"], registry=xdp_collector_registry)
+backend_bytes_rate = Gauge(name="xdp_backend_bytes_rate", documentation="Instant bytes per second sent to backend", labelnames=["service", "backend", "host"], registry=xdp_collector_registry)
+
+backend_up = Gauge(name="xdp_backend_up", documentation="Backend health, 1 when it passes health checks", labelnames=["service", "backend", "host"], registry=xdp_collector_registry)
+backend_health_check_rtt = Gauge(name="xdp_backend_health_check_rtt_seconds", documentation="Round trip time of the last successful health check", labelnames=["service", "backend", "host"], registry=xdp_collector_registry)
+
+rate_limited_source_packets = Gauge(name="xdp_rate_limited_source_packets", documentation="Packets dropped by the token bucket of a source, sources with the most drops", labelnames=["service", "source", "host"], registry=xdp_collector_registry)
+
+conntrack_flows = Gauge(name="xdp_conntrack_flows", documentation="Tracked flows, counted by the last sweep", labelnames=["host"], registry=xdp_collector_registry)
+
+rss_cpu_queue_size = Gauge(name="xdp_rss_cpu_queue_size", documentation="Queue size of each worker CPU of software RSS", labelnames=["cpu", "host"], registry=xdp_collector_registry)
+
 xdp_time_start = Gauge(name="xdp_time_start", documentation="Epoch time in seconds when started", labelnames=["interface", "host"], registry=xdp_collector_registry)
 
 
+class PacketHistogramCollector(Collector):
+    """
+    Export in-kernel histograms as prometheus histograms, from the values read by the scheduler
+    """
+
+    def collect(self):
+        for name, documentation, counts, total, bounds in [
+            ("xdp_packet_processing_time_ns", "Processing time of forwarded packets in nanoseconds", latency_hist_total, hist_sum_total[:, 0], LATENCY_HIST_BOUNDS),
+            ("xdp_packet_size", "Size of forwarded packets in bytes", pkt_size_hist_total, hist_sum_total[:, 1], PKT_SIZE_HIST_BOUNDS),
+        ]:
+            family = HistogramMetricFamily(name, documentation, labels=["interface", "host"])
+            for slot, device in enumerate(config.devices_in):
+                cumulative = histogram.cumulative_counts(counts[slot], bounds)
+                family.add_metric(
+                    [device, HOSTNAME],
+                    buckets=[(str(bound), count) for bound, count in zip(bounds, cumulative)] + [("+Inf", float(counts[slot].sum()))],
+                    sum_value=float(total[slot])
+                )
+            yield family
+
+
+xdp_collector_registry.register(PacketHistogramCollector())
+
+
+class VerdictCollector(Collector):
+    """
+    Export xdp_verdict_total{reason,action} from the counts read by the scheduler, pairs never seen are left out
+    """
+
+    def collect(self):
+        family = CounterMetricFamily("xdp_verdict", "Packets leaving the XDP program by reason and action", labels=["reason", "action", "interface", "host"])
+        for slot, reason, action in zip(*np.nonzero(verdicts_total)):
+            family.add_metric([config.verdict_reasons[reason], config.xdp_actions[action], config.devices_in[slot], HOSTNAME], float(verdicts_total[slot, reason, action]))
+        yield family
+
+
+xdp_collector_registry.register(VerdictCollector())
+
+
+class ConntrackEventCollector(Collector):
+    """
+    Export xdp_conntrack_events_total{event} from the counts read by the scheduler
+    """
+
+    def collect(self):
+        family = CounterMetricFamily("xdp_conntrack_events", "Flows created, expired and reassigned to another backend", labels=["event", "host"])
+        for event, count in zip(config.conntrack_events, conntrack_events_total.tolist()):
+            family.add_metric([event, HOSTNAME], float(count))
+        yield family
+
+
+xdp_collector_registry.register(ConntrackEventCollector())
+
+
 def read_total_packets_processed():
-    for k, v in b["counter"].items():
-        per_cpu_vals = list(v)
-        return per_cpu_vals
+    """
+    Processed packets of each ingress interface per CPU, a matrix (interfaces x cpus)
+    """
+    return read_percpu_table(b["counter"])[:cpu_count(), :len(config.devices_in)].T
+
 
-    return [0] * cpu_count()
+def read_backend_stats():
+    """
+    Per-CPU packets and bytes of each backend slot, two matrices (cpus x backends)
+    """
+    stats = read_percpu_table(b["backend_stats"], BACKEND_STATS_DTYPE)
+    return stats["packets"], stats["bytes"]
+
+
+def verdict_counter():
+    global verdicts_total
+    verdicts = read_percpu_table(b["verdicts"]).sum(axis=0, dtype=np.uint64)
+    verdicts_total = verdicts.reshape(len(config.devices_in), len(config.verdict_reasons), len(config.xdp_actions))
+
+
+def conntrack_counter():
+    global conntrack_events_total
+    conntrack_events_total = read_percpu_table(b["conntrack_events"]).sum(axis=0, dtype=np.uint64)
+
+
+def conntrack_sweep():
+    active = conntrack_tables.sweep(int(config.conntrack_timeout * 1e9))
+    conntrack_flows.labels(host=HOSTNAME).set(active)
+
+
+def rate_limit_counter():
+    """
+    Sources with the most packets dropped by their token bucket, summed over CPUs
+    """
+    global rate_limited_sources
+
+    sources = []
+    if any(service["rate_limit"]["rate"] for service in services.values()):
+        table = b["rate_limit_buckets"]
+        try:
+            # BPF_MAP_LOOKUP_BATCH, kernel >= 5.6
+            items = list(table.items_lookup_batch())
+        except Exception as e:
+            logging.debug(f"Batch lookup is not available, reading token buckets one by one: {e}")
+            items = list(table.items())
+        for key, buckets in items:
+            dropped = sum(bucket.dropped for bucket in buckets)
+            if dropped:
+                sources.append((dropped, key.service_id, key.saddr))
+
+    rate_limited_sources = [{
+        "service": service_id,
+        "source": f"{socket.inet_ntoa(struct.pack('I', saddr))}/{services[service_id]['rate_limit']['prefix']}",
+        "dropped": dropped,
+    } for dropped, service_id, saddr in heapq.nlargest(config.rate_limit_top, sources) if service_id in services]
+
+    rate_limited_source_packets.clear()
+    for source in rate_limited_sources:
+        rate_limited_source_packets.labels(service=services[source["service"]]["name"], source=source["source"], host=HOSTNAME).set(source["dropped"])
+
+
+def histogram_counter():
+    global latency_hist_total
+    global pkt_size_hist_total
+    global latency_hist_last_1s
+    global pkt_size_hist_last_1s
+    global hist_sum_total
+
+    latency_hist = read_percpu_table(b["latency_hist"]).sum(axis=0, dtype=np.uint64).reshape(len(config.devices_in), -1)
+    pkt_size_hist = read_percpu_table(b["pkt_size_hist"]).sum(axis=0, dtype=np.uint64).reshape(len(config.devices_in), -1)
+
+    latency_hist_last_1s = latency_hist - np.minimum(latency_hist_total, latency_hist)
+    pkt_size_hist_last_1s = pkt_size_hist - np.minimum(pkt_size_hist_total, pkt_size_hist)
+    latency_hist_total = latency_hist
+    pkt_size_hist_total = pkt_size_hist
+    hist_sum_total = read_percpu_table(b["hist_sum"]).sum(axis=0, dtype=np.uint64).reshape(len(config.devices_in), 2)
+
+    for slot, device in enumerate(config.devices_in):
+        for k, v in histogram.summarize(latency_hist_last_1s[slot]).items():
+            packet_latency.labels(interface=device, host=HOSTNAME, type=k).set(v)
+
+        for k, v in histogram.summarize(pkt_size_hist_last_1s[slot]).items():
+            packet_size.labels(interface=device, host=HOSTNAME, type=k).set(v)
+
+
+def collect_backend_stats():
+    """
+    Credit the packets and bytes of each backend slot since the last collection to the backend holding the slot. Run
+    by the scheduler, and before the backends of a service move to other slots so that a backend never inherits the
+    totals of the previous holder of its slot. Call with backend_stats_lock held
+    """
+    global backend_stats_last
+
+    packets, bytes_ = read_backend_stats()
+    stats = np.stack([packets.sum(axis=0), bytes_.sum(axis=0)])
+    if backend_stats_last.shape != stats.shape:
+        backend_stats_last = stats
+
+    delta = stats.astype(np.int64) - backend_stats_last.astype(np.int64)
+    backend_stats_last = stats
+
+    for service_id, labels in backend_labels.items():
+        service = services[service_id]["name"]
+        for i, label in enumerate(labels):
+            credit = np.maximum(delta[:, service_id * config.max_backends + i], 0)
+            key = (service_id, label)
+            backend_totals[key] = backend_totals.get(key, 0) + credit
+            backend_pending[key] = backend_pending.get(key, 0) + credit
+            if credit.any():
+                backend_packets.labels(service=service, backend=label, host=HOSTNAME).inc(int(credit[0]))
+                backend_bytes.labels(service=service, backend=label, host=HOSTNAME).inc(int(credit[1]))
+
+
+def backend_rate_counter():
+    global backend_last_1s
+    global backend_pending
+
+    with backend_stats_lock:
+        collect_backend_stats()
+        backend_last_1s, backend_pending = backend_pending, {}
+
+        # Removed backends
+        current = {(service_id, label) for service_id, labels in backend_labels.items() for label in labels}
+        for service_id, label in [key for key in backend_totals if key not in current]:
+            del backend_totals[(service_id, label)]
+            for metric in [backend_packets, backend_bytes]:
+                try:
+                    metric.remove(services[service_id]["name"], label, HOSTNAME)
+                except KeyError:
+                    pass
+
+    for metric in [backend_packets_rate, backend_bytes_rate]:
+        metric.clear()
+
+    for (service_id, label), (packets, bytes_) in backend_last_1s.items():
+        service = services[service_id]["name"]
+        backend_packets_rate.labels(service=service, backend=label, host=HOSTNAME).set(int(packets))
+        backend_bytes_rate.labels(service=service, backend=label, host=HOSTNAME).set(int(bytes_))
 
 
 def packet_rate_counter():
-    b.ring_buffer_consume()
-
-    latency = np.array(list(packet_latency_bucket))
-    packet_latency.labels(interface=config.device_in, host=HOSTNAME, type="mean").set(
-        0 if len(packet_latency_bucket) == 0 else latency.mean())
-    packet_latency.labels(interface=config.device_in, host=HOSTNAME, type="min").set(
-        0 if len(packet_latency_bucket) == 0 else latency.min())
-    packet_latency.labels(interface=config.device_in, host=HOSTNAME, type="max").set(
-        0 if len(packet_latency_bucket) == 0 else latency.max())
-    packet_latency.labels(interface=config.device_in, host=HOSTNAME, type="std").set(
-        0 if len(packet_latency_bucket) == 0 else latency.std())
-    for p in [25, 50, 90, 95, 99]:
-        packet_latency.labels(interface=config.device_in, host=HOSTNAME, type=f"p{p}").set(
-            0.0 if len(packet_latency_bucket) == 0 else float(np.percentile(latency, p)))
-
-    packet_latency_bucket.clear()
+    histogram_counter()
+    verdict_counter()
+    conntrack_counter()
 
     global packet_counter_per_cpus_last_1s
     global packet_counter_rate_per_cpus_last_1s
 
-    packet_counter_per_cpus = read_total_packets_processed()
-    packet_counter_rate_per_cpus = [x - y for x, y in zip(packet_counter_per_cpus, packet_counter_per_cpus_last_1s)]
+    packet_counters = read_total_packets_processed()
+
+    for device, packet_counter_per_cpus in zip(config.devices_in, packet_counters.tolist()):
+        packet_counter_rate_per_cpus = [x - y for x, y in zip(packet_counter_per_cpus, packet_counter_per_cpus_last_1s[device])]
+
+        packet_counter_rate_per_cpus_last_1s[device] = packet_counter_rate_per_cpus
+        packet_counter_per_cpus_last_1s[device] = packet_counter_per_cpus
+
+        packet_processed.labels(cpu="total", interface=device, host=HOSTNAME).set(sum(packet_counter_per_cpus))
+        for i, v in enumerate(packet_counter_per_cpus):
+            packet_processed.labels(cpu=str(i), interface=device, host=HOSTNAME).set(v)
+
+        packet_processed_rate.labels(cpu="total", interface=device, host=HOSTNAME).set(
+            sum(packet_counter_rate_per_cpus))
+        for i, v in enumerate(packet_counter_rate_per_cpus):
+            packet_processed_rate.labels(cpu=str(i), interface=device, host=HOSTNAME).set(v)
+
+    backend_rate_counter()
 
-    packet_counter_rate_per_cpus_last_1s = packet_counter_rate_per_cpus
-    packet_counter_per_cpus_last_1s = packet_counter_per_cpus
+    for device, stats in ethtool_stats.items():
+        for k, v in zip(stats.names, stats.read().tolist()):
+            interface_ethtool_stat.labels(interface=device, host=HOSTNAME, type=k).set(v)
 
-    packet_processed.labels(cpu="total", interface=config.device_in, host=HOSTNAME).set(sum(packet_counter_per_cpus))
-    for i, v in enumerate(packet_counter_per_cpus):
-        packet_processed.labels(cpu=str(i), interface=config.device_in, host=HOSTNAME).set(v)
+    link_stats_counter()
 
-    packet_processed_rate.labels(cpu="total", interface=config.device_in, host=HOSTNAME).set(
-        sum(packet_counter_rate_per_cpus))
-    for i, v in enumerate(packet_counter_rate_per_cpus):
-        packet_processed_rate.labels(cpu=str(i), interface=config.device_in, host=HOSTNAME).set(v)
+    health_counter()
 
-    for k, v in utils.get_ethtool_stats(config.device_in).items():
-        interface_ethtool_stat.labels(interface=config.device_in, host=HOSTNAME, type=k).set(v)
+    render_metrics()
+
+
+def link_stats_counter():
+    for device in config.devices_in:
+        link = link_monitor.refresh(device)
+
+        for metric_name, _ in LinkStats64._fields_:
+            interface_stat.labels(interface=device, host=HOSTNAME, type=metric_name).set(getattr(link.stats64, metric_name))
+
+        interface_stat.labels(interface=device, host=HOSTNAME, type="num_tx_queue").set(link.num_tx_queues)
+        interface_stat.labels(interface=device, host=HOSTNAME, type="num_rx_queue").set(link.num_rx_queues)
+        interface_stat.labels(interface=device, host=HOSTNAME, type="mtu").set(link.mtu)
+
+        for metric_name, value in link.af_inet.items():
+            interface_spec.labels(interface=device, host=HOSTNAME, type=metric_name).set(value)
+
+    link_state_counter()
+
+
+def link_state_counter(_=None):
+    # IFLA_XDP_ATTACHED is "xdp", "xdpgeneric", "xdpoffload" or None.
+    # Rebuilt for all ingress interfaces from their latest link info, so labels of a previous mode or qdisc go away
+    xdp_prog_id.clear()
+    xdp_mode.clear()
+    interface_qdisk.clear()
+
+    for device, link in list(link_monitor.links.items()):
+        if link.xdp_attached:
+            xdp_prog_id.labels(interface=device, host=HOSTNAME).inc(link.xdp_prog_id)
+            xdp_mode.labels(interface=device, host=HOSTNAME, mode=link.xdp_attached).set(1)
+        else:
+            xdp_mode.labels(interface=device, host=HOSTNAME, mode="").set(0)
+
+        interface_qdisk.labels(interface=device, host=HOSTNAME, qdisk=link.qdisc).set(1)
+
+
+def health_counter():
+    if health_checker is None:
+        return
+
+    backend_up.clear()
+    backend_health_check_rtt.clear()
+
+    for (service_id, ip, port), state in list(health_checker.states.items()):
+        service = services[service_id]["name"] if service_id in services else str(service_id)
+        backend_up.labels(service=service, backend=f"{ip}:{port}", host=HOSTNAME).set(int(state.up))
+        backend_health_check_rtt.labels(service=service, backend=f"{ip}:{port}", host=HOSTNAME).set(state.rtt)
+
+
+def render_metrics():
+    global metrics_snapshot
+    # Swapped as a whole, scrapes never see a partially rendered snapshot
+    metrics_snapshot = exposition.render_snapshot(xdp_collector_registry, time.time())
 
 
 def broadcast_arp():
-    ip = config.vip
-    mac = get_if_hwaddr(config.device_in)
+    for device in config.devices_in:
+        mac = get_if_hwaddr(device)
+
+        for ip in config.announced_vips:
+            logging.debug(f"Broadcasting ARP for {ip} ({mac}) on {device} ...")
 
-    logging.debug(f"Broadcasting ARP for {ip} ({mac}) on {config.device_in} ...")
+            ether = Ether(dst="ff:ff:ff:ff:ff:ff")
+            arp = ARP(op=2, psrc=ip, hwsrc=mac, pdst=ip, hwdst="00:00:00:00:00:00")
+            packet = ether / arp
 
-    ether = Ether(dst="ff:ff:ff:ff:ff:ff")
-    arp = ARP(op=2, psrc=ip, hwsrc=mac, pdst=ip, hwdst="00:00:00:00:00:00")
-    packet = ether / arp
+            sendp(packet, iface=device, verbose=False)
 
-    sendp(packet, iface=config.device_in, verbose=False)
+
+def run_event_consumer():
+    """Move sampled events from the ring buffer to memory in batches"""
+    while True:
+        event_consumer.poll(0.1)
+        event_consumer.consume()
+        events_consumed.labels(host=HOSTNAME).set(event_consumer.total)
+
+
+def run_flow_consumer():
+    """Aggregate sampled packet headers from the ring buffer in batches, export the top flows of finished sub-windows"""
+    while True:
+        flow_consumer.poll(0.1)
+        n = flow_consumer.consume()
+        now = time.time()
+        if n:
+            flow_telemetry.add(flow_consumer.latest(n), flow_sample_rate, now)
+        if ipfix_exporter is not None:
+            for start, end, keys, info, estimates in flow_telemetry.finished(config.flow_export_top, now):
+                ipfix_exporter.export(ipfix_exporter.records(start, end, keys, info, estimates), now)
+        flow_samples_consumed.labels(host=HOSTNAME).set(flow_consumer.total)
+
+
+def set_sample_rate(rate):
+    logging.info(f"Event sample rate: 1/{rate}" if rate else "Event sampling disabled")
+    b["sample_rate"][0] = ctypes.c_uint32(rate)
+
+
+def set_flow_sample_rate(rate):
+    global flow_sample_rate
+    logging.info(f"Flow sample rate: 1/{rate}" if rate else "Flow sampling disabled")
+    b["flow_sample_rate"][0] = ctypes.c_uint32(rate)
+    flow_sample_rate = rate
+
+
+def set_rss(cpus, queue_size):
+    """
+    Hand UDP packets of services to the worker cpus, where xdp_cpu_prog rewrites and sends them. No cpus to process
+    packets on the RX CPU. New cpumap entries are written before the worker list and removed ones after it, so the
+    first stage never picks a CPU without an entry
+    """
+    global cpu_prog
+    global rss_cpus
+    global rss_queue_size
+
+    cpus = list(dict.fromkeys(cpus))
+    invalid = [cpu for cpu in cpus if not 0 <= cpu < cpu_count()]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid CPUs {invalid}, {cpu_count()} CPUs available")
+
+    if cpus and cpu_prog is None:
+        cpu_prog = b.load_func("xdp_cpu_prog", BPF.XDP, attach_type=config.BPF_XDP_CPUMAP)
+
+    for cpu in cpus:
+        b["cpu_map"][cpu] = CpumapVal(qsize=queue_size, prog_fd=cpu_prog.fd)
+    for i, cpu in enumerate(cpus):
+        b["rss_cpus"][i] = ctypes.c_uint32(cpu)
+    b["rss_cpu_count"][0] = ctypes.c_uint32(len(cpus))
+    for cpu in set(rss_cpus) - set(cpus):
+        b["cpu_map"][cpu] = CpumapVal(qsize=0, prog_fd=0)
+
+    rss_cpus = cpus
+    rss_queue_size = queue_size
+
+    rss_cpu_queue_size.clear()
+    for cpu in cpus:
+        rss_cpu_queue_size.labels(cpu=str(cpu), host=HOSTNAME).set(queue_size)
+
+    logging.info(f"Software RSS on CPUs {cpus}, queue size {queue_size}" if cpus else "Software RSS disabled")
+
+
+def pinned_xdp_prog():
+    """
+    XDP program pinned in BPF_PIN_DIR by a previous run, None if there is none
+    """
+    try:
+        return bpfcache.Function("xdp_prog", bpfcache.get_pinned(os.path.join(config.bpf_pin_dir, "xdp_prog")))
+    except FileNotFoundError:
+        return None
+
+
+def adopt_xdp_prog(fn, previous):
+    """
+    Program to attach: the one of the previous run if fn is the same code on the same maps, so that it is left as it
+    is, else fn
+    """
+    info, map_ids = bpfcache.prog_info(fn.fd)
+    previous_info, previous_map_ids = bpfcache.prog_info(previous.fd)
+    if bytes(info.tag) == bytes(previous_info.tag) and map_ids == previous_map_ids:
+        logging.info(f"XDP program {previous_info.id} of the previous run is unchanged, keeping it")
+        return previous
+
+    logging.info(f"XDP program changed (tag {bytes(previous_info.tag).hex()} -> {bytes(info.tag).hex()}), program {previous_info.id} will be replaced by {info.id}")
+    return fn
+
+
+def replace_xdp_prog(device, fn, previous) -> bool:
+    """
+    Keep the program of the previous run attached to device, or swap it for fn in place. False if it is not attached
+    to device
+    """
+    prog_id, attached = utils.get_xdp_attachment(device)
+    if prog_id == 0 or prog_id != bpfcache.prog_info(previous.fd)[0].id:
+        return False
+
+    if fn is previous:
+        logging.info(f"XDP program {prog_id} left attached to {device} ({attached})")
+        return True
+
+    time_start = time.time()
+    # Same mode as attached, fails if another program was attached in the meantime
+    utils.replace_xdp(device, fn.fd, previous.fd, config.flags[config.xdp_attach_modes[attached]] | config.flags["XDP_FLAGS_REPLACE"])
+    logging.info(f"XDP program {prog_id} replaced on {device} ({attached}) in {(time.time() - time_start) * 1000:.2f} ms")
+    return True
+
+
+def attach_xdp_programs():
+    """
+    Attach xdp_prog to every ingress interface, same program and so same maps. With BPF_PIN_DIR, the program of the
+    previous run is kept or replaced in place where it is attached, and the attached program is pinned
+    """
+    fn = b.load_func("xdp_prog", BPF.XDP)
+    previous = pinned_xdp_prog() if config.bpf_pin_dir else None
+    if previous is not None:
+        fn = adopt_xdp_prog(fn, previous)
+
+    for device, mode in zip(config.devices_in, config.xdp_modes):
+        if previous is not None and replace_xdp_prog(device, fn, previous):
+            continue
+
+        try:
+            logging.info(f"Trying to load XDP program on {device} in mode {mode} ...")
+            time_start = time.time()
+            b.attach_xdp(device, fn, flags=config.flags[mode])
+            logging.info(f"XDP program loaded on {device} in {(time.time() - time_start) * 1000:.2f} ms")
+
+        except Exception as e1:
+            logging.exception(e1)
+            logging.error(f"Fail to load XDP program on {device} in mode {mode}, falling back to SKB mode ...")
+            time_start = time.time()
+            try:
+                b.attach_xdp(device, fn, flags=config.flags["XDP_FLAGS_SKB_MODE"])
+                logging.info(f"XDP program loaded on {device} in skb mode in {(time.time() - time_start) * 1000:.2f} ms")
+            except Exception as e2:
+                logging.exception(e2)
+                logging.info("Can not load XDP program. Exit.")
+                sys.exit(1)
+
+    if config.bpf_pin_dir and fn is not previous:
+        bpfcache.pin(fn.fd, os.path.join(config.bpf_pin_dir, "xdp_prog"))
+
+
+def adopt_backend_tables():
+    """
+    Continue from the backend tables of the previous run (pinned maps): active generation and slots of each service,
+    so that the next update writes the inactive copy and backends keep their slot
+    """
+    table = b["backends"]
+    for service in config.services:
+        service_id = service["id"]
+        generation = b["backend_generation"][service_id].value
+        pool = service_id * 2 + generation
+        entries = [bytes(table[pool * config.max_backends + i]) for i in range(b["backend_counter"][pool].value)]
+
+        backend_generations[service_id] = generation
+        pool_keys[pool] = [backend_key(Backend.from_buffer_copy(entry)) for entry in entries]
+        pool_entries[pool] = entries
+        logging.info(f"Adopted {len(entries)} backends of service {service_id} in generation {generation}")
+
+
+def adopt_counters():
+    """
+    Rates of pinned counters start from their current values instead of zero
+    """
+    global latency_hist_total
+    global pkt_size_hist_total
+
+    for device, packet_counter_per_cpus in zip(config.devices_in, read_total_packets_processed().tolist()):
+        packet_counter_per_cpus_last_1s[device] = packet_counter_per_cpus
+    latency_hist_total = read_percpu_table(b["latency_hist"]).sum(axis=0, dtype=np.uint64).reshape(len(config.devices_in), -1)
+    pkt_size_hist_total = read_percpu_table(b["pkt_size_hist"]).sum(axis=0, dtype=np.uint64).reshape(len(config.devices_in), -1)
 
 
 def run_scheduler():
     """Run scheduler loop in background"""
     schedule.every(1).seconds.do(packet_rate_counter)
-    if config.vip != "":
+    if config.announced_vips:
         schedule.every(5).seconds.do(broadcast_arp)
+    if config.conntrack_timeout > 0:
+        schedule.every(10).seconds.do(conntrack_sweep)
+    # Reads every token bucket of every CPU
+    schedule.every(10).seconds.do(rate_limit_counter)
 
     while True:
         schedule.run_pending()
@@ -130,62 +686,132 @@ def run_scheduler():
 async def lifespan(app: FastAPI):
     # 🚀 Startup code
 
-    try:
-        logging.info(f"Trying to load XDP program in mode {config.xdp_mode} ...")
-        time_start = time.time()
-        b.attach_xdp(config.device_in, b.load_func("xdp_prog", BPF.XDP), flags=config.flags[config.xdp_mode])
-        logging.info(f"XDP program loaded in {(time.time() - time_start) * 1000:.2f} ms")
+    # Slots of the ingress interfaces, before attaching so that no packet is counted on another interface
+    for slot, device in enumerate(config.devices_in):
+        b["interfaces"][ctypes.c_uint32(socket.if_nametoindex(device))] = ctypes.c_uint32(slot)
 
-    except Exception as e1:
-        logging.exception(e1)
-        logging.error(f"Fail to load XDP program in mode {config.xdp_mode}, falling back to SKB mode ...")
-        time_start = time.time()
-        try:
-            b.attach_xdp(config.device_in, b.load_func("xdp_prog", BPF.XDP), flags=config.flags["XDP_FLAGS_SKB_MODE"])
-            logging.info(f"XDP program loaded in skb mode in {(time.time() - time_start) * 1000:.2f} ms")
-        except Exception as e2:
-            logging.exception(e2)
-            logging.info("Can not load XDP program. Exit.")
-            sys.exit(1)
+    logging.info(f"Max CPUs: {cpu_count()}")
 
-    b['rb'].open_ring_buffer(print_event)
+    global link_monitor
+    link_monitor = LinkMonitor(config.devices_in)
+    link_monitor.on_change = link_state_counter
+    link_monitor.start()
+    for device in config.devices_in:
+        ethtool_stats[device] = EthtoolStats(device)
+        logging.info(f"{len(ethtool_stats[device].names)} ethtool stats on {device}")
 
-    logging.info(f"Filter IP: {config.filter_ip}")
-    logging.info(f"Max CPUs: {cpu_count()}")
+    global event_consumer
+    event_consumer = RingBufferConsumer.from_map_fd(b["rb"].map_fd, b["rb"].max_entries, EVENT_DTYPE, config.event_buffer_size)
+    set_sample_rate(config.event_sample_rate)
+
+    global flow_consumer
+    flow_consumer = RingBufferConsumer.from_map_fd(b["flow_rb"].map_fd, b["flow_rb"].max_entries, FLOW_SAMPLE_DTYPE, FLOW_SAMPLE_BATCH)
+    set_flow_sample_rate(config.flow_sample_rate)
+    if ipfix_exporter is not None:
+        logging.info(f"Exporting the top {config.flow_export_top} flows of every {config.flow_window / config.flow_window_slots:g} s to {config.ipfix_collector} (IPFIX)")
 
-    set_backends(get_backends(config.servers))
-    set_filters(config.filter_ip, config.destination_ports)
+    logging.info(f"Backend selection algorithm: {config.lb_algorithm}")
+    b["lb_algorithm"][0] = ctypes.c_uint32(config.lb_algorithms[config.lb_algorithm])
 
-    # Device to send traffic
-    if config.device_in != config.device_out:
-        logging.info(f"Setting out interface to {config.device_out}")
-        b["tx_port"][0] = ctypes.c_int(socket.if_nametoindex(config.device_out))
+    logging.info(f"Checksum mode: {config.checksum_mode}")
+    b["csum_mode"][0] = ctypes.c_uint32(config.checksum_modes[config.checksum_mode])
 
-        source_ip_out = utils.get_ip_address(config.device_out)
-        logging.info(f"Setting out ip address to {source_ip_out}")
-        b["source_ip_out"][0] = ctypes.c_uint32(struct.unpack("I", socket.inet_aton(source_ip_out))[0])
+    set_rss(config.rss_cpus, config.rss_queue_size)
+
+    if config.conntrack_timeout > 0:
+        logging.info(f"Conntrack: {config.conntrack_max_flows} flows, idle timeout {config.conntrack_timeout} s, source ports {config.nat_port_min}-{config.nat_port_max}")
     else:
-        b["source_ip_out"][0] = ctypes.c_uint32(struct.unpack("I", socket.inet_aton(config.filter_ip))[0])
+        logging.info("Conntrack disabled")
+    b["conntrack_config"][0] = ConntrackConfig(
+        timeout_ns=int(config.conntrack_timeout * 1e9),
+        port_min=config.nat_port_min,
+        port_count=config.nat_port_max - config.nat_port_min + 1
+    )
 
-    # Load balancer mac address
-    b["lb_mac"][0] = MacAddr(
-        utils.get_mac_tuple(config.device_in if config.device_in == config.device_out else config.device_out))
+    host_configs["device_in_ip"] = get_ip_address(config.device_in)
+    host_configs["device_out_ip"] = get_ip_address(config.device_out)
+    host_configs["interfaces"] = [{
+        "device_in": device_in,
+        "device_in_ip": get_ip_address(device_in),
+        "device_out": device_out,
+        "device_out_ip": get_ip_address(device_out),
+    } for device_in, device_out in zip(config.devices_in, config.devices_out)]
+    host_configs["default_gateway_ip"] = get_default_gateway_ip()
+
+    global neighbor_cache
+    neighbor_cache = NeighborCache()
+    neighbor_cache.on_neighbor = lambda ip, mac: patch_backend_macs(ip)
+    neighbor_cache.on_route = patch_backend_macs
+    neighbor_cache.start()
+
+    set_services(config.services)
+
+    if config.bpf_pin_dir and b.adopted:
+        logging.info(f"Adopted {len(b.adopted)} pinned maps from {config.bpf_pin_dir}")
+        adopt_backend_tables()
+        adopt_counters()
+
+    global health_checker
+    if any(service["health_check"]["interval"] > 0 for service in config.services):
+        health_checker = HealthChecker(on_change=apply_service_backends)
+        await health_checker.start()
+
+    for service in config.services:
+        service_backends[service["id"]] = BackendRegistry(resolve_backends(service["backends"]))
+        service_locks[service["id"]] = threading.Lock()
+        sync_service_backends(service["id"])
+
+    for slot, (device_in, device_out) in enumerate(zip(config.devices_in, config.devices_out)):
+        # Device to send traffic, also used by the second stage of software RSS which can not send with XDP_TX
+        logging.info(f"Setting out interface of {device_in} to {device_out}")
+        b["tx_port"][slot] = ctypes.c_int(socket.if_nametoindex(device_out))
+
+        if device_in != device_out:
+            source_ip_out = utils.get_ip_address(device_out)
+            logging.info(f"Setting out ip address of {device_in} to {source_ip_out}")
+            b["source_ip_out"][slot] = ctypes.c_uint32(struct.unpack("I", socket.inet_aton(source_ip_out))[0])
+        else:
+            # Keep the VIP of each service as source address
+            b["source_ip_out"][slot] = ctypes.c_uint32(0)
+
+        # Load balancer mac address
+        b["lb_mac"][slot] = MacAddr(utils.get_mac_tuple(device_out))
+
+        # Outer source address of DSR packets
+        b["tunnel_source"][slot] = ctypes.c_uint32(struct.unpack("I", socket.inet_aton(get_ip_address(device_out)))[0])
+        b["tunnel_mtu"][slot] = ctypes.c_uint32(config.tunnel_mtu or get_mtu(device_out))
+
+        # Replies of tracked flows leave where their client packets came in
+        b["reply_port"][slot] = ctypes.c_int(socket.if_nametoindex(device_in))
+
+    # Attached once the maps are filled: a replaced program takes over with the whole state at once
+    attach_xdp_programs()
 
     logging.info(f"Listening on {config.listen_host}:{config.listen_port} ...")
 
     thread = threading.Thread(target=run_scheduler, daemon=True)
     thread.start()
 
+    threading.Thread(target=run_event_consumer, daemon=True).start()
+    threading.Thread(target=run_flow_consumer, daemon=True).start()
+
     logging.info("✅ Server has started up!")
 
-    xdp_time_start.labels(interface=config.device_in, host=HOSTNAME).set(time.time())
+    for device in config.devices_in:
+        xdp_time_start.labels(interface=device, host=HOSTNAME).set(time.time())
+    # Until the first collection
+    render_metrics()
 
     yield
 
     # 🛑 Shutdown code
     logging.info("🛑 Server is shutting down...")
-    logging.info(f"Removing XDP prog from NIC {config.device_in}")
-    b.remove_xdp(config.device_in, 0)
+    for device in config.devices_in:
+        if config.bpf_pin_dir:
+            logging.info(f"Leaving XDP prog attached to NIC {device}, state pinned in {config.bpf_pin_dir}")
+            continue
+        logging.info(f"Removing XDP prog from NIC {device}")
+        b.remove_xdp(device, 0)
 
 
 def custom_openapi():
@@ -209,175 +835,551 @@ app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 app.openapi = custom_openapi
 
 
-@app.post("/api/v1/backends", summary="Add new backend")
-def add_new_backends(new_backends: List[BackendRequest]):
-    logging.info("Setting new backends: " + json.dumps([be.model_dump() for be in new_backends]))
+def get_service(service_id: int):
+    if service_id not in services:
+        raise HTTPException(status_code=404, detail=f"Service {service_id} not found")
 
-    backends = [make_backend(be["ip"], be["port"], mac_string_to_int(be["mac"])) for be in get_backends_from_xdp()]
+    return services[service_id]
 
-    if len(new_backends) + len(backends) > b["backends"].max_entries:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Too many backends: {len(new_backends) + len(backends)}. Maximum number of backend is {b['backends'].max_entries}"
-        )
 
-    for backend in new_backends:
-        backends.append(make_backend(
-            backend.ip,
-            backend.port,
-            get_mac_str_by_ip(backend.ip) or mac_string_to_int(get_mac_str_by_ip(get_default_gateway_ip()))
-        ))
+@app.post("/api/v1/services/{service_id}/backends", summary="Add new backend to a service")
+def add_new_service_backends(service_id: int, new_backends: List[BackendRequest]):
+    return patch_service_backends(service_id, BackendPatchRequest(add=new_backends))
 
-    set_backends(backends)
 
-    return get_configs()
+@app.delete("/api/v1/services/{service_id}/backends", summary="Delete backends of a service")
+def delete_service_backends(service_id: int, deleted_backends: List[BackendRequest]):
+    return patch_service_backends(service_id, BackendPatchRequest(remove=deleted_backends))
 
 
-@app.delete("/api/v1/backends", summary="Delete backends")
-def delete_backend(deleted_backends: List[BackendRequest]):
+@app.put("/api/v1/services/{service_id}/backends", summary="Replace all backends of a service")
+def replace_service_backends(service_id: int, backends: List[BackendRequest]):
+    get_service(service_id)
+    logging.info(f"Replacing backends of service {service_id}: {len(backends)} backends")
+
+    with service_locks[service_id]:
+        change_service_backends(service_id, BackendRegistry(make_backends(backends)))
+
+    return get_service_configs(service_id)
+
+
+@app.patch("/api/v1/services/{service_id}/backends", summary="Add and remove backends of a service")
+def patch_service_backends(service_id: int, patch: BackendPatchRequest):
+    get_service(service_id)
+    logging.info(f"Patching backends of service {service_id}: " + json.dumps(patch.model_dump()))
+
+    with service_locks[service_id]:
+        registry = service_backends[service_id].copy()
+        registry.remove((be.ip, be.port) for be in patch.remove)
+        registry.add(make_backends(patch.add))
+
+        change_service_backends(service_id, registry)
+
+    return get_service_configs(service_id)
+
+
+@app.get("/api/v1/services/{service_id}/backends", summary="Get backends of a service")
+def get_service_backends(service_id: int):
+    get_service(service_id)
+
+    return get_active_backends(service_id)
+
+
+@app.get("/api/v1/services/{service_id}/health", summary="Get health of the backends of a service")
+def get_service_health(service_id: int):
+    get_service(service_id)
+
+    return get_backends_health(service_id)
+
 
-    new_backends = []
-    for current_be in get_backends_from_xdp():
-        for deleted_be in deleted_backends:
-            if current_be["ip"] == deleted_be.ip and current_be["port"] == deleted_be.port:
-                continue
+@app.get("/api/v1/services/{service_id}/rate_limit", summary="Get the rate limit of the sources of a service")
+def get_service_rate_limit(service_id: int):
+    get_service(service_id)
 
-            new_backends.append(make_backend(
-                current_be["ip"],
-                current_be["port"],
-                mac_string_to_int(current_be["mac"]),
-            ))
+    return services[service_id]["rate_limit"]
 
-    set_backends(new_backends)
+
+@app.put("/api/v1/services/{service_id}/rate_limit", summary="Set the rate limit and allow and deny lists of a service")
+def put_service_rate_limit(service_id: int, rate_limit: RateLimitRequest):
+    get_service(service_id)
+    logging.info(f"Setting rate limit of service {service_id}: " + json.dumps(rate_limit.model_dump()))
+
+    set_rate_limit(service_id, rate_limit.model_dump())
+
+    return get_service_rate_limit(service_id)
+
+
+@app.get("/api/v1/rate_limit/top", summary="Get the sources with the most rate limited packets")
+def get_rate_limited_sources():
+    return rate_limited_sources
+
+
+@app.put("/api/v1/backends/weights", summary="Set the weights of backends of any service")
+def put_backend_weights(weights: List[BackendWeightRequest]):
+    # Every backend is checked before any service is changed, each service then switches to its new weights at once
+    by_service = {}
+    for request in weights:
+        get_service(request.service)
+        by_service.setdefault(request.service, {})[(request.ip, request.port)] = request.weight
+
+    registries = {}
+    # Locks taken in service order, so that two requests on overlapping services can not deadlock
+    with ExitStack() as stack:
+        for service_id in sorted(by_service):
+            stack.enter_context(service_locks[service_id])
+
+        for service_id, service_weights in by_service.items():
+            registries[service_id] = service_backends[service_id].copy()
+            unknown = registries[service_id].set_weights(service_weights)
+            if unknown:
+                raise HTTPException(status_code=404, detail=f"Backends {[f'{ip}:{port}' for ip, port in unknown]} not found in service {service_id}")
+
+        for service_id, registry in registries.items():
+            logging.info(f"Setting weights of service {service_id}: " + ", ".join(f"{ip}:{port}={weight}" for (ip, port), weight in by_service[service_id].items()))
+            change_service_backends(service_id, registry)
+
+    return [get_service_configs(service_id) for service_id in sorted(registries)]
+
+
+@app.get("/api/v1/services", summary="Get services")
+def get_services():
+    return [get_service_configs(service_id) for service_id in sorted(services)]
+
+
+@app.post("/api/v1/backends", summary="Add new backend to the first service")
+def add_new_backends(new_backends: List[BackendRequest]):
+    add_new_service_backends(0, new_backends)
 
     return get_configs()
 
 
-def set_filters(filter_ip, destination_ports):
-    b["filter_ip"][0] = ctypes.c_uint32(struct.unpack("I", socket.inet_aton(filter_ip))[0])
-    filter_ports = b["filter_ports"]
+@app.delete("/api/v1/backends", summary="Delete backends of the first service")
+def delete_backend(deleted_backends: List[BackendRequest]):
+    delete_service_backends(0, deleted_backends)
+
+    return get_configs()
 
-    for destination_port in destination_ports:
-        logging.info(f"Filter destination: {filter_ip}:{destination_port}")
-        filter_ports[filter_ports.Key(destination_port)] = filter_ports.Leaf(1)
 
+def set_services(configured_services):
+    """
+    Write the (vip, protocol, port) -> service id table and the VIPs answered to ICMP echo
+    """
+    if len(configured_services) > config.max_services:
+        raise ValueError(f"Too many services: {len(configured_services)}. Maximum number of service is {config.max_services}")
+
+    services_table = b["services"]
+    vips_table = b["vips"]
+
+    for service in configured_services:
+        if service["protocol"] not in config.protocols:
+            raise ValueError(f"Service {service['name']}: unsupported protocol {service['protocol']}")
+        if service["forwarding"] not in config.forwarding_modes:
+            raise ValueError(f"Service {service['name']}: unsupported forwarding mode {service['forwarding']}")
+
+        vip = struct.unpack("I", socket.inet_aton(service["vip"]))[0]
+        vips_table[vips_table.Key(vip)] = vips_table.Leaf(1)
+
+        for port in service["ports"]:
+            logging.info(f"Service {service['id']} ({service['name']}): {service['vip']}:{port}/{service['protocol']}, {service['forwarding']}")
+            key = services_table.Key(vip=vip, port=socket.htons(port), proto=config.protocols[service["protocol"]], pad=0)
+            services_table[key] = services_table.Leaf(
+                id=service["id"],
+                forwarding=config.forwarding_modes[service["forwarding"]],
+                pad=0,
+                tunnel_port=socket.htons(service["tunnel_port"])
+            )
+
+        services[service["id"]] = {
+            "name": service["name"],
+            "vip": service["vip"],
+            "protocol": service["protocol"],
+            "ports": service["ports"],
+            "health_check": service["health_check"],
+            "forwarding": service["forwarding"],
+            "tunnel_port": service["tunnel_port"],
+        }
+        set_rate_limit(service["id"], service["rate_limit"])
+
+
+def set_rate_limit(service_id, limit):
+    """
+    Write the rate limit and the allow and deny lists of a service. New prefixes are written before the limit that
+    makes the program look them up, removed ones are deleted after
+    """
+    prefixes = {}
+    for action in config.source_actions:
+        for prefix in limit[action]:
+            try:
+                key = parse_source_prefix(prefix)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid source prefix {prefix}: {e}")
+            if prefixes.setdefault(key, action) != action:
+                raise HTTPException(status_code=400, detail=f"Source prefix {prefix} is both allowed and denied")
+
+    table = b["source_prefixes"]
+    service_key = socket.htonl(service_id)
+    for (saddr, prefixlen), action in prefixes.items():
+        table[table.Key(prefixlen=32 + prefixlen, service_id=service_key, saddr=saddr)] = table.Leaf(config.source_actions[action])
+
+    rate = limit["rate"]
+    burst = limit["burst"] or rate
+    cost, bucket_size = token_bucket(rate, burst, rate_limit_cpus)
+    b["rate_limits"][service_id] = RateLimit(
+        cost=cost,
+        burst=bucket_size,
+        mask=socket.htonl((0xffffffff << (32 - limit["prefix"])) & 0xffffffff),
+        lists=1 if prefixes else 0,
+    )
 
-def set_backends(backends):
-    for i in range(b["backends"].max_entries):
-        b["backends"][i] = backends[i] if i < len(backends) else get_empty_backend()
+    stale = [key for key in table.keys() if key.service_id == service_key and (key.saddr, key.prefixlen - 32) not in prefixes]
+    for key in stale:
+        del table[key]
 
-    # for i, backend in enumerate(backends):
-    #    b["backends"][i] = backend
+    services[service_id]["rate_limit"] = limit
+    if rate:
+        logging.info(f"Rate limit of service {service_id}: {rate} packets/s per /{limit['prefix']} source, burst {burst}, split over {rate_limit_cpus} RX CPUs, {len(limit['allow'])} allowed and {len(limit['deny'])} denied prefixes")
+    else:
+        logging.info(f"Rate limit of service {service_id} disabled, {len(limit['allow'])} allowed and {len(limit['deny'])} denied prefixes")
 
-    leaf_backend_counter = b["backend_counter"].Leaf()
-    for i in range(len(leaf_backend_counter)):
-        leaf_backend_counter[i] = ctypes.c_uint64(len(backends))
-    b["backend_counter"][ctypes.c_uint32(0)] = leaf_backend_counter
 
+def change_service_backends(service_id, registry: BackendRegistry):
+    """
+    Make registry the declared backends of a service and write the difference to the XDP tables
+    """
+    if len(registry) > config.max_backends:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many backends: {len(registry)}. Maximum number of backend is {config.max_backends}"
+        )
 
-def get_backends_from_xdp():
+    service_backends[service_id] = registry
+    sync_service_backends(service_id)
+
+
+def sync_service_backends(service_id):
+    """
+    Health check the declared backends of a service and write the healthy ones to the XDP tables
+    """
+    if health_checker is not None:
+        check = services[service_id]["health_check"]
+        targets = list(service_backends[service_id].backends) if check["interval"] > 0 else []
+        health_checker.set_targets(service_id, HealthCheck(
+            interval=check["interval"],
+            timeout=check["timeout"],
+            rise=check["rise"],
+            fall=check["fall"],
+            jitter=check["jitter"],
+            payload=parse_probe_bytes(check["payload"]),
+            response=parse_probe_bytes(check["response"]),
+            port=check["port"],
+        ), targets)
+
+    apply_service_backends(service_id)
+
+
+def make_backends(requests: List[BackendRequest]):
+    """
+    Backends of API requests, MAC addresses not given are looked up in the neighbor cache
+    """
+    resolved = iter(resolve_backends([(be.ip, be.port, be.weight) for be in requests if not be.mac]))
+    backends = [make_backend(be.ip, be.port, mac_string_to_int(be.mac), be.weight) if be.mac else next(resolved) for be in requests]
+
+    for backend, be in zip(backends, requests):
+        if be.tunnel_port:
+            backend.tunnel_port = socket.htons(be.tunnel_port)
+
+    return backends
+
+
+def resolve_backends(addresses):
+    """
+    Backends with the MAC of their next hop from the neighbor cache. Next hops not resolved yet get the default gateway
+    MAC until the kernel resolves them, patch_backend_macs then writes the right MAC
+    """
+    gateway_mac = None
     backends = []
-    for i in range(len(b["backends"])):  # len(table) = array size
-        entry = b["backends"][ctypes.c_int(i)]
-        if not entry.ip:  # skip empty slots
-            continue
 
+    for ip, port, weight in addresses:
+        mac = neighbor_cache.lookup(ip)
+        if mac is None:
+            neighbor_cache.resolve(ip)
+            if gateway_mac is None:
+                gateway_mac = neighbor_cache.lookup(get_default_gateway_ip()) or "00:00:00:00:00:00"
+            logging.warning(f"Next hop of backend {ip} is not resolved yet, using default gateway mac address {gateway_mac}")
+            mac = gateway_mac
+
+        backends.append(make_backend(ip, port, mac_string_to_int(mac), weight))
+
+    return backends
+
+
+def patch_backend_macs(next_hop=None):
+    """
+    Write the current MAC of the next hop of each backend (only the backends behind next_hop if set) into the declared
+    backends and the active backends table. Slots are updated in place, without rebuilding the tables
+    """
+    def current_mac(key):
+        hop = neighbor_cache.next_hop(key[0])
+        if next_hop is not None and hop != next_hop:
+            return None
+        mac = neighbor_cache.neighbors.get(hop)
+        return mac_string_to_int(mac) if mac else None
+
+    table = b["backends"]
+    patched = 0
+
+    with backends_lock:
+        for service_id, registry in service_backends.items():
+            for key, be in registry.backends.items():
+                mac = current_mac(key)
+                if mac and tuple(be.mac) != mac:
+                    be.mac = (ctypes.c_ubyte * 6)(*mac)
+
+            pool = service_id * 2 + get_backend_generation(service_id)
+            for i, key in enumerate(pool_keys.get(pool, [])):
+                mac = current_mac(key)
+                entry = Backend.from_buffer_copy(pool_entries[pool][i])
+                if mac and tuple(entry.mac) != mac:
+                    entry.mac = (ctypes.c_ubyte * 6)(*mac)
+                    table[ctypes.c_int(pool * config.max_backends + i)] = entry
+                    pool_entries[pool][i] = bytes(entry)
+                    patched += 1
+
+    if patched:
+        logging.info(f"Patched the mac address of {patched} backends" + (f" behind {next_hop}" if next_hop else ""))
+
+
+def apply_service_backends(service_id):
+    """
+    Write the healthy backends of a service to the XDP tables, or all of them when none is healthy
+    """
+    declared = service_backends[service_id]
+    healthy = list(declared)
+
+    if health_checker is not None:
+        healthy = [be for key, be in declared.backends.items() if health_checker.is_up(service_id, *key)]
+        if len(declared) and not healthy:
+            logging.warning(f"No healthy backend in service {service_id}, sending traffic to all {len(declared)} backends")
+            healthy = list(declared)
+
+    set_backends(healthy, service_id)
+
+
+def get_backends_health(service_id):
+    backends = []
+    for be in map(backend_to_dict, service_backends[service_id]):
+        state = health_checker.states.get((service_id, be["ip"], be["port"])) if health_checker is not None else None
         backends.append({
-            "ip": socket.inet_ntoa(struct.pack("I", entry.ip)),
-            "port": socket.ntohs(entry.port),
-            "mac": ":".join(f"{mac_bin:02x}" for mac_bin in entry.mac)
+            **be,
+            "up": state.up if state else True,
+            "checked": state is not None,
+            "rtt_ms": state.rtt * 1000 if state else 0.0,
+            "failures": state.failures if state else 0,
+            "last_error": state.last_error if state else "",
         })
 
     return backends
 
 
+def set_backends(backends, service_id=0):
+    """
+    Write backends into the inactive copy of the backend tables of a service, then make it active with a single map update.
+    Backends keep their slot across updates and only the slots that differ from the inactive copy are written
+    """
+    if len(backends) > config.max_backends:
+        raise ValueError(f"Too many backends: {len(backends)}. Maximum number of backend is {config.max_backends}")
+
+    with backends_lock:
+        generation = get_backend_generation(service_id)
+        active = service_id * 2 + generation
+        pool = service_id * 2 + 1 - generation
+
+        time_start = time.time()
+
+        by_key = {backend_key(be): be for be in backends}
+        keys = layout_slots(pool_keys.get(active, []), list(by_key))
+        entries = [bytes(by_key[key]) for key in keys]
+
+        previous = pool_entries.get(pool, [])
+        changed = [i for i, entry in enumerate(entries) if i >= len(previous) or previous[i] != entry]
+        if changed:
+            table = b["backends"]
+            values = np.frombuffer(bytearray(b"".join(entries[i] for i in changed)), dtype=np.dtype(table.Leaf))
+            update_table_batch(table, pool * config.max_backends + np.array(changed), values)
+
+        set_backend_slots(pool_keys.get(pool), keys, pool)
+
+        weights = [by_key[key].weight for key in keys]
+        if keys and not any(weights):
+            logging.warning(f"All {len(keys)} backends of service {service_id} are drained, sending traffic to all of them")
+            weights = [1] * len(keys)
+        # Same weights select like no weights, without the weighted tables
+        if equal_weights(weights):
+            weights = None
+
+        if config.lb_algorithm == "maglev":
+            set_maglev_table(keys, pool, weights)
+        else:
+            set_weighted_rr(weights, pool)
+
+        if pool not in pool_keys or len(keys) != len(pool_keys[pool]):
+            b["backend_counter"][pool] = ctypes.c_uint32(len(keys))
+
+        # Flip, packets pick up the new copy from here on
+        b["backend_generation"][service_id] = ctypes.c_uint32(1 - generation)
+
+        pool_keys[pool] = keys
+        pool_entries[pool] = entries
+        backend_generations[service_id] = 1 - generation
+
+        logging.info(f"{len(keys)} backends of service {service_id} written to generation {1 - generation} ({len(changed)} slots changed) in {(time.time() - time_start) * 1000:.2f} ms")
+
+        # Packets of the previous holders of the slots go to them. The few packets still selecting from the previous
+        # copy after the flip are credited to the new holders
+        with backend_stats_lock:
+            collect_backend_stats()
+            backend_labels[service_id] = [f"{ip}:{port}" for ip, port in keys]
+
+
+def set_backend_slots(previous, keys, pool):
+    """
+    (ip, port) -> slot of the backends of a copy of the backend tables, where tracked flows find their backend when it
+    moved to another slot. Without the previous keys of the copy (first write), its entries are found in the map
+    """
+    table = b["backend_slots"]
+
+    def slot_key(key):
+        ip, port = key
+        return table.Key(pool=pool, ip=struct.unpack("I", socket.inet_aton(ip))[0], port=socket.htons(port), pad=0)
+
+    if previous is None:
+        stale = [key for key in table.keys() if key.pool == pool]
+    else:
+        current = set(keys)
+        stale = [slot_key(key) for key in previous if key not in current]
+        previous = {key: i for i, key in enumerate(previous)}
+    for key in stale:
+        try:
+            del table[key]
+        except KeyError:
+            pass
+
+    for i, key in enumerate(keys):
+        if previous is None or previous.get(key) != i:
+            table[slot_key(key)] = ctypes.c_uint32(i)
+
+
+def get_backend_generation(service_id=0):
+    return backend_generations.get(service_id, 0)
+
+
+def set_maglev_table(keys, pool, weights=None):
+    table = b["maglev_table"]
+    size = config.maglev_table_size
+
+    if len(keys) * 10 > size:
+        logging.warning(f"Maglev table of {size} slots is too small for {len(keys)} backends, consider increasing MAGLEV_TABLE_SIZE")
+
+    backend_keys = maglev.backend_keys([struct.unpack("I", socket.inet_aton(ip))[0] for ip, _ in keys], [socket.htons(port) for _, port in keys])
+
+    time_start = time.time()
+    # Empty slots only happen without backends, xdp_prog does not select any backend in that case
+    lookup = np.maximum(maglev.build_maglev_table(backend_keys, size, weights), 0)
+    logging.info(f"Maglev table of {size} slots for {len(keys)} backends built in {(time.time() - time_start) * 1000:.2f} ms")
+
+    previous = pool_maglev.get(pool)
+    changed = np.arange(size) if previous is None else np.flatnonzero(lookup != previous)
+    if len(changed):
+        update_table_batch(table, pool * size + changed, lookup[changed])
+
+    pool_maglev[pool] = lookup
+
+
+def set_weighted_rr(weights, pool):
+    """
+    Weighted round robin sequence of a copy of the backend tables, none (plain round robin) without weights
+    """
+    sequence = weighted_round_robin(weights, config.weighted_rr_size) if weights else np.empty(0, dtype=np.int64)
+
+    previous = pool_weighted_rr.get(pool)
+    if previous is None or not np.array_equal(previous, sequence):
+        update_table_batch(b["weighted_rr"], pool * config.weighted_rr_size + np.arange(len(sequence)), sequence)
+        b["weighted_rr_counter"][pool] = ctypes.c_uint32(len(sequence))
+        if weights:
+            logging.info(f"Weighted round robin sequence of {len(sequence)} slots for {len(weights)} backends")
+
+    pool_weighted_rr[pool] = sequence
+
+
+def get_active_backends(service_id=0):
+    pool = service_id * 2 + get_backend_generation(service_id)
+    return [backend_to_dict(Backend.from_buffer_copy(entry)) for entry in pool_entries.get(pool, [])]
+
+
+def get_service_configs(service_id):
+    generation = get_backend_generation(service_id)
+    backends = get_active_backends(service_id)
+
+    return {
+        "id": service_id,
+        **services[service_id],
+        "backends": backends,
+        "declared_backends": len(service_backends.get(service_id, [])),
+        # Healthy or not, what fleet.py compares with its desired state
+        "declared": [backend_to_dict(backend) for backend in service_backends.get(service_id, [])],
+        "backend_counter": len(backends),
+        "backend_generation": generation,
+    }
+
+
 @app.get("/api/v1/configs", summary="Get current configurations")
 def get_configs():
-    filter_ip = socket.inet_ntoa(struct.pack("I", b["filter_ip"][ctypes.c_int(0)].value))
-    filter_ports = []
-    backends = get_backends_from_xdp()
-
-    for k, v in b["filter_ports"].items():
-        port = k.value  # the stored destination_port
-        enabled = v.value  # the value you stored (1)
-        if enabled:
-            filter_ports.append(port)
+    default_service = get_service_configs(0)
 
     return {
         "device_in": config.device_in,
-        "device_in_ip": get_ip_address(config.device_in) if config.vip == "" else config.vip,
+        "device_in_ip": host_configs["device_in_ip"] if config.vip == "" else config.vip,
         "device_out": config.device_out,
-        "device_out_ip": get_ip_address(config.device_out),
-        "default_gateway_ip": get_default_gateway_ip(),
-        "default_gateway_mac": get_mac_str_by_ip(get_default_gateway_ip()),
-        "filter_ip": filter_ip,
-        "filter_ports": filter_ports,
-        "backends": backends,
-        "backend_counter": b["backend_counter"][0][0]
+        "device_out_ip": host_configs["device_out_ip"],
+        "default_gateway_ip": host_configs["default_gateway_ip"],
+        "default_gateway_mac": neighbor_cache.neighbors.get(host_configs["default_gateway_ip"]),
+        "filter_ip": default_service["vip"],
+        "filter_ports": default_service["ports"],
+        "backends": default_service["backends"],
+        "backend_counter": default_service["backend_counter"],
+        "backend_generation": default_service["backend_generation"],
+        "lb_algorithm": config.lb_algorithm,
+        "checksum_mode": config.checksum_mode,
+        "interfaces": [{
+            **interface,
+            "xdp_mode": link_monitor.links[interface["device_in"]].xdp_attached,
+        } for interface in host_configs["interfaces"]],
+        "services": get_services()
     }
 
 
 @app.get("/metrics", summary="Get exported prometheus metrics")
-def get_metrics():
-    link_info = get_link_info_by_interface(config.device_in)
-
-    for metric_name in link_info["IFLA_STATS64"].keys():
-        interface_stat.labels(interface=config.device_in, host=HOSTNAME, type=metric_name).set(
-            link_info["IFLA_STATS64"][metric_name])
-
-    interface_stat.labels(interface=config.device_in, host=HOSTNAME, type="num_tx_queue").set(
-        link_info["IFLA_NUM_TX_QUEUES"])
-    interface_stat.labels(interface=config.device_in, host=HOSTNAME, type="num_rx_queue").set(
-        link_info["IFLA_NUM_RX_QUEUES"])
-
-    interface_stat.labels(interface=config.device_in, host=HOSTNAME, type="mtu").set(link_info["IFLA_MTU"])
-    interface_stat.labels(interface=config.device_in, host=HOSTNAME, type="mtu").set(link_info["IFLA_MTU"])
-    interface_stat.labels(interface=config.device_in, host=HOSTNAME, type="mtu").set(link_info["IFLA_MTU"])
-    interface_stat.labels(interface=config.device_in, host=HOSTNAME, type="mtu").set(link_info["IFLA_MTU"])
-    interface_stat.labels(interface=config.device_in, host=HOSTNAME, type="mtu").set(link_info["IFLA_MTU"])
-
-    for metric_name in link_info["IFLA_AF_SPEC"]["AF_INET"].keys():
-        interface_spec.labels(interface=config.device_in, host=HOSTNAME, type=metric_name).set(
-            link_info["IFLA_AF_SPEC"]["AF_INET"][metric_name])
-
-    # XDP mode
-    '''
-    "IFLA_XDP": {
-        "IFLA_XDP_SKB_PROG_ID": 1023,
-        "IFLA_XDP_ATTACHED": "xdpgeneric",
-        "IFLA_XDP_PROG_ID": 1023
-    },
-
-    "IFLA_XDP": {
-        "IFLA_XDP_DRV_PROG_ID": 1047,
-        "IFLA_XDP_ATTACHED": "xdp",
-        "IFLA_XDP_PROG_ID": 1047
-    },
-
-    "IFLA_XDP": {
-        "IFLA_XDP_ATTACHED": null
-    },
-
-    '''
+async def get_metrics(request: Request):
+    snapshot = metrics_snapshot
+    accept = request.headers.get("accept", "")
+    rendered = snapshot.openmetrics if "application/openmetrics-text" in accept else snapshot.text
+
+    headers = {
+        "ETag": rendered.etag,
+        "Vary": "Accept, Accept-Encoding",
+        "Cache-Control": "no-cache",
+        "Last-Modified": formatdate(snapshot.timestamp, usegmt=True),
+    }
 
-    xdp_prog_id.clear()
-    xdp_mode.clear()
+    if exposition.etag_matches(request.headers.get("if-none-match", ""), rendered.etag):
+        return Response(status_code=304, headers=headers)
 
-    if "IFLA_XDP" in link_info.keys() and "IFLA_XDP_ATTACHED" in link_info["IFLA_XDP"].keys() and link_info["IFLA_XDP"][
-        "IFLA_XDP_ATTACHED"]:
-        xdp_prog_id.labels(interface=config.device_in, host=HOSTNAME).inc(link_info["IFLA_XDP"].get("IFLA_XDP_PROG_ID"))
-        xdp_mode.labels(interface=config.device_in, host=HOSTNAME, mode=link_info["IFLA_XDP"]["IFLA_XDP_ATTACHED"]).set(
-            1)
-    else:
-        xdp_mode.labels(interface=config.device_in, host=HOSTNAME, mode="").set(0)
+    # Pre-compressed, the GZip middleware leaves responses with a Content-Encoding alone
+    if exposition.accepts_gzip(request.headers.get("accept-encoding", "")):
+        headers["Content-Encoding"] = "gzip"
+        return Response(rendered.body_gzip, media_type=rendered.content_type, headers=headers)
 
-    interface_qdisk.clear()
-    interface_qdisk.labels(interface=config.device_in, host=HOSTNAME, qdisk=link_info["IFLA_QDISC"]).set(1)
-
-    return Response(
-        generate_latest(xdp_collector_registry),
-        media_type=CONTENT_TYPE_LATEST
-    )
+    return Response(rendered.body, media_type=rendered.content_type, headers=headers)
 
 
 @app.get("/")
@@ -394,24 +1396,122 @@ def get_packet_rates():
     global packet_counter_rate_per_cpus_last_1s
 
     return {
-        "packet_processed": packet_counter_per_cpus_last_1s,
-        "packet_rate": packet_counter_rate_per_cpus_last_1s
+        # Summed over ingress interfaces
+        "packet_processed": [sum(v) for v in zip(*packet_counter_per_cpus_last_1s.values())],
+        "packet_rate": [sum(v) for v in zip(*packet_counter_rate_per_cpus_last_1s.values())],
+        "interfaces": {
+            device: {
+                "packet_processed": packet_counter_per_cpus_last_1s[device],
+                "packet_rate": packet_counter_rate_per_cpus_last_1s[device],
+            }
+            for device in config.devices_in
+        },
+        "backends": [
+            {
+                "service": service_id,
+                "backend": label,
+                "packets": int(backend_totals.get((service_id, label), [0, 0])[0]),
+                "bytes": int(backend_totals.get((service_id, label), [0, 0])[1]),
+                "packet_rate": int(backend_last_1s.get((service_id, label), [0, 0])[0]),
+                "byte_rate": int(backend_last_1s.get((service_id, label), [0, 0])[1]),
+            }
+            for service_id, labels in backend_labels.items()
+            for label in labels
+        ]
+    }
+
+
+@app.get("/api/v1/sampling", summary="Get event sample rate")
+def get_sampling():
+    return {
+        "rate": b["sample_rate"][0].value,
+        "events_consumed": event_consumer.total,
     }
 
 
-def print_event(ctx, data, size):
-    event = b['rb'].event(data)
-    # print(f"Receive packet size {event.pkt_size}")
-    # print(f"Receive time delta  {event.time_delta} ns")
+@app.put("/api/v1/sampling", summary="Set event sample rate")
+def put_sampling(sampling: SamplingRequest):
+    set_sample_rate(sampling.rate)
 
-    packet_latency_bucket.append(event.time_delta)
+    return get_sampling()
+
+
+@app.get("/api/v1/flows/sampling", summary="Get flow telemetry sample rate")
+def get_flow_sampling():
+    return {
+        "rate": flow_sample_rate,
+        "samples_consumed": flow_consumer.total,
+    }
+
+
+@app.put("/api/v1/flows/sampling", summary="Set flow telemetry sample rate")
+def put_flow_sampling(sampling: FlowSamplingRequest):
+    set_flow_sample_rate(sampling.rate)
+
+    return get_flow_sampling()
+
+
+@app.get("/api/v1/flows/top", summary="Get the flows, sources, destinations or backends with the most packets")
+def get_top_flows(by: str = "flow", limit: int = 20):
+    if by not in DIMENSIONS:
+        raise HTTPException(status_code=400, detail=f"by must be one of {', '.join(DIMENSIONS)}")
+
+    return {
+        "by": by,
+        "window": config.flow_window,
+        "sample_rate": flow_sample_rate,
+        # Estimated from the samples, each counts for sample_rate packets
+        "top": flow_telemetry.top(by, max(limit, 0), time.time()),
+    }
+
+
+@app.get("/api/v1/rss", summary="Get software RSS worker CPUs")
+def get_rss():
+    packet_rate = [sum(v) for v in zip(*packet_counter_rate_per_cpus_last_1s.values())]
+
+    return {
+        "cpus": rss_cpus,
+        "queue_size": rss_queue_size,
+        # Packets are counted on the CPU that rewrites them, the workers when software RSS is enabled
+        "packet_rate": {str(cpu): rate for cpu, rate in enumerate(packet_rate)},
+    }
+
+
+@app.put("/api/v1/rss", summary="Set software RSS worker CPUs")
+def put_rss(rss: RssRequest):
+    set_rss(rss.cpus, rss.queue_size)
+
+    return get_rss()
+
+
+@app.get("/api/v1/conntrack", summary="Get connection tracking state")
+def get_conntrack():
+    return {
+        "enabled": config.conntrack_timeout > 0,
+        "timeout": config.conntrack_timeout,
+        "max_flows": config.conntrack_max_flows,
+        "nat_port_range": [config.nat_port_min, config.nat_port_max],
+        "flows": conntrack_tables.active,
+        "events": dict(zip(config.conntrack_events, conntrack_events_total.tolist())),
+    }
+
+
+@app.get("/api/v1/events", summary="Get latest sampled events")
+def get_events(limit: int = 1000):
+    events = event_consumer.latest(limit)
+
+    return {
+        "pkt_size": events["pkt_size"].tolist(),
+        "time_delta": events["time_delta"].tolist(),
+    }
 
 
 @app.get("/api/v1/links", summary="Get links info")
 def get_link_info():
     return {
         "device_in": utils.get_link_info_by_interface(config.device_in),
-        "device_out": utils.get_link_info_by_interface(config.device_out)
+        "device_out": utils.get_link_info_by_interface(config.device_out),
+        "interfaces": {device: utils.get_link_info_by_interface(device) for device in config.devices_in},
     }
 
 
@@ -425,12 +1525,19 @@ async def custom_server_header(request, call_next):
 
 if __name__ == "__main__":
 
-    link_info = get_link_info_by_interface(config.device_in)
-    if link_info.get("IFLA_XDP", {}).get("IFLA_XDP_ATTACHED", None):
-        logging.error(
-            f"A xdp program is being attached to nic {config.device_in}: {json.dumps(link_info.get('IFLA_XDP', {}))}")
-        logging.error("Exiting ...")
-        sys.exit(1)
+    # A program pinned by a previous run is adopted, not a reason to exit
+    previous = pinned_xdp_prog() if config.bpf_pin_dir else None
+    pinned_prog_id = bpfcache.prog_info(previous.fd)[0].id if previous is not None else 0
+
+    for device in config.devices_in:
+        link_info = get_link_info_by_interface(device)
+        if pinned_prog_id and utils.get_xdp_attachment(device)[0] == pinned_prog_id:
+            logging.info(f"XDP program {pinned_prog_id} of a previous run attached to {device}, adopting it")
+        elif link_info.get("IFLA_XDP", {}).get("IFLA_XDP_ATTACHED", None):
+            logging.error(
+                f"A xdp program is being attached to nic {device}: {json.dumps(link_info.get('IFLA_XDP', {}))}")
+            logging.error("Exiting ...")
+            sys.exit(1)
 
     try:
         uvicorn.run(
@@ -443,7 +1550,9 @@ if __name__ == "__main__":
     except Exception as e:
         logging.error(e)
     finally:
-        if utils.get_loaded_xdp_program(config.device_in):
-            logging.warning("XDP program still attached, forcing it to be detached")
-            subprocess.run(["ip", "link", "set", "dev", config.device_in, "xdp", "off"])
-            subprocess.run(["ip", "link", "set", "dev", config.device_in, "xdpgeneric", "off"])
\ No newline at end of file
+        # Pinned programs stay attached on purpose
+        for device in config.devices_in:
+            if not config.bpf_pin_dir and utils.get_loaded_xdp_program(device):
+                logging.warning(f"XDP program still attached to {device}, forcing it to be detached")
+                subprocess.run(["ip", "link", "set", "dev", device, "xdp", "off"])
+                subprocess.run(["ip", "link", "set", "dev", device, "xdpgeneric", "off"])
\ No newline at end of file
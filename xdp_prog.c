@@ -9,47 +9,379 @@
 #define MAX_UDP_LENGTH 1500
 #define DEFAULT_TTL 64
 
+// Capacity of the backends table of each service, overridden from user space with -D__MAX_BACKENDS__
+#ifndef __MAX_BACKENDS__
+#define __MAX_BACKENDS__ 1024
+#endif
+
+// Number of services (backend pools), overridden from user space with -D__MAX_SERVICES__
+#ifndef __MAX_SERVICES__
+#define __MAX_SERVICES__ 16
+#endif
+
+// Number of possible CPUs, overridden from user space with -D__MAX_CPU__
+#ifndef __MAX_CPU__
+#define __MAX_CPU__ 64
+#endif
+
+// Number of ingress interfaces sharing the maps, overridden from user space with -D__MAX_INTERFACES__
+#ifndef __MAX_INTERFACES__
+#define __MAX_INTERFACES__ 1
+#endif
+
+// Capacity of the conntrack tables, overridden from user space with -D__MAX_FLOWS__
+#ifndef __MAX_FLOWS__
+#define __MAX_FLOWS__ 65536
+#endif
+
+// Capacity of the token bucket table of the rate limiter, overridden from user space with -D__MAX_RATE_LIMITED__
+#ifndef __MAX_RATE_LIMITED__
+#define __MAX_RATE_LIMITED__ 65536
+#endif
+
+// Capacity of the allow and deny lists over all services, overridden from user space with -D__MAX_SOURCE_PREFIXES__
+#ifndef __MAX_SOURCE_PREFIXES__
+#define __MAX_SOURCE_PREFIXES__ 16384
+#endif
+
+// Number of (vip, protocol, port) entries over all services
+#define MAX_SERVICE_KEYS 16384
+
+// Must be prime, overridden from user space with -D__MAGLEV_TABLE_SIZE__
+#ifndef __MAGLEV_TABLE_SIZE__
+#define __MAGLEV_TABLE_SIZE__ 4099
+#endif
+
+// Length of the weighted round robin sequence of each service, overridden from user space with -D__WEIGHTED_RR_SIZE__
+#ifndef __WEIGHTED_RR_SIZE__
+#define __WEIGHTED_RR_SIZE__ 4096
+#endif
+
+// Must match FLOW_HASH_SEED in maglev.py
+#define FLOW_HASH_SEED 0x9e3779b9
+
+// Backend selection algorithms, must match config.lb_algorithms
+#define LB_ALGORITHM_ROUND_ROBIN 0
+#define LB_ALGORITHM_MAGLEV 1
+
+// Checksum update after the rewrite, must match config.checksum_modes
+#define CSUM_MODE_INCREMENTAL 0    // RFC 1624 from the changed words, IP and UDP
+#define CSUM_MODE_ZERO 1           // full IP header recompute, UDP checksum set to 0
+#define CSUM_MODE_FULL 2           // full IP header and UDP (pseudo header + payload) recompute
+
+// Why a packet left xdp_prog, must match config.verdict_reasons
+#define VERDICT_FORWARD 0          // sent to a backend
+#define VERDICT_ICMP_ECHO 1        // ICMP echo to a VIP, answered
+#define VERDICT_SHORT_PACKET 2     // truncated ethernet, IP, ICMP or UDP header
+#define VERDICT_NOT_IPV4 3
+#define VERDICT_NOT_VIP 4          // ICMP not sent to a VIP
+#define VERDICT_ICMP_NOT_ECHO 5
+#define VERDICT_NOT_UDP 6
+#define VERDICT_NO_SERVICE 7       // no (vip, protocol, port) match
+#define VERDICT_NO_BACKENDS 8
+#define VERDICT_BAD_BACKEND 9      // backend slot out of range
+#define VERDICT_MAP_LOOKUP 10      // unexpected map lookup failure
+#define VERDICT_NO_LB_MAC 11
+#define VERDICT_CPU_REDIRECT 12    // handed to a worker CPU (software RSS first stage)
+#define VERDICT_REPLY 13           // backend reply of a tracked flow, sent back to the client
+#define VERDICT_NO_NAT_PORT 14     // no free source port for a new tracked flow
+#define VERDICT_ENCAP_FAILED 15    // no headroom for the outer headers of a DSR packet
+#define VERDICT_RATE_LIMITED 16    // token bucket of the source empty
+#define VERDICT_DENIED 17          // source in the deny list of the service
+#define VERDICT_ENCAP_TOO_BIG 18   // DSR packet larger than tunnel_mtu once encapsulated
+#define VERDICT_REASONS 19
+
+// XDP_ABORTED ... XDP_REDIRECT
+#define XDP_ACTIONS 5
+
+// Forwarding mode of a service, must match forwarding_modes in config.py
+#define FORWARDING_NAT 0           // addresses and ports rewritten, replies come back through the load balancer
+#define FORWARDING_IPIP 1          // DSR, client packet untouched inside an outer IPv4 header
+#define FORWARDING_GUE 2           // DSR, client packet untouched inside outer IPv4 and UDP headers (GUE variant 1)
+
+// Source port of GUE packets: 0xc000 | 14 bits of the flow hash, so that backends spread flows over their queues
+#define GUE_SPORT_BASE 0xc000
+#define GUE_SPORT_MASK 0x3fff
+
 //#define DEBUG 1
 
 struct backend_t {
     u32 ip;   // network byte order
     u16 port; // network byte order
-    u16 pad;  // padding to align to 4 bytes
+    u16 tunnel_port;  // GUE destination port, network byte order, 0 for the tunnel port of the service
     u8 mac[6];  // backend MAC
+    u16 weight;  // share of new flows, 0 to drain. Only read from user space, which builds the selection tables
 };
 
-// Allocate 4096 page (4096 * 4KB page size = 16MB buffer size)
-BPF_RINGBUF_OUTPUT(rb, 4096);
+struct service_key_t {
+    u32 vip;   // network byte order
+    u16 port;  // network byte order
+    u8 proto;  // IPPROTO_*
+    u8 pad;
+};
+
+struct service_t {
+    u32 id;    // backend pool of the service
+    u8 forwarding;    // FORWARDING_*
+    u8 pad;
+    u16 tunnel_port;  // GUE destination port, network byte order
+};
+
+// Services: (vip, protocol, port) -> backend pool
+BPF_HASH(services, struct service_key_t, struct service_t, MAX_SERVICE_KEYS);
+
+// VIPs of all services, answered to ICMP echo
+BPF_HASH(vips, u32, u8, __MAX_SERVICES__);
+
+// Store backend configs, each service has two copies of __MAX_BACKENDS__ slots starting at
+// (id * 2 + generation) * __MAX_BACKENDS__.
+// User space fills the inactive copy then flips backend_generation, so a packet never sees a half-written table
+BPF_ARRAY(backends, struct backend_t, __MAX_SERVICES__ * 2 * __MAX_BACKENDS__);
+
+// Packets and bytes sent to each backend, indexed by id * __MAX_BACKENDS__ + slot in the active copy of backends
+struct backend_stats_t {
+    u64 packets;
+    u64 bytes;
+};
+
+BPF_PERCPU_ARRAY(backend_stats, struct backend_stats_t, __MAX_SERVICES__ * __MAX_BACKENDS__);
+
+// Number of backends in each copy, indexed by id * 2 + generation
+BPF_ARRAY(backend_counter, u32, __MAX_SERVICES__ * 2);
+
+// Slot of each backend in a copy of backends, so that tracked flows follow their backend when it moves to another slot
+struct backend_slot_key_t {
+    u32 pool;   // id * 2 + generation
+    u32 ip;
+    u16 port;
+    u16 pad;
+};
+
+BPF_HASH(backend_slots, struct backend_slot_key_t, u32, __MAX_SERVICES__ * 2 * __MAX_BACKENDS__);
+
+// Active copy (0 or 1) of backends, backend_counter and maglev_table of each service
+BPF_ARRAY(backend_generation, u32, __MAX_SERVICES__);
+
+// Maglev lookup table: flow hash slot -> slot in backends, one copy per service and generation
+BPF_ARRAY(maglev_table, u32, __MAX_SERVICES__ * 2 * __MAGLEV_TABLE_SIZE__);
 
-// Store backend configs
-BPF_ARRAY(backends, struct backend_t, 16);
+// Weighted round robin: sequence of slots in backends where each backend appears in proportion to its weight, one copy
+// per service and generation like maglev_table
+BPF_ARRAY(weighted_rr, u32, __MAX_SERVICES__ * 2 * __WEIGHTED_RR_SIZE__);
 
-// Counter for number of backend
-BPF_PERCPU_ARRAY(backend_counter, u64, 1);
+// Length of each copy of weighted_rr, indexed by id * 2 + generation. 0 when all backends have the same weight, round
+// robin then goes over the slots of backends directly
+BPF_ARRAY(weighted_rr_counter, u32, __MAX_SERVICES__ * 2);
 
-// Processed packet counter
-BPF_PERCPU_ARRAY(counter, u64, 1);
+// Backend selection algorithm (LB_ALGORITHM_*)
+BPF_ARRAY(lb_algorithm, u32, 1);
 
-// filter: only match this dest ip/port
-BPF_ARRAY(filter_ip, u32, 1);
-BPF_HASH(filter_ports, __u16, __u8);
-BPF_ARRAY(source_ip_out, u32, 1);
+// Checksum update mode (CSUM_MODE_*)
+BPF_ARRAY(csum_mode, u32, 1);
 
-// device map for xdp_redirect (filled from user space)
-BPF_DEVMAP(tx_port, 1);
+// Slot of each ingress interface (ifindex -> slot), per interface maps below are indexed by slot.
+// Packets from an interface missing here use slot 0
+BPF_HASH(interfaces, u32, u32, __MAX_INTERFACES__);
+
+// Processed packet counter of each interface
+BPF_PERCPU_ARRAY(counter, u64, __MAX_INTERFACES__);
+
+// Packets per exit point of xdp_prog, indexed by (slot * VERDICT_REASONS + reason) * XDP_ACTIONS + action
+BPF_PERCPU_ARRAY(verdicts, u64, __MAX_INTERFACES__ * VERDICT_REASONS * XDP_ACTIONS);
+
+// Source IP of forwarded packets when sending out of another interface, 0 to keep the VIP
+BPF_ARRAY(source_ip_out, u32, __MAX_INTERFACES__);
+
+// device map for xdp_redirect, out interface of each slot, which is the in interface itself when packets are sent back
+// where they came from (filled from user space)
+BPF_DEVMAP(tx_port, __MAX_INTERFACES__);
 
-// Mac address of the load balancer
 struct macaddr {
     unsigned char addr[6];
 };
 
-BPF_ARRAY(lb_mac, struct macaddr, 1);
+// Mac address of the load balancer on the out interface of each slot
+BPF_ARRAY(lb_mac, struct macaddr, __MAX_INTERFACES__);
+
+// Software RSS: worker CPUs of the second stage, rss_cpus[0 .. rss_cpu_count). 0 workers to process packets on the
+// RX CPU in a single stage
+BPF_ARRAY(rss_cpus, u32, __MAX_CPU__);
+BPF_ARRAY(rss_cpu_count, u32, 1);
+
+// Queue size and second stage program (xdp_cpu_prog) of each worker CPU (filled from user space)
+BPF_XDP_REDIRECT_MAP("cpumap", struct bpf_cpumap_val, cpu_map, __MAX_CPU__);
+
+// Outer source address of DSR packets, address of the out interface of each slot (filled from user space)
+BPF_ARRAY(tunnel_source, u32, __MAX_INTERFACES__);
+
+// Largest IP packet sent to the backends of each slot, outer headers included (filled from user space, 0 = unchecked)
+BPF_ARRAY(tunnel_mtu, u32, __MAX_INTERFACES__);
+
+// Connection tracking (full-NAT): idle timeout of flows (0 = disabled, packets keep the client source port) and range
+// of source ports allocated to flows (filled from user space)
+struct conntrack_config_t {
+    u64 timeout_ns;
+    u32 port_min;
+    u32 port_count;
+};
+
+BPF_ARRAY(conntrack_config, struct conntrack_config_t, 1);
+
+// Client 5-tuple of a flow, as received
+struct flow_key_t {
+    u32 saddr;
+    u32 daddr;
+    u16 sport;
+    u16 dport;
+    u32 proto;
+};
+
+// Backend and source address of a flow, last_seen is bpf_ktime_get_ns()
+struct flow_t {
+    u32 backend_ip;
+    u16 backend_port;
+    u16 nat_port;
+    u32 nat_ip;
+    u32 index;     // slot of the backend in the pool of the service
+    u64 last_seen;
+};
+
+// Flows by client 5-tuple, with per-CPU LRU lists so that new flows do not contend on a single lock
+BPF_F_TABLE("lru_hash", struct flow_key_t, struct flow_t, conntrack, __MAX_FLOWS__, BPF_F_NO_COMMON_LRU);
+
+// Reply 5-tuple of a flow, backend -> source address and port allocated to the flow
+struct nat_key_t {
+    u32 backend_ip;
+    u32 nat_ip;
+    u16 backend_port;
+    u16 nat_port;
+    u32 proto;
+};
+
+// Client of a flow, to translate replies back
+struct nat_t {
+    u32 client_ip;
+    u32 vip;
+    u16 client_port;
+    u16 vport;
+    u32 slot;                              // interface slot the client packets come from
+    unsigned char client_mac[ETH_ALEN];    // source MAC of the client packets (client or router)
+    unsigned char lb_mac[ETH_ALEN];        // destination MAC of the client packets
+    u64 last_seen;
+};
+
+BPF_TABLE("lru_hash", struct nat_key_t, struct nat_t, conntrack_reverse, __MAX_FLOWS__);
+
+// Next source port to try on each CPU, as an offset in the range
+BPF_PERCPU_ARRAY(nat_port_next, u32, 1);
+
+// device map for replies, ingress interface of each slot (filled from user space)
+BPF_DEVMAP(reply_port, __MAX_INTERFACES__);
+
+// Must match conntrack_events in config.py
+#define CT_EVENT_CREATED 0         // new flow
+#define CT_EVENT_EXPIRED 1         // flow idle for timeout_ns, or its reply entry was evicted, replaced by a new one
+#define CT_EVENT_REASSIGNED 2      // backend of the flow left the pool, replaced by a new flow
+#define CT_EVENTS 3
+BPF_PERCPU_ARRAY(conntrack_events, u64, CT_EVENTS);
+
+// last_seen of a flow is written at most once per CT_REFRESH_NS
+#define CT_REFRESH_NS 1000000000ULL
+
+// Source ports tried for a new flow
+#define NAT_PORT_TRIES 8
+
+// Credit is counted in 1/2^RATE_LIMIT_SHIFT ns, so that the cost of a packet keeps its precision at high rates. Must
+// match RATE_LIMIT_SHIFT in utils.py
+#define RATE_LIMIT_SHIFT 10
+
+// Rate limit of the sources of a service (filled from user space). A packet costs `cost` of credit, a bucket holds at
+// most `burst` (burst packets), and earns 2^RATE_LIMIT_SHIFT of credit per ns. cost 0 disables the limiter
+struct rate_limit_t {
+    u64 cost;         // 1e9 * 2^RATE_LIMIT_SHIFT / rate
+    u64 burst;        // burst packets * cost
+    u32 mask;         // applied to the source address, network byte order: /32 per source, /24 per prefix
+    u32 lists;        // the service has allow or deny prefixes
+};
+
+BPF_ARRAY(rate_limits, struct rate_limit_t, __MAX_SERVICES__);
+
+struct rate_limit_key_t {
+    u32 service_id;
+    u32 saddr;        // network byte order, masked
+};
+
+// A new entry starts as a full bucket
+struct token_bucket_t {
+    u64 credit;
+    u64 last_ns;
+    u64 dropped;      // packets dropped by this bucket
+};
+
+// Token buckets of the sources, one per CPU so that the packets of a source never contend on a lock: each RX CPU
+// enforces its share of the limit (rate_limits is divided by the number of RX CPUs) on its own share of the traffic of
+// the source. The least recently used sources are evicted
+BPF_F_TABLE("lru_percpu_hash", struct rate_limit_key_t, struct token_bucket_t, rate_limit_buckets, __MAX_RATE_LIMITED__, 0);
+
+// Allow and deny lists of the services: longest prefix of (service id, source address), prefixlen counts the 32 bits
+// of service_id
+struct source_prefix_t {
+    u32 prefixlen;
+    u32 service_id;   // network byte order
+    u32 saddr;        // network byte order
+};
+
+// Must match source_actions in config.py
+#define SOURCE_ALLOW 1             // not rate limited
+#define SOURCE_DENY 2              // dropped
 
+BPF_F_TABLE("lpm_trie", struct source_prefix_t, u32, source_prefixes, __MAX_SOURCE_PREFIXES__, BPF_F_NO_PREALLOC);
+
+// Raw samples of forwarded packets for user space, 1 in sample_rate packets (0 = disabled)
 struct event {
     int pkt_size;
     int time_delta;
 };
 
+// Allocate 4096 page (4096 * 4KB page size = 16MB buffer size)
+BPF_RINGBUF_OUTPUT(rb, 4096);
+BPF_ARRAY(sample_rate, u32, 1);
+
+// Flow telemetry: header sample of a forwarded packet, taken before the rewrite. Must match FLOW_SAMPLE_DTYPE in
+// object.py
+struct flow_sample_t {
+    u32 saddr;          // client 5-tuple as received, network byte order
+    u32 daddr;
+    u16 sport;
+    u16 dport;
+    u32 backend_ip;     // network byte order
+    u16 backend_port;   // network byte order
+    u16 pkt_size;
+    u16 service_id;
+    u16 cpu;
+    u8 proto;
+    u8 pad[3];
+};
+
+// 1 in flow_sample_rate forwarded packets on average (0 = disabled), 256 pages (1MB)
+BPF_RINGBUF_OUTPUT(flow_rb, 256);
+BPF_ARRAY(flow_sample_rate, u32, 1);
+
+// Log-linear histograms of processing time (ns) and packet size (bytes) of forwarded packets, must match histogram.py.
+// Values below HIST_SUB_BUCKETS get their own bucket, then every power of two is split in HIST_SUB_BUCKETS buckets
+#define HIST_SUB_BITS 4
+#define HIST_SUB_BUCKETS (1 << HIST_SUB_BITS)
+#define HIST_BUCKETS 512
+
+// HIST_BUCKETS buckets per interface slot
+BPF_PERCPU_ARRAY(latency_hist, u64, __MAX_INTERFACES__ * HIST_BUCKETS);
+BPF_PERCPU_ARRAY(pkt_size_hist, u64, __MAX_INTERFACES__ * HIST_BUCKETS);
+
+// Sum of the values in each histogram, 2 per interface slot: 0 = processing time, 1 = packet size
+#define HIST_SUM_LATENCY 0
+#define HIST_SUM_PKT_SIZE 1
+BPF_PERCPU_ARRAY(hist_sum, u64, __MAX_INTERFACES__ * 2);
+
 
 static __always_inline __u16 csum_fold_helper(__u32 csum) {
     csum = (csum >> 16) + (csum & 0xffff);
@@ -83,6 +415,452 @@ static __always_inline __u16 iph_csum2(struct iphdr *ip) {
 
 }
 
+// RFC 1624 eqn. 3: HC' = ~(~HC + ~m + m'), accumulated over 16-bit words then folded once by csum_fold_helper
+static __always_inline u32 csum_replace32(u32 csum, u32 from, u32 to) {
+    return csum + (~from & 0xffff) + (~from >> 16) + (to & 0xffff) + (to >> 16);
+}
+
+static __always_inline u32 csum_replace16(u32 csum, u16 from, u16 to) {
+    return csum + (u16)~from + to;
+}
+
+// UDP checksum over the pseudo header, header and payload (up to udp->len, Ethernet padding excluded)
+static __always_inline __u16 udp_csum_full(struct iphdr *ip, struct udphdr *udp, void *data_end) {
+    u32 csum = (ip->saddr & 0xffff) + (ip->saddr >> 16) + (ip->daddr & 0xffff) + (ip->daddr >> 16);
+    csum += bpf_htons(IPPROTO_UDP) + udp->len;
+
+    udp->check = 0;
+    u32 len = bpf_ntohs(udp->len);
+    u16 *p = (u16 *)udp;
+
+    for (int i = 0; i < MAX_UDP_LENGTH / 2; i++) {
+        if (2 * i + 2 > len || (void *)(p + 1) > data_end) {
+            break;
+        }
+        csum += *p;
+        p++;
+    }
+
+    // Odd length: last byte padded with zero
+    if ((len & 1) && (void *)p + 1 <= data_end) {
+        csum += *(u8 *)p;
+    }
+
+    __u16 check = csum_fold_helper(csum);
+    // 0 means no checksum for UDP
+    return check ? check : 0xffff;
+}
+
+// Update IP and UDP checksums after rewriting addresses and ports, from their previous values (CSUM_MODE_*)
+static __always_inline void update_csums(struct iphdr *ip, struct udphdr *udp, void *data_end,
+                                         u32 saddr, u32 daddr, u16 sport, u16 dport) {
+    u32 i = 0;
+    u32 *mode = csum_mode.lookup(&i);
+    if (!mode || *mode == CSUM_MODE_INCREMENTAL) {
+        // saddr and daddr are in both the IP header and the UDP pseudo header, the ports in UDP only
+        u32 ip_csum = csum_replace32((u16)~ip->check, saddr, ip->saddr);
+        ip_csum = csum_replace32(ip_csum, daddr, ip->daddr);
+        ip->check = csum_fold_helper(ip_csum);
+
+        // 0 means the sender did not compute the UDP checksum, keep it that way
+        if (udp->check) {
+            u32 udp_csum = csum_replace32((u16)~udp->check, saddr, ip->saddr);
+            udp_csum = csum_replace32(udp_csum, daddr, ip->daddr);
+            udp_csum = csum_replace16(udp_csum, sport, udp->source);
+            udp_csum = csum_replace16(udp_csum, dport, udp->dest);
+            __u16 check = csum_fold_helper(udp_csum);
+            udp->check = check ? check : 0xffff;
+        }
+    } else {
+        ip->check = iph_csum(ip);
+
+        if (*mode == CSUM_MODE_FULL) {
+            udp->check = udp_csum_full(ip, udp, data_end);
+        } else {
+            udp->check = 0;
+        }
+    }
+}
+
+// floor(log2(v)), v > 0
+static __always_inline u32 log2_u64(u64 v) {
+    u32 r = 0;
+    if (v >> 32) { v >>= 32; r += 32; }
+    if (v >> 16) { v >>= 16; r += 16; }
+    if (v >> 8) { v >>= 8; r += 8; }
+    if (v >> 4) { v >>= 4; r += 4; }
+    if (v >> 2) { v >>= 2; r += 2; }
+    if (v >> 1) { r += 1; }
+    return r;
+}
+
+static __always_inline u32 hist_bucket(u64 v) {
+    if (v < HIST_SUB_BUCKETS) {
+        return v;
+    }
+
+    u32 exponent = log2_u64(v);
+    u32 bucket = (exponent - HIST_SUB_BITS + 1) * HIST_SUB_BUCKETS + ((v >> (exponent - HIST_SUB_BITS)) & (HIST_SUB_BUCKETS - 1));
+    return bucket < HIST_BUCKETS ? bucket : HIST_BUCKETS - 1;
+}
+
+static __always_inline void hist_record(u32 slot, u64 time_delta, u64 pkt_size) {
+    u32 bucket = slot * HIST_BUCKETS + hist_bucket(time_delta);
+    u64 *count = latency_hist.lookup(&bucket);
+    if (count) {
+        (*count)++;
+    }
+
+    bucket = slot * HIST_BUCKETS + hist_bucket(pkt_size);
+    count = pkt_size_hist.lookup(&bucket);
+    if (count) {
+        (*count)++;
+    }
+
+    u32 k = slot * 2 + HIST_SUM_LATENCY;
+    u64 *sum = hist_sum.lookup(&k);
+    if (sum) {
+        *sum += time_delta;
+    }
+
+    k = slot * 2 + HIST_SUM_PKT_SIZE;
+    sum = hist_sum.lookup(&k);
+    if (sum) {
+        *sum += pkt_size;
+    }
+}
+
+// murmur3 finalizer
+static __always_inline u32 hash_mix32(u32 h) {
+    h ^= h >> 16;
+    h *= 0x85ebca6b;
+    h ^= h >> 13;
+    h *= 0xc2b2ae35;
+    h ^= h >> 16;
+    return h;
+}
+
+// Hash of the UDP 5-tuple, fields are used as loaded (network byte order). Mirrored by maglev.flow_hash()
+static __always_inline u32 flow_hash(struct iphdr *ip, struct udphdr *udp) {
+    u32 h = hash_mix32(ip->saddr ^ FLOW_HASH_SEED);
+    h = hash_mix32(h ^ ip->daddr);
+    h = hash_mix32(h ^ (((u32)udp->source << 16) | udp->dest));
+    return hash_mix32(h ^ ip->protocol);
+}
+
+// Slot of the interface the packet was received on
+static __always_inline u32 interface_slot(struct xdp_md *ctx) {
+    u32 ifindex = ctx->ingress_ifindex;
+    u32 *slot = interfaces.lookup(&ifindex);
+    return slot ? *slot : 0;
+}
+
+// Count the packet in verdicts of the interface slot and return action
+static __always_inline int verdict(u32 slot, u32 reason, int action) {
+    u32 key = (slot * VERDICT_REASONS + reason) * XDP_ACTIONS + action;
+    u64 *count = verdicts.lookup(&key);
+    if (count) {
+        (*count)++;
+    }
+    return action;
+}
+
+// Allow and deny lists then token bucket of the source of a packet to a service with a rate limit, returns the
+// VERDICT_* of a dropped packet or VERDICT_FORWARD
+static __always_inline u32 source_check(struct rate_limit_t *limit, u32 service_id, u32 saddr, u64 now) {
+    if (limit->lists) {
+        struct source_prefix_t prefix = {
+            .prefixlen = 64,
+            .service_id = bpf_htonl(service_id),
+            .saddr = saddr,
+        };
+        u32 *action = source_prefixes.lookup(&prefix);
+        if (action && *action == SOURCE_DENY) {
+            return VERDICT_DENIED;
+        }
+        if (action && *action == SOURCE_ALLOW) {
+            return VERDICT_FORWARD;
+        }
+    }
+
+    if (!limit->cost) {
+        return VERDICT_FORWARD;
+    }
+
+    struct rate_limit_key_t key = {
+        .service_id = service_id,
+        .saddr = saddr & limit->mask,
+    };
+    struct token_bucket_t *bucket = rate_limit_buckets.lookup(&key);
+    if (!bucket) {
+        // Full bucket, minus this packet
+        struct token_bucket_t new_bucket = {
+            .credit = limit->burst - limit->cost,
+            .last_ns = now,
+        };
+        rate_limit_buckets.update(&key, &new_bucket);
+        return VERDICT_FORWARD;
+    }
+
+    // A long idle bucket is full, without shifting an elapsed time that could overflow
+    u64 elapsed = now - bucket->last_ns;
+    u64 credit = limit->burst;
+    if (elapsed < limit->burst >> RATE_LIMIT_SHIFT) {
+        credit = bucket->credit + (elapsed << RATE_LIMIT_SHIFT);
+        if (credit > limit->burst) {
+            credit = limit->burst;
+        }
+    }
+    bucket->last_ns = now;
+    if (credit < limit->cost) {
+        bucket->credit = credit;
+        bucket->dropped++;
+        return VERDICT_RATE_LIMITED;
+    }
+    bucket->credit = credit - limit->cost;
+    return VERDICT_FORWARD;
+}
+
+static __always_inline void conntrack_event(u32 event) {
+    u64 *count = conntrack_events.lookup(&event);
+    if (count) {
+        (*count)++;
+    }
+}
+
+// Reply entry of a flow
+static __always_inline void flow_nat_key(struct flow_t *flow, struct nat_key_t *nat_key) {
+    nat_key->backend_ip = flow->backend_ip;
+    nat_key->nat_ip = flow->nat_ip;
+    nat_key->backend_port = flow->backend_port;
+    nat_key->nat_port = flow->nat_port;
+    nat_key->proto = IPPROTO_UDP;
+}
+
+// The source port of an idle flow can be given to another client, a reply entry only belongs to the flow of its client
+static __always_inline int nat_owned(struct nat_t *nat, struct flow_key_t *flow_key) {
+    return nat->client_ip == flow_key->saddr && nat->client_port == flow_key->sport &&
+           nat->vip == flow_key->daddr && nat->vport == flow_key->dport;
+}
+
+// A flow is alive while either direction had a packet within timeout and its reply entry is still there.
+// Both entries are refreshed together
+static __always_inline int flow_alive(struct flow_t *flow, struct flow_key_t *flow_key, u64 timeout, u64 now) {
+    if ((s64)(now - flow->last_seen) <= (s64)CT_REFRESH_NS) {
+        return 1;
+    }
+
+    struct nat_key_t nat_key = {};
+    flow_nat_key(flow, &nat_key);
+    struct nat_t *nat = conntrack_reverse.lookup(&nat_key);
+    if (!nat || !nat_owned(nat, flow_key)) {
+        return 0;
+    }
+
+    if ((s64)(now - flow->last_seen) > (s64)timeout && (s64)(now - nat->last_seen) > (s64)timeout) {
+        return 0;
+    }
+
+    flow->last_seen = now;
+    nat->last_seen = now;
+    return 1;
+}
+
+// Insert the reply entry of a new flow with a free source port, or the port of an idle flow.
+// Returns 0 when every port tried is taken
+static __always_inline int nat_port_alloc(struct nat_key_t *nat_key, struct nat_t *nat, struct conntrack_config_t *ct, u64 now) {
+    u32 k = 0;
+    u32 *next = nat_port_next.lookup(&k);
+    if (!next || ct->port_count == 0) {
+        return 0;
+    }
+
+    // CPUs start from different offsets of the range
+    u32 offset = bpf_get_smp_processor_id() * (ct->port_count / __MAX_CPU__ + 1);
+
+    for (int i = 0; i < NAT_PORT_TRIES; i++) {
+        u32 port = ct->port_min + (offset + *next) % ct->port_count;
+        (*next)++;
+        nat_key->nat_port = bpf_htons(port);
+
+        if (conntrack_reverse.insert(nat_key, nat) == 0) {
+            return 1;
+        }
+
+        struct nat_t *old = conntrack_reverse.lookup(nat_key);
+        if (old && (s64)(now - old->last_seen) > (s64)ct->timeout_ns) {
+            conntrack_reverse.update(nat_key, nat);
+            return 1;
+        }
+    }
+
+    return 0;
+}
+
+// Translate a backend reply of a tracked flow back to its client: from the VIP and service port, to the client
+static __always_inline int conntrack_reply(u32 slot, void *data_end, struct ethhdr *eth, struct iphdr *ip,
+                                           struct udphdr *udp, struct nat_t *nat, u64 now) {
+    u32 saddr = ip->saddr;
+    u32 daddr = ip->daddr;
+    u16 sport = udp->source;
+    u16 dport = udp->dest;
+
+    ip->saddr = nat->vip;
+    ip->daddr = nat->client_ip;
+    udp->source = nat->vport;
+    udp->dest = nat->client_port;
+    update_csums(ip, udp, data_end, saddr, daddr, sport, dport);
+
+    __builtin_memcpy(eth->h_dest, nat->client_mac, ETH_ALEN);
+    __builtin_memcpy(eth->h_source, nat->lb_mac, ETH_ALEN);
+
+    if ((s64)(now - nat->last_seen) > (s64)CT_REFRESH_NS) {
+        nat->last_seen = now;
+    }
+
+    if (nat->slot == slot) {
+        return verdict(slot, VERDICT_REPLY, XDP_TX);
+    }
+
+    // XDP_REDIRECT, or XDP_ABORTED when the devmap entry is missing
+    return verdict(slot, VERDICT_REPLY, reply_port.redirect_map(nat->slot, 0));
+}
+
+static __always_inline void outer_iph_init(struct iphdr *outer, struct iphdr *inner, u32 saddr, u32 daddr, u8 protocol, u16 tot_len) {
+    outer->version = 4;
+    outer->ihl = sizeof(struct iphdr) >> 2;
+    outer->tos = inner->tos;
+    outer->tot_len = bpf_htons(tot_len);
+    outer->id = 0;
+    outer->frag_off = 0;
+    outer->ttl = DEFAULT_TTL;
+    outer->protocol = protocol;
+    outer->saddr = saddr;
+    outer->daddr = daddr;
+    outer->check = 0;
+    outer->check = iph_csum(outer);
+}
+
+// DSR: prepend an outer IPv4 header (and a UDP header for GUE) addressed to the backend, and the ethernet header.
+// The client packet is left untouched, packet pointers taken before are invalid afterwards. Returns 0 on success
+static __always_inline int encap_len(u32 forwarding) {
+    return forwarding == FORWARDING_GUE ? sizeof(struct iphdr) + sizeof(struct udphdr) : sizeof(struct iphdr);
+}
+
+static __always_inline int encap(struct xdp_md *ctx, u32 forwarding, struct backend_t *be, u16 tunnel_port,
+                                 struct macaddr *lb, u32 saddr, u32 hash) {
+    int outer_len = encap_len(forwarding);
+    if (bpf_xdp_adjust_head(ctx, -outer_len)) {
+        return -1;
+    }
+
+    void *data_end = (void *)(long)ctx->data_end;
+    void *data     = (void *)(long)ctx->data;
+    struct ethhdr *eth = data;
+    struct iphdr *outer = (void *)(eth + 1);
+    if ((void *)(outer + 1) > data_end) {
+        return -1;
+    }
+
+    // Overwrites the original ethernet header, now between the outer and the inner IP headers
+    __builtin_memcpy(eth->h_dest, be->mac, ETH_ALEN);
+    __builtin_memcpy(eth->h_source, lb->addr, ETH_ALEN);
+    eth->h_proto = bpf_htons(ETH_P_IP);
+
+    if (forwarding == FORWARDING_GUE) {
+        struct udphdr *udp = (void *)(outer + 1);
+        struct iphdr *inner = (void *)(udp + 1);
+        if ((void *)(inner + 1) > data_end) {
+            return -1;
+        }
+
+        u16 inner_len = bpf_ntohs(inner->tot_len);
+        udp->source = bpf_htons(GUE_SPORT_BASE | (hash & GUE_SPORT_MASK));
+        udp->dest = tunnel_port;
+        udp->len = bpf_htons(inner_len + sizeof(struct udphdr));
+        // Optional over IPv4
+        udp->check = 0;
+        outer_iph_init(outer, inner, saddr, be->ip, IPPROTO_UDP, inner_len + sizeof(struct iphdr) + sizeof(struct udphdr));
+    } else {
+        struct iphdr *inner = (void *)(outer + 1);
+        if ((void *)(inner + 1) > data_end) {
+            return -1;
+        }
+
+        u16 inner_len = bpf_ntohs(inner->tot_len);
+        outer_iph_init(outer, inner, saddr, be->ip, IPPROTO_IPIP, inner_len + sizeof(struct iphdr));
+    }
+
+    return 0;
+}
+
+// Send the header of 1 in flow_sample_rate packets to flow_rb. Picked at random, not by packet counter: round robin
+// also goes by the packet counter, every sample would come from the same backends
+static __always_inline void flow_sample(struct iphdr *ip, struct udphdr *udp, u32 service_id, struct backend_t *be, int pkt_size) {
+    u32 i = 0;
+    u32 *rate = flow_sample_rate.lookup(&i);
+    if (!rate || !*rate || bpf_get_prandom_u32() % *rate) {
+        return;
+    }
+
+    struct flow_sample_t *sample = flow_rb.ringbuf_reserve(sizeof(struct flow_sample_t));
+    if (!sample) {
+        return;
+    }
+    sample->saddr = ip->saddr;
+    sample->daddr = ip->daddr;
+    sample->sport = udp->source;
+    sample->dport = udp->dest;
+    sample->backend_ip = be->ip;
+    sample->backend_port = be->port;
+    sample->pkt_size = pkt_size;
+    sample->service_id = service_id;
+    sample->cpu = bpf_get_smp_processor_id();
+    sample->proto = ip->protocol;
+
+    // User space consumes on a timer, skip the wakeup to keep the submit cheap
+    flow_rb.ringbuf_submit(sample, BPF_RB_NO_WAKEUP);
+}
+
+// Account a packet sent to a backend and send it, out of the ingress interface (XDP_TX) or through the tx_port devmap
+static __always_inline int forward(u32 slot, u32 service_id, u32 index, int pkt_size, u64 time_start, u64 pktcnt, int redirect) {
+    u32 stats_index = service_id * __MAX_BACKENDS__ + index;
+    struct backend_stats_t *stats = backend_stats.lookup(&stats_index);
+    if (stats) {
+        stats->packets++;
+        stats->bytes += pkt_size;
+    }
+
+    u64 time_delta = bpf_ktime_get_ns() - time_start;
+#ifdef DEBUG
+    bpf_trace_printk("time delta: %d", time_delta);
+#endif
+    hist_record(slot, time_delta, pkt_size);
+
+    u32 i = 0;
+    u32 *rate = sample_rate.lookup(&i);
+    if (rate && *rate && pktcnt % *rate == 0) {
+        struct event *event = rb.ringbuf_reserve(sizeof(struct event));
+        if (event) {
+            event->pkt_size = pkt_size;
+            event->time_delta = time_delta;
+
+            // User space consumes on a timer, skip the wakeup to keep the submit cheap
+            rb.ringbuf_submit(event, BPF_RB_NO_WAKEUP);
+        }
+    }
+
+    if (!redirect) {
+#ifdef DEBUG
+        bpf_trace_printk("Source IP out not set, returning XDP_TX");
+#endif
+        return verdict(slot, VERDICT_FORWARD, XDP_TX);
+    } else {
+        // XDP_REDIRECT, or XDP_ABORTED when the devmap entry is missing
+        return verdict(slot, VERDICT_FORWARD, tx_port.redirect_map(slot, 0));
+    }
+}
+
 // https://github.com/facebookincubator/katran/blob/8f4b9b5badcd458084bcab805403616df524f87e/katran/lib/bpf/handle_icmp.h#L40
 __attribute__((__always_inline__))
 static inline int swap_mac_and_send(void* data, void* data_end) {
@@ -139,10 +917,14 @@ static inline int send_icmp_reply(void* data, void* data_end) {
 
 
 
-int xdp_prog(struct xdp_md *ctx) {
+// Whole pipeline on the RX CPU, or its first stage (parse, filter, service lookup) then its second stage (backend
+// selection, rewrite, transmit) on a worker CPU when software RSS is enabled
+static __always_inline int lb_process(struct xdp_md *ctx, int second_stage) {
 
     u64 time_start = bpf_ktime_get_ns();
 
+    u32 slot = interface_slot(ctx);
+
     int pkt_size = (int)(ctx->data_end - ctx->data);
 
     void *data_end = (void *)(long)ctx->data_end;
@@ -151,78 +933,129 @@ int xdp_prog(struct xdp_md *ctx) {
 
     // Check if ethernet header size > packet size (invalid packet)
     if ((void *)(eth + 1) > data_end) {
-        return XDP_PASS;
+        return verdict(slot, VERDICT_SHORT_PACKET, XDP_PASS);
     }
 
     // Check if ethernet frame is carrying an IP packet
     if (eth->h_proto != __constant_htons(ETH_P_IP)) {
-        return XDP_PASS;
+        return verdict(slot, VERDICT_NOT_IPV4, XDP_PASS);
     }
 
     // Check valid IP packet
     struct iphdr *ip = (void *)(eth + 1);
     if ((void *)(ip + 1) > data_end) {
-        return XDP_PASS;
-    }
-
-    // Filter IP
-    u32 fk = 0;
-    u32 *fip = filter_ip.lookup(&fk);
-    if (!fip || *fip != ip->daddr) {
-#ifdef DEBUG
-        bpf_trace_printk("Not match filter ip");
-#endif
-        return XDP_PASS;
+        return verdict(slot, VERDICT_SHORT_PACKET, XDP_PASS);
     }
 
+    u32 vip = ip->daddr;
 
     // Handle ICMP
     if (ip->protocol == IPPROTO_ICMP) {
+        u8 *is_vip = vips.lookup(&vip);
+        if (!is_vip) {
+#ifdef DEBUG
+            bpf_trace_printk("Not match any vip");
+#endif
+            return verdict(slot, VERDICT_NOT_VIP, XDP_PASS);
+        }
+
         struct icmphdr *icmph = (struct icmphdr *)(ip + 1);
         if ((void *)(icmph + 1) > data_end) {
-            return XDP_PASS;
+            return verdict(slot, VERDICT_SHORT_PACKET, XDP_PASS);
         }
 
         if (icmph->type != ICMP_ECHO) {
-            return XDP_PASS;
+            return verdict(slot, VERDICT_ICMP_NOT_ECHO, XDP_PASS);
         }
 
 #ifdef DEBUG
-        bpf_trace_printk("Replying to ICMP_ECHO to filter ip %d", *fip);
+        bpf_trace_printk("Replying to ICMP_ECHO to vip 0x%x", bpf_ntohl(vip));
 #endif
 
-        return send_icmp_reply(data, data_end);
+        return verdict(slot, VERDICT_ICMP_ECHO, send_icmp_reply(data, data_end));
     }
 
     // Filter protocol
     if (ip->protocol != IPPROTO_UDP) {
-        return XDP_PASS;
+        return verdict(slot, VERDICT_NOT_UDP, XDP_PASS);
     }
 
     struct udphdr *udp = (void *)(ip + 1);
 
     // Check valid UDP packet
     if ((void *)(udp + 1) > data_end) {
-        return XDP_PASS;
+        return verdict(slot, VERDICT_SHORT_PACKET, XDP_PASS);
     }
 
-    // Filter port
-    u16 dport = __constant_ntohs(udp->dest);
+    // Backend replies of tracked flows, before the service lookup as the source port of a flow can be a service port
+    if (!second_stage) {
+        u32 k = 0;
+        struct conntrack_config_t *ct = conntrack_config.lookup(&k);
+        if (ct && ct->timeout_ns) {
+            struct nat_key_t nat_key = {
+                .backend_ip = ip->saddr,
+                .nat_ip = ip->daddr,
+                .backend_port = udp->source,
+                .nat_port = udp->dest,
+                .proto = IPPROTO_UDP,
+            };
+            struct nat_t *nat = conntrack_reverse.lookup(&nat_key);
+            if (nat && (s64)(time_start - nat->last_seen) <= (s64)ct->timeout_ns) {
+                return conntrack_reply(slot, data_end, eth, ip, udp, nat, time_start);
+            }
+        }
+    }
+
+    // Find the service
+    struct service_key_t service_key = {
+        .vip = vip,
+        .port = udp->dest,
+        .proto = IPPROTO_UDP,
+        .pad = 0,
+    };
 #ifdef DEBUG
-    bpf_trace_printk("Checking port %d", dport);
+    bpf_trace_printk("Checking service 0x%x:%d", bpf_ntohl(vip), __constant_ntohs(udp->dest));
 #endif
 
-    __u8 *exists = filter_ports.lookup(&dport);
-    if (!exists) {
+    struct service_t *service = services.lookup(&service_key);
+    if (!service) {
 #ifdef DEBUG
-        bpf_trace_printk("Not match filter port");
+        bpf_trace_printk("Not match any service");
 #endif
-        return XDP_PASS;
+        return verdict(slot, VERDICT_NO_SERVICE, XDP_PASS);
     }
 
-#ifdef DEBUG
-    bpf_trace_printk("Filter IP: 0x%x", bpf_ntohl(*fip));
-#endif
+    u32 service_id = service->id;
+    u32 forwarding = service->forwarding;
+    u16 tunnel_port = service->tunnel_port;
+    if (service_id >= __MAX_SERVICES__) {
+        return verdict(slot, VERDICT_NO_SERVICE, XDP_PASS);
+    }
+
+    // Flood protection, on the RX CPU before any work on the packet
+    if (!second_stage) {
+        struct rate_limit_t *limit = rate_limits.lookup(&service_id);
+        if (limit && (limit->cost || limit->lists)) {
+            u32 reason = source_check(limit, service_id, ip->saddr, time_start);
+            if (reason != VERDICT_FORWARD) {
+                return verdict(slot, reason, XDP_DROP);
+            }
+        }
+    }
+
+    // Software RSS: spread flows over the worker CPUs by flow hash, whatever the RX CPU is
+    if (!second_stage) {
+        u32 k = 0;
+        u32 *workers = rss_cpu_count.lookup(&k);
+        if (workers && *workers) {
+            u32 worker = flow_hash(ip, udp) % *workers;
+            u32 *cpu = rss_cpus.lookup(&worker);
+            if (cpu) {
+                // XDP_REDIRECT, or XDP_ABORTED when the cpumap entry is missing
+                return verdict(slot, VERDICT_CPU_REDIRECT, cpu_map.redirect_map(*cpu, 0));
+            }
+        }
+    }
 
     //unsigned char *payload = (unsigned char *)(udp + 1);
     //bpf_trace_printk("UDP Data: %s", payload);
@@ -230,8 +1063,7 @@ int xdp_prog(struct xdp_md *ctx) {
 
 
     // packet counter
-    u32 k0 = 0;
-    u64 *pktcnt = counter.lookup(&k0);
+    u64 *pktcnt = counter.lookup(&slot);
     if (pktcnt) {
 #ifdef DEBUG
         bpf_trace_printk("Receive UDP packet with size %d", pkt_size);
@@ -239,30 +1071,205 @@ int xdp_prog(struct xdp_md *ctx) {
         (*pktcnt)++;
         //__sync_fetch_and_add(pktcnt, 1);
     } else {
-        return XDP_PASS;
+        return verdict(slot, VERDICT_MAP_LOOKUP, XDP_PASS);
     }
 
-    u32 i = 0;
-    u64 *backends_cnt = backend_counter.lookup(&i);
-    if (!backends_cnt) {
+    // Read the generation once, everything below uses the same copy of the backend tables
+    u32 *generation = backend_generation.lookup(&service_id);
+    if (!generation) {
+        return verdict(slot, VERDICT_MAP_LOOKUP, XDP_PASS);
+    }
+    u32 pool = service_id * 2 + (*generation & 1);
+
+    u32 *backends_cnt = backend_counter.lookup(&pool);
+    if (!backends_cnt || *backends_cnt == 0) {
         // No backends is configured
 #ifdef DEBUG
         bpf_trace_printk("No backends is configured");
 #endif
-        return XDP_PASS;
+        return verdict(slot, VERDICT_NO_BACKENDS, XDP_PASS);
     }
 
 #ifdef DEBUG
-    bpf_trace_printk("Backend count: %d", *backends_cnt);
+    bpf_trace_printk("Service %d backend count: %d (pool %d)", service_id, *backends_cnt, pool);
 #endif
 
-    // choose backend index (round robin)
-    u32 index = (*pktcnt) % (*backends_cnt);
-    struct backend_t *be = backends.lookup(&index);
+    // Source address of forwarded packets
+    u32 *spo = source_ip_out.lookup(&slot);
+    u32 nat_ip = (spo && *spo) ? *spo : vip;
+
+    // XDP_TX is not available to cpumap programs, the second stage always goes through the devmap
+    int redirect = second_stage || (spo && *spo);
+
+    // Connection tracking: a flow keeps its backend and source port until it is idle for timeout_ns.
+    // DSR replies do not come back through the load balancer, there is nothing to translate
+    u32 i = 0;
+    struct conntrack_config_t *ct = conntrack_config.lookup(&i);
+    int tracked = ct && ct->timeout_ns && forwarding == FORWARDING_NAT;
+    struct flow_key_t flow_key = {
+        .saddr = ip->saddr,
+        .daddr = vip,
+        .sport = udp->source,
+        .dport = udp->dest,
+        .proto = IPPROTO_UDP,
+    };
+    struct flow_t *flow = NULL;
+    struct backend_t *be = NULL;
+    u32 index = 0;
+
+    if (tracked) {
+        flow = conntrack.lookup(&flow_key);
+        if (flow && !flow_alive(flow, &flow_key, ct->timeout_ns, time_start)) {
+            conntrack_event(CT_EVENT_EXPIRED);
+            flow = NULL;
+        }
+
+        if (flow) {
+            // Backends keep their slot while they stay in the pool, unless the table is compacted after a removal
+            u32 flow_index = flow->index;
+            u32 backend_index = pool * __MAX_BACKENDS__ + flow_index;
+            if (flow_index < *backends_cnt && flow_index < __MAX_BACKENDS__) {
+                be = backends.lookup(&backend_index);
+            }
+
+            if (!be || be->ip != flow->backend_ip || be->port != flow->backend_port) {
+                struct backend_slot_key_t slot_key = {
+                    .pool = pool,
+                    .ip = flow->backend_ip,
+                    .port = flow->backend_port,
+                };
+                u32 *moved = backend_slots.lookup(&slot_key);
+                be = NULL;
+                if (moved && *moved < *backends_cnt && *moved < __MAX_BACKENDS__) {
+                    flow_index = *moved;
+                    backend_index = pool * __MAX_BACKENDS__ + flow_index;
+                    be = backends.lookup(&backend_index);
+                }
+            }
+
+            // Reassigned only when the backend left the pool
+            if (be && be->ip == flow->backend_ip && be->port == flow->backend_port) {
+                index = flow_index;
+                flow->index = flow_index;
+            } else {
+                conntrack_event(CT_EVENT_REASSIGNED);
+
+                // Free the source port of the flow
+                struct nat_key_t nat_key = {};
+                flow_nat_key(flow, &nat_key);
+                struct nat_t *nat = conntrack_reverse.lookup(&nat_key);
+                if (nat && nat_owned(nat, &flow_key)) {
+                    conntrack_reverse.delete(&nat_key);
+                }
+
+                be = NULL;
+                flow = NULL;
+            }
+        }
+    }
+
     if (!be) {
-        // No backends is configured, this is unexpected
-        bpf_trace_printk("Backends %d not found", index);
-        return XDP_PASS;
+        // choose backend index
+        u32 *algorithm = lb_algorithm.lookup(&i);
+        if (algorithm && *algorithm == LB_ALGORITHM_MAGLEV) {
+            // consistent hash, packets of a flow always go to the same backend
+            u32 table_slot = pool * __MAGLEV_TABLE_SIZE__ + flow_hash(ip, udp) % __MAGLEV_TABLE_SIZE__;
+            u32 *maglev_index = maglev_table.lookup(&table_slot);
+            if (!maglev_index) {
+                return verdict(slot, VERDICT_MAP_LOOKUP, XDP_PASS);
+            }
+            index = *maglev_index;
+        } else {
+            // round robin, through the weighted sequence when backends have different weights
+            u32 *sequence_len = weighted_rr_counter.lookup(&pool);
+            if (sequence_len && *sequence_len) {
+                u32 sequence_slot = pool * __WEIGHTED_RR_SIZE__ + (*pktcnt) % (*sequence_len);
+                u32 *weighted_index = weighted_rr.lookup(&sequence_slot);
+                if (!weighted_index) {
+                    return verdict(slot, VERDICT_MAP_LOOKUP, XDP_PASS);
+                }
+                index = *weighted_index;
+            } else {
+                index = (*pktcnt) % (*backends_cnt);
+            }
+        }
+
+        if (index >= __MAX_BACKENDS__) {
+            return verdict(slot, VERDICT_BAD_BACKEND, XDP_PASS);
+        }
+
+        u32 backend_index = pool * __MAX_BACKENDS__ + index;
+        be = backends.lookup(&backend_index);
+        if (!be) {
+            // No backends is configured, this is unexpected
+            bpf_trace_printk("Backends %d not found", index);
+            return verdict(slot, VERDICT_MAP_LOOKUP, XDP_PASS);
+        }
+    }
+
+    flow_sample(ip, udp, service_id, be, pkt_size);
+
+    if (forwarding != FORWARDING_NAT) {
+        // DSR: the backend gets the client packet as is inside a tunnel, and replies to the client directly
+        struct macaddr *mac = lb_mac.lookup(&slot);
+        u32 *tunnel_saddr = tunnel_source.lookup(&slot);
+        u32 *mtu = tunnel_mtu.lookup(&slot);
+        if (!mac || !tunnel_saddr || !mtu) {
+            return verdict(slot, VERDICT_NO_LB_MAC, XDP_PASS);
+        }
+
+        // The driver would drop an oversized frame after it is counted as forwarded, drop it here where it is seen
+        if (*mtu && bpf_ntohs(ip->tot_len) + encap_len(forwarding) > *mtu) {
+            return verdict(slot, VERDICT_ENCAP_TOO_BIG, XDP_DROP);
+        }
+
+        if (encap(ctx, forwarding, be, be->tunnel_port ? be->tunnel_port : tunnel_port, mac, *tunnel_saddr, flow_hash(ip, udp))) {
+            return verdict(slot, VERDICT_ENCAP_FAILED, XDP_DROP);
+        }
+
+        return forward(slot, service_id, index, pkt_size, time_start, *pktcnt, redirect);
+    }
+
+    // Source port: the one of the flow, or the client port when conntrack is disabled
+    u16 nat_port = udp->source;
+    if (flow) {
+        nat_port = flow->nat_port;
+    } else if (tracked) {
+        // New flow, its reply entry maps the allocated port back to the client
+        struct nat_key_t nat_key = {
+            .backend_ip = be->ip,
+            .nat_ip = nat_ip,
+            .backend_port = be->port,
+            .nat_port = 0,
+            .proto = IPPROTO_UDP,
+        };
+        struct nat_t nat = {
+            .client_ip = ip->saddr,
+            .vip = vip,
+            .client_port = udp->source,
+            .vport = udp->dest,
+            .slot = slot,
+            .last_seen = time_start,
+        };
+        __builtin_memcpy(nat.client_mac, eth->h_source, ETH_ALEN);
+        __builtin_memcpy(nat.lb_mac, eth->h_dest, ETH_ALEN);
+
+        if (!nat_port_alloc(&nat_key, &nat, ct, time_start)) {
+            return verdict(slot, VERDICT_NO_NAT_PORT, XDP_DROP);
+        }
+
+        struct flow_t new_flow = {
+            .backend_ip = be->ip,
+            .backend_port = be->port,
+            .nat_port = nat_key.nat_port,
+            .nat_ip = nat_ip,
+            .index = index,
+            .last_seen = time_start,
+        };
+        conntrack.update(&flow_key, &new_flow);
+        conntrack_event(CT_EVENT_CREATED);
+
+        nat_port = nat_key.nat_port;
     }
 
 #ifdef DEBUG
@@ -273,22 +1280,12 @@ int xdp_prog(struct xdp_md *ctx) {
 
     // L3 rewrite
 
-    u32 sk = 0;
-    u32 *spo = source_ip_out.lookup(&sk);
-    if (!spo || *spo == *fip) {
-#ifdef DEBUG
-        bpf_trace_printk("Source IP out not found, using filter ip ");
-#endif
-        ip->saddr = *fip;
-    } else {
-#ifdef DEBUG
-        bpf_trace_printk("Source IP out: %d", *spo);
-#endif
-
-        ip->saddr = *spo;
-    }
-
+    u32 saddr = ip->saddr;
+    u16 sport = udp->source;
+    u16 dport = udp->dest;
+    ip->saddr = nat_ip;
     ip->daddr = be->ip;
+    udp->source = nat_port;
     udp->dest = be->port;
 
 #ifdef DEBUG
@@ -298,8 +1295,7 @@ int xdp_prog(struct xdp_md *ctx) {
     // L2 rewrite (dst + src MAC)
     __builtin_memcpy(eth->h_dest, be->mac, ETH_ALEN);
 
-    u32 k1 = 0;
-    struct macaddr *mac = lb_mac.lookup(&k1);
+    struct macaddr *mac = lb_mac.lookup(&slot);
     if (mac) {
         __builtin_memcpy(eth->h_source, mac, ETH_ALEN);
 
@@ -315,56 +1311,29 @@ int xdp_prog(struct xdp_md *ctx) {
         bpf_trace_printk("Can not find lb mac address");
 #endif
 
-        return XDP_PASS;
+        return verdict(slot, VERDICT_NO_LB_MAC, XDP_PASS);
     }
 
-    // Recalculate IP packet checksum
-    ip->check = iph_csum(ip);
+    // Update IP and UDP checksums, the destination address was the VIP
+    update_csums(ip, udp, data_end, saddr, vip, sport, dport);
 
 #ifdef DEBUG
-    bpf_trace_printk("IP Checksum #1: 0x%x", ip->check);
+    bpf_trace_printk("IP checksum: 0x%x, UDP checksum: 0x%x", ip->check, udp->check);
 #endif
 
-    //ip->check = iph_csum(ip);
-    //bpf_trace_printk("IP Checksum #2: 0x%x", ip->check);
-
-    // Calculate UDP packet checksum (optional)
-    udp->check = 0;
-    //udp->check = caludpcsum(ip, udp, data_end);
-    //bpf_trace_printk("UDP Checksum: 0x%x", udp->check);
-
 #ifdef DEBUG
     unsigned char *payload = (unsigned char *)(udp + 1);
     bpf_trace_printk("UDP Data: %s", payload);
 #endif
 
+    return forward(slot, service_id, index, pkt_size, time_start, *pktcnt, redirect);
+}
 
-    if (*pktcnt % 100 == 0)
-    {
-        int time_delta = bpf_ktime_get_ns() - time_start;
-#ifdef DEBUG
-        bpf_trace_printk("time delta: %d", time_delta);
-#endif
-        struct event *event = rb.ringbuf_reserve(sizeof(struct event));
-        if (!event) {
-            bpf_trace_printk("Cannot allocate %d bytes from ring buffer\n", sizeof(struct event));
-            return XDP_PASS;
-        }
-        event->pkt_size = pkt_size;
-        event->time_delta = time_delta;
-
-        // Send packet size to userspace ring buffer
-        rb.ringbuf_submit(event, 0);
-
-    }
-
-    if (!spo || *spo == *fip) {
-#ifdef DEBUG
-        bpf_trace_printk("Source IP out not found, returning XDP_TX");
-#endif
-        return XDP_TX;
-    } else {
-        return tx_port.redirect_map(0, 0);
-    }
+int xdp_prog(struct xdp_md *ctx) {
+    return lb_process(ctx, 0);
+}
 
+// Second stage of software RSS, run by the cpumap on the worker CPUs
+int xdp_cpu_prog(struct xdp_md *ctx) {
+    return lb_process(ctx, 1);
 }
\ No newline at end of file